@@ -1,18 +1,32 @@
 #!/usr/bin/python3
 import sys, getopt
+import os.path
+import array
 import collections
 import logging
+import multiprocessing
+import tsv_files
+# NumPy is needed for the binary output only
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 USAGE = "\nThe script calculates domain and domain combination prevalences in genomes using as input the results generated by the process_MiST_TCS.py script. \n" + \
 	"It calculates also this information at the domain superfamily level for the MiST signal transduction domains. \n\n" + \
 	"python " + sys.argv[0] + '''
 	-h || --help               - help
-	-i || --ifile              - input file 1 (protein and domain information file generated by the process_MiST_TCS.py script)
+	-i || --ifile              - input file 1 (protein and domain information file generated by the process_MiST_TCS.py script, plain or gzip-compressed)
 	-s || --sfile              - input file 2 (with MiST domain information)
 	-f || --ffile              - output file 1 (domain prevalence)
 	-g || --gfile              - output file 2 (domain combination prevalence)
 	-k || --kfile              - output file 3 (domain supefamily prevalence)
 	-l || --lfile              - output file 4 (domain supefamily combination prevalence)
+	-b || --binary             - also write every output file as an .npz file next to it (requires NumPy): integer-coded genome, element and count arrays
+	                             with the genome and element names, which analyze_tcs_per_taxon.py loads without parsing text
+	-j || --jobs               - number of processes (default 1). A plain input file is split into byte ranges starting at genome boundaries,
+	                             which are analyzed in parallel and written in the order of the input file, so the output does not depend on it.
+	                             A gzip-compressed input file is analyzed by one process
 '''
 # Variables controlled by the script parameters
 INPUT_FILE1 = None
@@ -21,6 +35,8 @@ OUTPUT_FILE1 = "genome_to_domain_data.tsv"
 OUTPUT_FILE2 = "genome_to_domain_comb_data.tsv"
 OUTPUT_FILE3 = "genome_to_superfamily_data.tsv"
 OUTPUT_FILE4 = "genome_to_superfamily_comb_data.tsv"
+BINARY = False
+JOBS = 1
 
 MIST_DOMAIN_TO_SUPERFAMILY = {}
 HIS_KINASE_DIM_DOMAINS = ["HisKA", "HisKA_2", "HisKA_3", "H-kinase_dim", "His_kinase"]
@@ -28,13 +44,20 @@ HIS_KINASE_CATAL_DOMAINS = ["HATPase_c", "HATPase_c_2", "HATPase_c_5", "HWE_HK"]
 RESPONSE_REG_DOMAINS = ["Response_reg", "FleQ"]
 
 # Variables set within the script
+# byte ranges analyzed by the processes are not larger than this, so many of them are in flight and the results arrive steadily
+MAX_CHUNK_SIZE = 64*1024*1024
+CHUNKS_PER_JOB = 4
+# output files stay open for the whole run
+OUTPUT_FILE_TO_HANDLE = {}
+# {output file: {"genomes": [names], "genome_ids": {name: code}, "elements": [...], "element_ids": {...}, "genome": codes, "element": codes, "count": counts}}
+OUTPUT_FILE_TO_BINARY = {}
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(filename=sys.argv[0].replace(".py", "") + "_log.txt", level=logging.INFO)
 
 def initialize(argv):
-	global INPUT_FILE1, INPUT_FILE2, OUTPUT_FILE1, OUTPUT_FILE2, OUTPUT_FILE3, OUTPUT_FILE4
+	global INPUT_FILE1, INPUT_FILE2, OUTPUT_FILE1, OUTPUT_FILE2, OUTPUT_FILE3, OUTPUT_FILE4, BINARY, JOBS
 	try:
-		opts, args = getopt.getopt(argv[1:],"hi:s:f:g:k:l:",["help", "ifile=", "sfile=", "ffile=", "gfile=", "kfile=", "lfile="])
+		opts, args = getopt.getopt(argv[1:],"hi:s:f:g:k:l:bj:",["help", "ifile=", "sfile=", "ffile=", "gfile=", "kfile=", "lfile=", "binary", "jobs="])
 		if len(opts) == 0:
 			raise getopt.GetoptError("Options are required\n")
 	except getopt.GetoptError as e:
@@ -57,13 +80,24 @@ def initialize(argv):
 				OUTPUT_FILE3 = str(arg).strip()
 			elif opt in ("-l", "--lfile"):
 				OUTPUT_FILE4 = str(arg).strip()
+			elif opt in ("-b", "--binary"):
+				if numpy is None:
+					raise ImportError("The binary output (-b) requires NumPy")
+				BINARY = True
+			elif opt in ("-j", "--jobs"):
+				JOBS = int(arg)
+				if JOBS < 1:
+					raise ValueError("-j (--jobs) must be at least 1")
 	except Exception as e:
 		print("===========ERROR==========\n " + str(e) + USAGE)
 		sys.exit(2)
 
 def processInput():
-	global MIST_DOMAIN_TO_SUPERFAMILY
-	with open(INPUT_FILE2, "r") as iFile2:
+	readDomainSuperfamilies(INPUT_FILE2)
+
+# also used by tcs_pipeline.py, which counts the records of obtain_and_process_tcs.py with countPerGenome() as they are made
+def readDomainSuperfamilies(domainsFile):
+	with open(domainsFile, "r") as iFile2:
 		for line in iFile2:
 			domain_info = line.split("\t")
 			MIST_DOMAIN_TO_SUPERFAMILY[domain_info[2].strip()] = domain_info[3].strip()
@@ -73,70 +107,183 @@ def processInput():
 # domain_comb_to_protein_count = {"MEDS,PAS,PAS_3,PAS_4,PAS_9":2}. This means that a particualr domain combiation was found in 2 protins in the given genome
 # reports inofrmation per genome
 def findDomainAndCombPrevalenceInProteins():
-	domain_to_protein_count = collections.defaultdict(int)
-	# MiST domain superfamilies only
-	superfamily_to_protein_count = collections.defaultdict(int)
+	openOutputFiles()
+	try:
+		if JOBS > 1 and not tsv_files.isGzipFile(INPUT_FILE1):
+			pool = multiprocessing.Pool(JOBS, initializer=setDomainSuperfamilies, initargs=(MIST_DOMAIN_TO_SUPERFAMILY,))
+			try:
+				# results come in the order of the byte ranges, i.e. of the input file
+				byteRanges = [(INPUT_FILE1, start, end) for start, end in genomeAlignedRanges(INPUT_FILE1, JOBS*CHUNKS_PER_JOB)]
+				for genomes in pool.imap(processByteRange, byteRanges):
+					writeGenomes(genomes)
+			finally:
+				pool.terminate()
+		else:
+			with tsv_files.openTsv(INPUT_FILE1) as iFile:
+				writeGenomes(countPerGenome(iFile))
+	finally:
+		closeOutputFiles()
 
-	domain_comb_to_protein_count = collections.defaultdict(int)
-	# MiST domain superfamilies only
-	superfamily_comb_to_protein_count = collections.defaultdict(int)
+def setDomainSuperfamilies(domainToSuperfamily):
+	MIST_DOMAIN_TO_SUPERFAMILY.update(domainToSuperfamily)
 
+# yields (Genome_id, [domain_to_protein_count, domain_comb_to_protein_count, superfamily_to_protein_count, superfamily_comb_to_protein_count])
+# for every run of consecutive lines of a genome
+def countPerGenome(proteins):
 	Genome_id_prev = None
-	with open(INPUT_FILE1, "r") as iFile:
-		for protein in iFile:
-			# filed 6 has only uniqe domain names with indicated counts showing how many times a given domain is present in a given protein.
-			# Domains are sorted alphabetically
-			# Ex., HATPase_c:1,HisKA_2:1,MEDS:1,PAS:1,PAS_3:2,PAS_4:1,PAS_9:1 
-			protein_record = protein.strip().split("\t")
-			Genome_id = protein_record[0]
-			domain_counts = protein_record[6].replace("<", "").replace(">", "")
-			# if records of a new genome began, save the previous genome data and update variables
-			if Genome_id != Genome_id_prev:
-				if Genome_id_prev:
-					writeToFile(domain_to_protein_count, Genome_id_prev, OUTPUT_FILE1)
-					writeToFile(domain_comb_to_protein_count, Genome_id_prev, OUTPUT_FILE2)
-					writeToFile(superfamily_to_protein_count, Genome_id_prev, OUTPUT_FILE3)
-					writeToFile(superfamily_comb_to_protein_count, Genome_id_prev, OUTPUT_FILE4)
-
-				Genome_id_prev = Genome_id
-				domain_to_protein_count = collections.defaultdict(int)
-				domain_comb_to_protein_count = collections.defaultdict(int)
-				superfamily_to_protein_count = collections.defaultdict(int)
-				superfamily_comb_to_protein_count = collections.defaultdict(int)
-
-			domains_and_counts = domain_counts.split(",")
-			# empty list to collect domains of a protein and add the domain combination dictinary (domain_comb_to_protein_count)
-			domains = []
-			# empty list to collect superfamilie of domains of a proteins and add to the superfamily combination dictionary (superfamily_comb_to_protein_count)
-			domains_and_superfamilies = []
-			for domain in domains_and_counts:
-				domain = domain.split(":")[0]
-				# if entry is a sensor domain
-				if domain not in HIS_KINASE_DIM_DOMAINS and domain not in HIS_KINASE_CATAL_DOMAINS and domain not in RESPONSE_REG_DOMAINS:
-					domain_to_protein_count[domain]+=1
-					domains.append(domain)
-					if domain in MIST_DOMAIN_TO_SUPERFAMILY:
-						superfamily_to_protein_count[MIST_DOMAIN_TO_SUPERFAMILY[domain]]+=1
-						domains_and_superfamilies.append(MIST_DOMAIN_TO_SUPERFAMILY[domain])
-					else:
-						superfamily_to_protein_count[domain]+=1
-						domains_and_superfamilies.append(domain)
-
-			# count this domain combination
-			domain_comb_to_protein_count[",".join(sorted(domains))]+=1
-
-			# count this superfamily combination
-			superfamily_comb_to_protein_count[",".join(sorted(domains_and_superfamilies))]+=1
-			
+	for protein in proteins:
+		# filed 6 has only uniqe domain names with indicated counts showing how many times a given domain is present in a given protein.
+		# Domains are sorted alphabetically
+		# Ex., HATPase_c:1,HisKA_2:1,MEDS:1,PAS:1,PAS_3:2,PAS_4:1,PAS_9:1 
+		protein_record = protein.strip().split("\t")
+		Genome_id = protein_record[0]
+		domain_counts = protein_record[6].replace("<", "").replace(">", "")
+		# if records of a new genome began, save the previous genome data and update variables
+		if Genome_id != Genome_id_prev:
+			if Genome_id_prev:
+				yield Genome_id_prev, [domain_to_protein_count, domain_comb_to_protein_count, superfamily_to_protein_count, superfamily_comb_to_protein_count]
+
+			Genome_id_prev = Genome_id
+			domain_to_protein_count = collections.defaultdict(int)
+			domain_comb_to_protein_count = collections.defaultdict(int)
+			# MiST domain superfamilies only
+			superfamily_to_protein_count = collections.defaultdict(int)
+			# MiST domain superfamilies only
+			superfamily_comb_to_protein_count = collections.defaultdict(int)
+
+		domains_and_counts = domain_counts.split(",")
+		# empty list to collect domains of a protein and add the domain combination dictinary (domain_comb_to_protein_count)
+		domains = []
+		# empty list to collect superfamilie of domains of a proteins and add to the superfamily combination dictionary (superfamily_comb_to_protein_count)
+		domains_and_superfamilies = []
+		for domain in domains_and_counts:
+			domain = domain.split(":")[0]
+			# if entry is a sensor domain
+			if domain not in HIS_KINASE_DIM_DOMAINS and domain not in HIS_KINASE_CATAL_DOMAINS and domain not in RESPONSE_REG_DOMAINS:
+				domain_to_protein_count[domain]+=1
+				domains.append(domain)
+				if domain in MIST_DOMAIN_TO_SUPERFAMILY:
+					superfamily_to_protein_count[MIST_DOMAIN_TO_SUPERFAMILY[domain]]+=1
+					domains_and_superfamilies.append(MIST_DOMAIN_TO_SUPERFAMILY[domain])
+				else:
+					superfamily_to_protein_count[domain]+=1
+					domains_and_superfamilies.append(domain)
+
+		# count this domain combination
+		domain_comb_to_protein_count[",".join(sorted(domains))]+=1
+
+		# count this superfamily combination
+		superfamily_comb_to_protein_count[",".join(sorted(domains_and_superfamilies))]+=1
+	# the last genome of the input
+	if Genome_id_prev:
+		yield Genome_id_prev, [domain_to_protein_count, domain_comb_to_protein_count, superfamily_to_protein_count, superfamily_comb_to_protein_count]
+
+# splits the file into about rangeCount byte ranges (limited to MAX_CHUNK_SIZE); every range but the first starts at the first line of a genome
+def genomeAlignedRanges(path, rangeCount):
+	fileSize = os.path.getsize(path)
+	rangeSize = max(1, min(MAX_CHUNK_SIZE, -(-fileSize // rangeCount)))
+	starts = [0]
+	with open(path, "rb") as iFile:
+		for offset in range(rangeSize, fileSize, rangeSize):
+			if offset <= starts[-1]:
+				continue
+			start = genomeStart(iFile, offset)
+			if start < fileSize and start > starts[-1]:
+				starts.append(start)
+	return list(zip(starts, starts[1:] + [fileSize]))
+
+# returns the offset of the first line at or after offset whose genome differs from the genome of the line before it
+def genomeStart(iFile, offset):
+	iFile.seek(offset - 1)
+	# the rest of the line containing offset-1 (which is empty if offset is at a line start)
+	iFile.readline()
+	start = iFile.tell()
+	previousGenome = None
+	while True:
+		line = iFile.readline()
+		if not line:
+			return start
+		genome = line.split(b"\t", 1)[0]
+		if previousGenome is not None and genome != previousGenome:
+			return start
+		previousGenome = genome
+		start+=len(line)
+
+def readByteRange(path, start, end):
+	with open(path, "rb") as iFile:
+		iFile.seek(start)
+		position = start
+		while position < end:
+			line = iFile.readline()
+			if not line:
+				break
+			position+=len(line)
+			yield line.decode("utf-8")
+
+# runs in the pool processes; the path comes with the range, as globals set by initialize() reach the workers only when they are forked
+def processByteRange(byteRange):
+	path, start, end = byteRange
+	return list(countPerGenome(readByteRange(path, start, end)))
+
+def openOutputFiles(outputFiles=None):
+	for outputFile in outputFiles or (OUTPUT_FILE1, OUTPUT_FILE2, OUTPUT_FILE3, OUTPUT_FILE4):
+		OUTPUT_FILE_TO_HANDLE[outputFile] = open(outputFile, "w")
+
+def closeOutputFiles():
+	for oFile in OUTPUT_FILE_TO_HANDLE.values():
+		oFile.close()
+	OUTPUT_FILE_TO_HANDLE.clear()
+
+def writeGenomes(genomes):
+	for Genome_id, dataDicts in genomes:
+		for dataDict, outputFile in zip(dataDicts, (OUTPUT_FILE1, OUTPUT_FILE2, OUTPUT_FILE3, OUTPUT_FILE4)):
+			writeToFile(dataDict, Genome_id, outputFile)
+
 def writeToFile(dataDict, Genome_id, outputFile):
 	if Genome_id != "Genome_id":
-		with open (outputFile, "a") as oFile:
-			for element, count in dataDict.items():
-				oFile.write("\t".join([Genome_id, element, str(count)]) + "\n")
+		OUTPUT_FILE_TO_HANDLE[outputFile].write("".join(["\t".join([Genome_id, element, str(count)]) + "\n" for element, count in dataDict.items()]))
+		if BINARY:
+			addToBinary(dataDict, Genome_id, outputFile)
+
+# genomes and elements are coded in the order they are written, the order analyze_tcs_per_taxon.py reads them from the text file
+def addToBinary(dataDict, Genome_id, outputFile):
+	binary = OUTPUT_FILE_TO_BINARY.get(outputFile)
+	if binary is None:
+		binary = OUTPUT_FILE_TO_BINARY[outputFile] = newBinary()
+	genome_id = binary["genome_ids"].setdefault(Genome_id, len(binary["genomes"]))
+	if genome_id == len(binary["genomes"]):
+		binary["genomes"].append(Genome_id)
+	element_ids = binary["element_ids"]
+	for element, count in dataDict.items():
+		element_id = element_ids.get(element)
+		if element_id is None:
+			element_id = element_ids[element] = len(binary["elements"])
+			binary["elements"].append(element)
+		binary["genome"].append(genome_id)
+		binary["element"].append(element_id)
+		binary["count"].append(count)
+
+def newBinary():
+	return {"genomes": [], "genome_ids": {}, "elements": [], "element_ids": {}, "genome": array.array("i"), "element": array.array("i"), "count": array.array("q")}
+
+def binaryFile(outputFile):
+	return os.path.splitext(outputFile)[0] + ".npz"
+
+# the arrays are stored uncompressed so that they are loaded with a single read each; every output file gets its .npz file,
+# with empty arrays when no genome was written to it
+def writeBinaryFiles():
+	for outputFile in (OUTPUT_FILE1, OUTPUT_FILE2, OUTPUT_FILE3, OUTPUT_FILE4):
+		binary = OUTPUT_FILE_TO_BINARY.get(outputFile) or newBinary()
+		numpy.savez(binaryFile(outputFile), genomes=numpy.array(binary["genomes"], dtype=str), elements=numpy.array(binary["elements"], dtype=str),
+			genome=numpy.frombuffer(binary["genome"], dtype=numpy.int32), element=numpy.frombuffer(binary["element"], dtype=numpy.int32),
+			count=numpy.frombuffer(binary["count"], dtype=numpy.int64))
 
 def main(argv):
 	initialize(argv)
 	processInput()
 	findDomainAndCombPrevalenceInProteins()
+	if BINARY:
+		writeBinaryFiles()
 
-main(sys.argv)
+if __name__ == "__main__":
+	main(sys.argv)
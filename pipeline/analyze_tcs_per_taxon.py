@@ -1,6 +1,23 @@
 #!/usr/bin/python3
 import sys, getopt
+import os.path
+import array
 import collections
+import tsv_files
+import gtdb_taxonomy
+try:
+	import resource
+except ImportError:
+	resource = None
+# NumPy and SciPy are needed by the matrix mode and NumPy by the .npz input only
+try:
+	import numpy
+except ImportError:
+	numpy = None
+try:
+	import scipy.sparse
+except ImportError:
+	scipy = None
 
 USAGE = "\nThe script calculates domain and domain combination prevalences at chosen taxonomy levels using the result of the 'analyze_tcs_per_genome' script. \n" + \
 	"'analyze_tcs_per_genome' script produces domain (as well as domain combination, domain superfamily, domain superfamily combination) count statisitcs per genome.\n\n" + \
@@ -11,29 +28,54 @@ USAGE = "\nThe script calculates domain and domain combination prevalences at ch
 							        * domain combination prevalence
 							        * domain supefamily prevalence
 							        * domain supefamily combination prevalence)
-	-s || --sfile              - input file 2 (GTDB taxonomy metadata file)
+	                             plain or gzip-compressed, or the .npz file written next to it by analyze_tcs_per_genome.py -b (requires NumPy)
+	-s || --sfile              - input file 2 (GTDB taxonomy metadata file: the GTDB zip archive, a plain or a gzip-compressed TSV;
+	                             default ''' + "input/gtdb_taxonomy/ar53_bac120_taxonmy_r214.tsv.zip" + ''' of this repository).
+	                             An index of it is saved next to it on the first run and loaded by the next runs
+	--index-dir                - directory for the taxonomy index instead of the directory of input file 2
 	-f || --ffile              - output file 1 (protein and domains statistics per selected taxon)
-	-t || --taxlevel           - taxonomy level to calculate the average at (one of "species", "genus", "order", "family", "class", "phylum", "kingdom")
+	-t || --taxlevel           - taxonomy level to calculate the average at (one of "species", "genus", "order", "family", "class", "phylum", "kingdom"),
+	                             a comma-separated list of them or "all". With several levels the input is read once and one file is written per level,
+	                             named after output file 1 with the level added before the extension (domains.tsv -> domains_genus.tsv)
+	-m || --matrix             - matrix mode (requires NumPy and SciPy): builds a sparse taxon x domain matrix and writes, per taxon and domain,
+	                             the count, the average count per genome, the fraction of genomes having the domain and the number of genomes of the taxon
+	                             (genomes of the input file) to output file 1, and the same as arrays to an .npz file next to it
+	                             (taxa, domains, genomes per taxon, and taxon, domain, sum, carriers per non-zero cell)
 '''
 # Variables controlled by the script parameters
 INPUT_FILE1 = None
-INPUT_FILE2 = None
-INPUT_FILE3 = "/home/vadim/bin/ar53_bac120_taxonmy_r214.tsv"
-TAXONOMY_LEVEL = "species"
+INPUT_FILE2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "input", "gtdb_taxonomy", "ar53_bac120_taxonmy_r214.tsv.zip")
+INDEX_DIR = None
+TAXONOMY_LEVELS = ["species"]
+ALL_TAXONOMY_LEVELS = ["species", "genus", "family", "order", "class", "phylum", "kingdom"]
+MATRIX = False
 
 OUTPUT_FILE1 = "domain_statistics_per_taxon.tsv"
 
-GENOME_TO_DOMAIN = collections.defaultdict(list)
 GENOME_TO_TAXONOMY = {}
-# {"full taxonomy up to the selected level": ["Genome1", "Genome2", "Genome3", ...], ...}
-TAXONOMY_TO_GENOMES = collections.defaultdict(list)
-# {"full taxonomy up to the selected level": {"domain1 (domain combination 1)": 21, "domain2(or domain comb 2)": 852, ...}, ...}
-TAXONOMY_TO_STATISTICS = collections.defaultdict(dict)
+# full taxonomies (species level) and domains (or domain combinations) are interned to integer ids in the order they are first read:
+# TAXA[taxon id] = "full taxonomy", DOMAINS[domain id] = "domain1 (domain combination 1)"
+TAXON_TO_ID = {}
+TAXA = []
+DOMAIN_TO_ID = {}
+DOMAINS = []
+# TAXON_STATISTICS[taxon id] = {domain id: 21, domain id: 852, ...}; statistics of the higher levels are rolled up from it
+TAXON_STATISTICS = []
+GENOMES_WITHOUT_TAXONOMY = set()
+# matrix mode: genomes are numbered in the order they are read; one entry per input line with the genome number, domain id and count
+GENOME_TO_NUMBER = {}
+# species taxon id of every genome number
+GENOME_TAXA = array.array("i")
+MATRIX_GENOMES = array.array("i")
+MATRIX_DOMAINS = array.array("i")
+MATRIX_COUNTS = array.array("q")
+# the globals above are the accumulator of this script; tcs_pipeline.py keeps one accumulator per statistics it streams (see new_accumulator())
+ACCUMULATOR = {"taxon_to_id": TAXON_TO_ID, "taxa": TAXA, "domain_to_id": DOMAIN_TO_ID, "domains": DOMAINS, "statistics": TAXON_STATISTICS}
 
 def initialize(argv):
-	global INPUT_FILE1, INPUT_FILE2, OUTPUT_FILE1, TAXONOMY_LEVEL
+	global INPUT_FILE1, INPUT_FILE2, OUTPUT_FILE1, TAXONOMY_LEVELS, INDEX_DIR, MATRIX
 	try:
-		opts, args = getopt.getopt(argv[1:],"hi:s:f:t:",["help", "ifile=", "sfile=", "ffile=", "taxlevel="])
+		opts, args = getopt.getopt(argv[1:],"hi:s:f:t:m",["help", "ifile=", "sfile=", "ffile=", "taxlevel=", "index-dir=", "matrix"])
 		if len(opts) == 0:
 			raise getopt.GetoptError("Options are required\n")
 	except getopt.GetoptError as e:
@@ -46,54 +88,206 @@ def initialize(argv):
 				sys.exit()
 			elif opt in ("-i", "--ifile"):
 				INPUT_FILE1 = str(arg).strip()
+				if INPUT_FILE1.endswith(".npz") and numpy is None:
+					raise ImportError("Reading an .npz input file requires NumPy")
 			elif opt in ("-s", "--sfile"):
 				INPUT_FILE2 = str(arg).strip()
 			elif opt in ("-f", "--ffile"):
 				OUTPUT_FILE1 = str(arg).strip()
+			elif opt == "--index-dir":
+				INDEX_DIR = str(arg).strip()
+			elif opt in ("-m", "--matrix"):
+				if numpy is None or scipy is None:
+					raise ImportError("The matrix mode (-m) requires NumPy and SciPy")
+				MATRIX = True
 			elif opt in ("-t", "--taxlevel"):
-				TAXONOMY_LEVEL = tax_level_selector(str(arg).strip())
-				print("Taxonomy level is '" + arg + "':", TAXONOMY_LEVEL)
-				if TAXONOMY_LEVEL == None:
-					raise IOError("Incorrect argument of -t (--taxlevel) option")
+				arg = str(arg).strip()
+				TAXONOMY_LEVELS = ALL_TAXONOMY_LEVELS if arg == "all" else [level.strip() for level in arg.split(",")]
+				for level in TAXONOMY_LEVELS:
+					print("Taxonomy level is '" + level + "':", tax_level_selector(level))
+					if tax_level_selector(level) == None:
+						raise IOError("Incorrect argument of -t (--taxlevel) option")
 	except Exception as e:
 		print("===========ERROR==========\n" + str(e) + USAGE)
 		sys.exit(2)
 
+# the counts are added to the statistics of the genome species while the input file is read, so only the statistics are kept in memory
+# G1 Domcomb2 12
+# d__Archaea;p__Halobacteriota;c__Methanosarcinia;o__Methanosarcinales;f__Methanosarcinaceae;g__Methanosarcina;s__Methanosarcina mazei
 def process_input():
-	global GENOME_TO_DOMAIN
-	with open(INPUT_FILE1, "r") as iFile1:
+	load_taxonomy(INPUT_FILE2, INDEX_DIR)
+	if INPUT_FILE1.endswith(".npz"):
+		process_binary_input()
+		return
+	previous_genome = None
+	statistics = None
+	with tsv_files.openTsv(INPUT_FILE1) as iFile1:
 		for line in iFile1:
 			# domain_c can be a signle domain (GAF_3) or a domain combination (ex, GAF_3,PAS_3,PAS_4,hole)
 			genomeID, domain_c, count = line.strip().split("\t")
-			# {"GenomeID1": (TIM, 5), ... }
-			# Can be domain combination to counts: ("TIM,PIR", 62), ...
-			GENOME_TO_DOMAIN[genomeID].append((domain_c, int(count)))
-	with open(INPUT_FILE3, "r") as iFile3:
-		for line in iFile3:
-			record = line.strip().split("\t")
-			genomeID = "_".join(record[0].split("_")[1:])
-			taxonomy = ";".join(record[1].split(";")[:TAXONOMY_LEVEL])
-			GENOME_TO_TAXONOMY[genomeID] = taxonomy
-			TAXONOMY_TO_GENOMES[taxonomy].append(genomeID)
-
-# reports inofrmation per taxon
-# G1 Domcomb2 12
-# d__Archaea;p__Halobacteriota;c__Methanosarcinia;o__Methanosarcinales;f__Methanosarcinaceae;g__Methanosarcina;s__Methanosarcina mazei
-def process_domains_per_taxon():
-	for genome, domain_counts in GENOME_TO_DOMAIN.items():
-		for element in domain_counts:
-			taxonomy = GENOME_TO_TAXONOMY[genome]
-			domain_c = element[0]
-			if  domain_c in TAXONOMY_TO_STATISTICS[taxonomy]:
-				TAXONOMY_TO_STATISTICS[taxonomy][domain_c] += element[1]
+			# the lines of a genome are consecutive, so its species is looked up once
+			if genomeID != previous_genome:
+				previous_genome = genomeID
+				statistics = taxon_statistics(genomeID)
+				if MATRIX and statistics is not None:
+					genome_number = matrix_genome(genomeID)
+			if statistics is None:
+				continue
+			domain_id = DOMAIN_TO_ID.get(domain_c)
+			if domain_id is None:
+				domain_id = DOMAIN_TO_ID[domain_c] = len(DOMAINS)
+				DOMAINS.append(domain_c)
+			if MATRIX:
+				MATRIX_GENOMES.append(genome_number)
+				MATRIX_DOMAINS.append(domain_id)
+				MATRIX_COUNTS.append(int(count))
 			else:
-				TAXONOMY_TO_STATISTICS[taxonomy][domain_c] = element[1]
+				statistics[domain_id] = statistics.get(domain_id, 0) + int(count)
+	if GENOMES_WITHOUT_TAXONOMY:
+		print("Genomes missing from the taxonomy file (skipped):", len(GENOMES_WITHOUT_TAXONOMY))
+
+# the .npz file of analyze_tcs_per_genome.py: genome and element codes are in the order of its text file,
+# so the element codes are the domain ids and taxa are met in the same order as when the text file is read
+def process_binary_input():
+	with numpy.load(INPUT_FILE1) as binary:
+		genomes = binary["genomes"].tolist()
+		DOMAINS.extend(binary["elements"].tolist())
+		genome_codes = binary["genome"]
+		domain_codes = binary["element"]
+		counts = binary["count"]
+	DOMAIN_TO_ID.update((domain_c, domain_id) for domain_id, domain_c in enumerate(DOMAINS))
+	genome_statistics = [taxon_statistics(genomeID) for genomeID in genomes]
+	if MATRIX:
+		genome_numbers = numpy.array([matrix_genome(genomeID) if statistics is not None else -1
+			for genomeID, statistics in zip(genomes, genome_statistics)], dtype=numpy.int32)[genome_codes]
+		known = genome_numbers >= 0
+		MATRIX_GENOMES.frombytes(genome_numbers[known].tobytes())
+		MATRIX_DOMAINS.frombytes(domain_codes[known].astype(numpy.int32).tobytes())
+		MATRIX_COUNTS.frombytes(counts[known].astype(numpy.int64).tobytes())
+	else:
+		for genome_code, domain_id, count in zip(genome_codes.tolist(), domain_codes.tolist(), counts.tolist()):
+			statistics = genome_statistics[genome_code]
+			if statistics is not None:
+				statistics[domain_id] = statistics.get(domain_id, 0) + count
+	if GENOMES_WITHOUT_TAXONOMY:
+		print("Genomes missing from the taxonomy file (skipped):", len(GENOMES_WITHOUT_TAXONOMY))
+
+def load_taxonomy(taxonomy_file, index_dir=None):
+	global GENOME_TO_TAXONOMY
+	GENOME_TO_TAXONOMY = gtdb_taxonomy.loadIndex(taxonomy_file, index_dir)
+
+def new_accumulator():
+	return {"taxon_to_id": {}, "taxa": [], "domain_to_id": {}, "domains": [], "statistics": []}
+
+# returns the statistics dictionary of the genome species or None for a genome missing from the taxonomy
+def taxon_statistics(genomeID, accumulator=ACCUMULATOR):
+	taxonomy = GENOME_TO_TAXONOMY.get(genomeID)
+	if taxonomy is None:
+		GENOMES_WITHOUT_TAXONOMY.add(genomeID)
+		return None
+	taxon_to_id = accumulator["taxon_to_id"]
+	taxon_id = taxon_to_id.get(taxonomy)
+	if taxon_id is None:
+		taxon_id = taxon_to_id[taxonomy] = len(accumulator["taxa"])
+		accumulator["taxa"].append(taxonomy)
+		accumulator["statistics"].append({})
+	return accumulator["statistics"][taxon_id]
+
+# adds the counts of a genome ({domain or domain combination: count}, as analyze_tcs_per_genome.py counts them) to the statistics of its species
+def add_genome(genomeID, domain_counts, accumulator):
+	statistics = taxon_statistics(genomeID, accumulator)
+	if statistics is None:
+		return
+	domain_to_id = accumulator["domain_to_id"]
+	domains = accumulator["domains"]
+	for domain_c, count in domain_counts.items():
+		domain_id = domain_to_id.get(domain_c)
+		if domain_id is None:
+			domain_id = domain_to_id[domain_c] = len(domains)
+			domains.append(domain_c)
+		statistics[domain_id] = statistics.get(domain_id, 0) + count
+
+def matrix_genome(genomeID):
+	genome_number = GENOME_TO_NUMBER.get(genomeID)
+	if genome_number is None:
+		genome_number = GENOME_TO_NUMBER[genomeID] = len(GENOME_TAXA)
+		GENOME_TAXA.append(TAXON_TO_ID[GENOME_TO_TAXONOMY[genomeID]])
+	return genome_number
+
+# sums the species statistics per taxon of the level, i.e. per taxonomy truncated to the level; returns (taxon, {domain id: count}) pairs
+def roll_up_statistics(level, accumulator=ACCUMULATOR):
+	depth = tax_level_selector(level)
+	if depth == len(ALL_TAXONOMY_LEVELS):
+		return zip(accumulator["taxa"], accumulator["statistics"])
+	taxon_to_statistics = collections.defaultdict(dict)
+	for taxonomy, domain_counts in zip(accumulator["taxa"], accumulator["statistics"]):
+		statistics = taxon_to_statistics[";".join(taxonomy.split(";")[:depth])]
+		for domain_id, count in domain_counts.items():
+			statistics[domain_id] = statistics.get(domain_id, 0) + count
+	return taxon_to_statistics.items()
+
+def level_output_file(level):
+	if len(TAXONOMY_LEVELS) == 1:
+		return OUTPUT_FILE1
+	root, extension = os.path.splitext(OUTPUT_FILE1)
+	return root + "_" + level + extension
+
+# returns the taxa of the level and, for every species taxon id, the number of its taxon at the level
+def level_taxa(level):
+	depth = tax_level_selector(level)
+	taxon_to_number = {}
+	species_to_level = [taxon_to_number.setdefault(";".join(taxonomy.split(";")[:depth]), len(taxon_to_number)) for taxonomy in TAXA]
+	return list(taxon_to_number), species_to_level
+
+# matrix mode: the genome x domain count matrix is multiplied by the taxon x genome membership matrix of the level,
+# which gives the counts and the numbers of genomes having each domain (carriers) of all taxa at once
+def matrix_statistics(level):
+	taxa, species_to_level = level_taxa(level)
+	genome_count = len(GENOME_TAXA)
+	genome_taxa = numpy.asarray(species_to_level, dtype=numpy.int64)[numpy.frombuffer(GENOME_TAXA, dtype=numpy.int32)]
+	genomes_by_domain = scipy.sparse.csr_matrix((numpy.frombuffer(MATRIX_COUNTS, dtype=numpy.int64),
+		(numpy.frombuffer(MATRIX_GENOMES, dtype=numpy.int32), numpy.frombuffer(MATRIX_DOMAINS, dtype=numpy.int32))), shape=(genome_count, len(DOMAINS)))
+	membership = scipy.sparse.csr_matrix((numpy.ones(genome_count, dtype=numpy.int64), (genome_taxa, numpy.arange(genome_count))), shape=(len(taxa), genome_count))
+	genomes_by_domain.eliminate_zeros()
+	carriers_by_domain = genomes_by_domain.copy()
+	carriers_by_domain.data = numpy.ones_like(carriers_by_domain.data)
+	sums = membership.dot(genomes_by_domain)
+	carriers = membership.dot(carriers_by_domain)
+	# both products have the non-zero cells of the same matrices, so with sorted indices their values correspond one to one
+	sums.sort_indices()
+	carriers.sort_indices()
+	carriers = carriers.data
+	sums = sums.tocoo()
+	genomes = numpy.asarray(membership.sum(axis=1)).ravel()
+	return taxa, genomes, sums, carriers
+
+def write_matrix(level, output_file):
+	taxa, genomes, sums, carriers = matrix_statistics(level)
+	taxon_genomes = genomes[sums.row]
+	means = sums.data / taxon_genomes
+	prevalences = carriers / taxon_genomes
+	with open(output_file, "w") as oFile:
+		for taxon, domain_id, count, mean, prevalence, genome_count in zip(sums.row.tolist(), sums.col.tolist(), sums.data.tolist(),
+				means.tolist(), prevalences.tolist(), taxon_genomes.tolist()):
+			oFile.write("\t".join([taxa[taxon], DOMAINS[domain_id], str(count), "{:.6g}".format(mean), "{:.6g}".format(prevalence), str(genome_count)]) + "\n")
+	numpy.savez_compressed(os.path.splitext(output_file)[0] + ".npz", taxa=numpy.array(taxa, dtype=str), domains=numpy.array(DOMAINS, dtype=str),
+		genomes=genomes, taxon=sums.row, domain=sums.col, sum=sums.data, carriers=carriers)
+
+def write_to_file(taxon_to_statistics, output_file, accumulator=ACCUMULATOR):
+	domains = accumulator["domains"]
+	with open(output_file, "w") as oFile:
+		for taxon, domain_counts in taxon_to_statistics:
+			for domain_id, count in domain_counts.items():
+				oFile.write("\t".join([taxon, domains[domain_id], str(count)]) + "\n")
 
-def write_to_file():
-	with open(OUTPUT_FILE1, "w") as oFile:
-		for taxon, domain_counts in TAXONOMY_TO_STATISTICS.items():
-			for domain_c, count in domain_counts.items():
-				oFile.write("\t".join([taxon, domain_c, str(count)]) + "\n")
+def report_memory():
+	if resource is None:
+		return
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		peak = peak // 1024
+	print("Peak memory (RSS): {:.1f} MB".format(peak / 1024.0))
 
 def tax_level_selector(level):
 	if level == "species":
@@ -115,7 +309,12 @@ def tax_level_selector(level):
 def main(argv):
 	initialize(argv)
 	process_input()
-	process_domains_per_taxon()
-	write_to_file()
+	for level in TAXONOMY_LEVELS:
+		if MATRIX:
+			write_matrix(level, level_output_file(level))
+		else:
+			write_to_file(roll_up_statistics(level), level_output_file(level))
+	report_memory()
 
-main(sys.argv)
+if __name__ == "__main__":
+	main(sys.argv)
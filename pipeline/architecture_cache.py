@@ -0,0 +1,155 @@
+#Memoized domain architectures for obtain_and_process_tcs.py.
+#The same protein sequence (Aseq) is found in many genomes, in MiST and in MetaMiST alike, and different sequences often have
+#the same pfam31 hits. The gene-independent part of an output record (the architecture, the sensor or regulatory domains,
+#the domain counts and the unique domain names) is kept per Aseq id and per hit signature in a bounded LRU cache,
+#so the overlaps, holes and strings are computed once per distinct hit layout.
+#The cache can be saved to a file at the end of a run and loaded by the next one (e.g. a process pass over a raw store).
+#A saved cache carries the fingerprint of the code resolving and formatting the architectures, and is discarded by a run of other code.
+import collections
+import os
+import pickle
+import threading
+
+MAX_ENTRIES = 500000
+#Fields of a pfam31 hit the architecture depends on; the hits are kept in the server order, which decides ties of the sort
+HIT_FIELDS = ("name", "ali_from", "ali_to", "env_from", "env_to", "i_evalue")
+CACHE_FORMAT = 2
+
+#{Aseq id: architecture strings} and {hit signature: architecture strings}, least recently used first
+ASEQ_TO_STRINGS = collections.OrderedDict()
+SIGNATURE_TO_STRINGS = collections.OrderedDict()
+CACHE_LOCK = threading.Lock()
+STATISTICS = {"lookups": 0, "aseq_hits": 0, "signature_hits": 0, "evictions": 0}
+#Entries computed since the last takeNewEntries() call: [(Aseq id or None, signature, strings), ...]; collected only when enabled
+NEW_ENTRIES = []
+COLLECT_NEW_ENTRIES = False
+
+def configure(maxEntries=MAX_ENTRIES, collectNewEntries=False):
+	global MAX_ENTRIES, COLLECT_NEW_ENTRIES
+	MAX_ENTRIES = maxEntries
+	COLLECT_NEW_ENTRIES = collectNewEntries
+
+def hitSignature(hits):
+	return tuple(tuple(hit[field] for field in HIT_FIELDS) for hit in hits)
+
+#Returns (architecture strings or None, signature or None). The signature is computed only when the Aseq id is not known,
+#and is passed back to store() with the strings computed for a miss
+def lookup(aseqId, hits):
+	with CACHE_LOCK:
+		STATISTICS["lookups"]+=1
+		if aseqId is not None:
+			strings = ASEQ_TO_STRINGS.get(aseqId)
+			if strings is not None:
+				ASEQ_TO_STRINGS.move_to_end(aseqId)
+				STATISTICS["aseq_hits"]+=1
+				return strings, None
+	signature = hitSignature(hits)
+	with CACHE_LOCK:
+		strings = SIGNATURE_TO_STRINGS.get(signature)
+		if strings is None:
+			return None, signature
+		SIGNATURE_TO_STRINGS.move_to_end(signature)
+		STATISTICS["signature_hits"]+=1
+		if aseqId is not None:
+			putEntry(ASEQ_TO_STRINGS, aseqId, strings)
+	return strings, signature
+
+def store(aseqId, signature, strings):
+	with CACHE_LOCK:
+		putEntry(SIGNATURE_TO_STRINGS, signature, strings)
+		if aseqId is not None:
+			putEntry(ASEQ_TO_STRINGS, aseqId, strings)
+		if COLLECT_NEW_ENTRIES:
+			NEW_ENTRIES.append((aseqId, signature, strings))
+
+#Called with CACHE_LOCK held
+def putEntry(keyToStrings, key, strings):
+	keyToStrings[key] = strings
+	keyToStrings.move_to_end(key)
+	while len(keyToStrings) > MAX_ENTRIES:
+		keyToStrings.popitem(last=False)
+		STATISTICS["evictions"]+=1
+
+#Worker processes hand the entries they computed and their statistics over to the main process with these
+def takeNewEntries():
+	global NEW_ENTRIES
+	with CACHE_LOCK:
+		newEntries = NEW_ENTRIES
+		NEW_ENTRIES = []
+	return newEntries
+
+def addEntries(newEntries):
+	with CACHE_LOCK:
+		for aseqId, signature, strings in newEntries:
+			if signature not in SIGNATURE_TO_STRINGS:
+				putEntry(SIGNATURE_TO_STRINGS, signature, strings)
+			if aseqId is not None and aseqId not in ASEQ_TO_STRINGS:
+				putEntry(ASEQ_TO_STRINGS, aseqId, strings)
+
+def takeStatistics():
+	with CACHE_LOCK:
+		statistics = dict(STATISTICS)
+		for name in STATISTICS:
+			STATISTICS[name] = 0
+	return statistics
+
+def addStatistics(statistics):
+	with CACHE_LOCK:
+		for name, value in statistics.items():
+			STATISTICS[name]+=value
+
+def resetStatistics():
+	takeStatistics()
+
+def statisticsReport():
+	with CACHE_LOCK:
+		statistics = dict(STATISTICS)
+		entries = len(SIGNATURE_TO_STRINGS)
+	lookups = statistics["lookups"]
+	hits = statistics["aseq_hits"] + statistics["signature_hits"]
+	hitRate = 100.0*hits/lookups if lookups else 0.0
+	return "Architecture cache: {} lookups, {} hits ({:.1f}%: {} by Aseq id, {} by hit signature), {} distinct architectures, {} evictions".format(
+		lookups, hits, hitRate, statistics["aseq_hits"], statistics["signature_hits"], entries, statistics["evictions"])
+
+#(Aseq entries, signature entries), least recently used first
+def cacheEntries():
+	with CACHE_LOCK:
+		return list(ASEQ_TO_STRINGS.items()), list(SIGNATURE_TO_STRINGS.items())
+
+#Replaces the entries with those of cacheEntries(), e.g. of the main process in a worker process started without fork
+def setEntries(aseqEntries, signatureEntries):
+	with CACHE_LOCK:
+		ASEQ_TO_STRINGS.clear()
+		SIGNATURE_TO_STRINGS.clear()
+		for key, strings in signatureEntries:
+			putEntry(SIGNATURE_TO_STRINGS, key, strings)
+		for key, strings in aseqEntries:
+			putEntry(ASEQ_TO_STRINGS, key, strings)
+
+#A missing or unreadable file, or one saved with another fingerprint, leaves the cache empty;
+#the entries beyond MAX_ENTRIES are dropped, least recently used first
+def loadCache(path, fingerprint):
+	if not os.path.exists(path):
+		return False
+	try:
+		with open(path, "rb") as iFile:
+			cacheFormat, cacheFingerprint, aseqEntries, signatureEntries = pickle.load(iFile)
+	except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+		return False
+	if cacheFormat != CACHE_FORMAT or cacheFingerprint != fingerprint:
+		return False
+	with CACHE_LOCK:
+		for key, strings in signatureEntries:
+			putEntry(SIGNATURE_TO_STRINGS, key, strings)
+		for key, strings in aseqEntries:
+			putEntry(ASEQ_TO_STRINGS, key, strings)
+		STATISTICS["evictions"] = 0
+	return True
+
+#Written to a temporary file and renamed, so an interrupted run never leaves a truncated cache behind
+def saveCache(path, fingerprint):
+	aseqEntries, signatureEntries = cacheEntries()
+	temporaryFile = path + ".tmp"
+	with open(temporaryFile, "wb") as oFile:
+		pickle.dump((CACHE_FORMAT, fingerprint, aseqEntries, signatureEntries), oFile, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(temporaryFile, path)
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+import sys, getopt
+import os
+import json
+import time
+import tempfile
+import subprocess
+import urllib.request
+
+USAGE = "\nThe script measures the fetch throughput of obtain_and_process_tcs.py against a local MiST stand-in (mist_stub.py).\n" + \
+	"The stub is started with the given data and network settings, and obtain_and_process_tcs.py is run once per number of workers\n" + \
+	"on the same synthetic genomes. Reported per run: genomes per second, requests per genome, p50 and p99 of the request latency\n" + \
+	"and of the time to fetch a genome, the number of errors injected by the stub and of requests it turned away over its capacity.\n" + \
+	"Options after -- are passed to obtain_and_process_tcs.py (e.g. -- --host-connections 16 --backoff-base 0.1).\n\n" + \
+	"python " + sys.argv[0] + '''
+	-h || --help               - help
+	-n || --genomes            - number of synthetic genomes (default 50)
+	-w || --workers            - comma-separated numbers of workers to run obtain_and_process_tcs.py with (default 1,4,8)
+	-r || --repeat             - runs per number of workers; the best run is reported (default 1)
+	-o || --output             - also write the results as JSON lines to this file
+	--components               - range of the number of components per genome (default 1-4)
+	--genes                    - range of the number of histidine kinases and of response regulators per component (default 0-40)
+	--latency                  - seconds every response of the stub is delayed by (default 0.05)
+	--error-rate               - fraction of requests the stub answers with 503 (default 0)
+	--capacity                 - requests the stub serves at once; more are answered with 504 (default 0: no limit)
+	--distinct-aseqs           - number of distinct protein sequences per rank the genes are drawn from (default 0: one per gene)
+	--seed                     - seed of the synthetic data (default 1)
+'''
+
+#Variables controlled by the script parameters
+GENOMES = 50
+WORKERS = [1, 4, 8]
+REPEAT = 1
+OUTPUT_FILE = None
+STUB_OPTIONS = {"--components": "1-4", "--genes": "0-40", "--latency": "0.05", "--error-rate": "0", "--capacity": "0", "--distinct-aseqs": "0", "--seed": "1"}
+OBTAIN_OPTIONS = []
+
+#Variables set within the script
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+OBTAIN_SCRIPT = os.path.join(PIPELINE_DIR, "obtain_and_process_tcs.py")
+STUB_SCRIPT = os.path.join(PIPELINE_DIR, "mist_stub.py")
+#Timings collected by the measured run: seconds per request and per genome
+REQUEST_TIMES = []
+GENOME_TIMES = []
+REPORT_FIELDS = ["workers", "genomes", "seconds", "genomes_per_second", "requests_per_genome", "request_p50_ms", "request_p99_ms",
+	"genome_p50_s", "genome_p99_s", "stub_errors", "stub_overloaded"]
+
+def initialize(argv):
+	global GENOMES, WORKERS, REPEAT, OUTPUT_FILE, OBTAIN_OPTIONS
+	arguments = argv[1:]
+	if "--" in arguments:
+		OBTAIN_OPTIONS = arguments[arguments.index("--")+1:]
+		arguments = arguments[:arguments.index("--")]
+	try:
+		opts, args = getopt.getopt(arguments,"hn:w:r:o:",["help", "genomes=", "workers=", "repeat=", "output=", "components=", "genes=", "latency=", "error-rate=", "capacity=", "distinct-aseqs=", "seed="])
+	except getopt.GetoptError as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				print(USAGE)
+				sys.exit()
+			elif opt in ("-n", "--genomes"):
+				GENOMES = int(arg)
+			elif opt in ("-w", "--workers"):
+				WORKERS = [int(workers) for workers in str(arg).split(",")]
+			elif opt in ("-r", "--repeat"):
+				REPEAT = int(arg)
+			elif opt in ("-o", "--output"):
+				OUTPUT_FILE = str(arg).strip()
+			elif opt in STUB_OPTIONS:
+				STUB_OPTIONS[opt] = str(arg).strip()
+		if GENOMES < 1 or REPEAT < 1 or min(WORKERS) < 1:
+			raise ValueError("Numbers of genomes, runs and workers should be positive")
+	except Exception as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+
+#Nearest-rank percentile of a list of numbers
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values)-1, max(0, int(round(fraction*len(values) + 0.5)) - 1))]
+
+##*********************************************************************##
+##************************* Measured run block ************************##
+#Runs obtain_and_process_tcs.py in this process with timers around mist_client.fetchResponse and retrieveSignalGenesFromMist,
+#then saves the timings to metricsFile. Called as: benchmark_fetch.py --measure metricsFile <obtain_and_process_tcs.py options>
+def measure(metricsFile, obtainArguments):
+	#The log file of obtain_and_process_tcs.py goes next to the metrics instead of into the pipeline directory
+	sys.argv[0] = os.path.join(os.path.dirname(os.path.abspath(metricsFile)), "obtain_and_process_tcs.py")
+	sys.path.insert(0, PIPELINE_DIR)
+	import mist_client
+	import obtain_and_process_tcs
+	fetchResponse = mist_client.fetchResponse
+	retrieveSignalGenesFromMist = obtain_and_process_tcs.retrieveSignalGenesFromMist
+	def timedFetchResponse(url):
+		start = time.perf_counter()
+		try:
+			return fetchResponse(url)
+		finally:
+			REQUEST_TIMES.append(time.perf_counter() - start)
+	def timedRetrieveSignalGenes(genomeVersion):
+		start = time.perf_counter()
+		try:
+			return retrieveSignalGenesFromMist(genomeVersion)
+		finally:
+			GENOME_TIMES.append(time.perf_counter() - start)
+	mist_client.fetchResponse = timedFetchResponse
+	obtain_and_process_tcs.retrieveSignalGenesFromMist = timedRetrieveSignalGenes
+	start = time.perf_counter()
+	with open(os.devnull, "w") as devnull:
+		stdout = sys.stdout
+		sys.stdout = devnull
+		try:
+			obtain_and_process_tcs.main([sys.argv[0]] + obtainArguments)
+		finally:
+			sys.stdout = stdout
+	with open(metricsFile, "w") as oFile:
+		json.dump({"seconds": time.perf_counter() - start, "requests": REQUEST_TIMES, "genomes": GENOME_TIMES}, oFile)
+##*********************** Measured run block finish *******************##
+##*********************************************************************##
+
+def startStub():
+	command = [sys.executable, STUB_SCRIPT, "--port", "0"]
+	for option, value in STUB_OPTIONS.items():
+		command+= [option, value]
+	stub = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+	port = int(stub.stdout.readline())
+	return stub, "http://127.0.0.1:{}".format(port)
+
+def stubStatistics(stubUrl, path):
+	with urllib.request.urlopen(stubUrl + path) as response:
+		return json.loads(response.read().decode("utf-8"))
+
+def runOnce(workDir, stubUrl, workers, run):
+	prefix = os.path.join(workDir, "w{}_r{}".format(workers, run))
+	metricsFile = prefix + "_metrics.json"
+	stubStatistics(stubUrl, "/reset")
+	command = [sys.executable, os.path.abspath(__file__), "--measure", metricsFile, "-i", os.path.join(workDir, "genomes.tsv"),
+		"-f", prefix + "_HK.tsv", "-s", prefix + "_RR.tsv", "-d", "mist", "--api-url", stubUrl + "/v1/genomes/", "-w", str(workers), "--restart"] + OBTAIN_OPTIONS
+	subprocess.check_call(command, cwd=workDir)
+	with open(metricsFile) as iFile:
+		metrics = json.load(iFile)
+	statistics = stubStatistics(stubUrl, "/stats")
+	genomes = len(metrics["genomes"])
+	return {"workers": workers, "genomes": genomes, "seconds": round(metrics["seconds"], 3),
+		"genomes_per_second": round(genomes/metrics["seconds"], 2) if metrics["seconds"] else 0.0,
+		"requests_per_genome": round(len(metrics["requests"])/float(genomes), 2) if genomes else 0.0,
+		"request_p50_ms": round(1000*percentile(metrics["requests"], 0.50), 1), "request_p99_ms": round(1000*percentile(metrics["requests"], 0.99), 1),
+		"genome_p50_s": round(percentile(metrics["genomes"], 0.50), 3), "genome_p99_s": round(percentile(metrics["genomes"], 0.99), 3),
+		"stub_errors": statistics["errors"], "stub_overloaded": statistics["overloaded"]}
+
+def runBenchmark():
+	stub, stubUrl = startStub()
+	results = []
+	try:
+		with tempfile.TemporaryDirectory(prefix="benchmark_fetch_") as workDir:
+			with open(os.path.join(workDir, "genomes.tsv"), "w") as genomesFile:
+				for number in range(1, GENOMES+1):
+					genomesFile.write("\t".join(["benchmark", "SYN_{:06d}.1".format(number), "synthetic"]) + "\n")
+			print("\t".join(REPORT_FIELDS))
+			for workers in WORKERS:
+				runs = [runOnce(workDir, stubUrl, workers, run) for run in range(REPEAT)]
+				best = min(runs, key=lambda result: result["seconds"])
+				results.append(best)
+				print("\t".join(str(best[field]) for field in REPORT_FIELDS), flush=True)
+	finally:
+		stub.terminate()
+		stub.wait()
+	if OUTPUT_FILE:
+		with open(OUTPUT_FILE, "a") as oFile:
+			for result in results:
+				result["stub"] = STUB_OPTIONS
+				result["obtain_options"] = OBTAIN_OPTIONS
+				oFile.write(json.dumps(result) + "\n")
+
+def main(argv):
+	if len(argv) > 2 and argv[1] == "--measure":
+		measure(argv[2], argv[3:])
+		return
+	initialize(argv)
+	runBenchmark()
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,199 @@
+#Per-genome index of the histidine kinase and response regulator output files of obtain_and_process_tcs.py, used by tcs_coverage.py.
+#For every genome the index keeps the number of its rows in each file and the byte range holding them, so coverage reports
+#need no pass over the outputs and the rows of a genome are read with one seek.
+#The index is built in one streaming pass over the two files (tcs_coverage.py index) or written alongside them during the fetch
+#(obtain_and_process_tcs.py --coverage-index); the journal of the run adds the genomes fetched without any rows.
+#The index is a tabulated file:
+#  #file	HK	<histidine kinases file, relative to the index>
+#  #file	RR	<response regulators file, relative to the index>
+#  Genome_id	HK_rows	HK_offset	HK_bytes	RR_rows	RR_offset	RR_bytes
+#  <one line per genome>
+#In a gzip-compressed output the byte range starts and ends at gzip member boundaries and may hold rows of other genomes too.
+import collections
+import os
+import zlib
+import gzip
+import tsv_files
+
+PROTEIN_KEYS = ["HK", "RR"]
+INDEX_HEADER = ["Genome_id", "HK_rows", "HK_offset", "HK_bytes", "RR_rows", "RR_offset", "RR_bytes"]
+FILE_PREFIX = "#file"
+JOURNAL_START = "#start"
+OUTPUT_HEADER_START = b"Genome_id\t"
+READ_BLOCK_SIZE = 1024*1024
+
+def indexFileFor(hkFile):
+	return hkFile + ".coverage.tsv"
+
+#{genome version: [HK rows, HK offset, HK bytes, RR rows, RR offset, RR bytes]}
+def newEntry():
+	return [0, 0, 0, 0, 0, 0]
+
+##*********************************************************************##
+##***************************** Scanning block ************************##
+#Yields (line, start, end key) of a plain file; the end key is the offset after the line
+def plainLines(path):
+	with open(path, "rb") as iFile:
+		position = 0
+		for line in iFile:
+			yield line, position, position + len(line)
+			position+=len(line)
+
+#Yields (line, start of its gzip member, end key) of a gzip file; the end key is the start of the member, whose end offset
+#is stored in memberEnds once the member is read. A line belongs to the member it starts in
+def gzipLines(path, memberEnds):
+	with open(path, "rb") as iFile:
+		decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		memberStart = position = 0
+		pending, pendingMember = b"", 0
+		data = iFile.read(READ_BLOCK_SIZE)
+		while data:
+			if not pending:
+				pendingMember = memberStart
+			lines = (pending + decompressor.decompress(data)).split(b"\n")
+			pending = lines.pop()
+			for line in lines:
+				yield line + b"\n", pendingMember, pendingMember
+				pendingMember = memberStart
+			if decompressor.eof:
+				memberEnd = position + len(data) - len(decompressor.unused_data)
+				memberEnds[memberStart] = memberEnd
+				data, position, memberStart = decompressor.unused_data, memberEnd, memberEnd
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+				if not data:
+					data = iFile.read(READ_BLOCK_SIZE)
+			else:
+				position+=len(data)
+				data = iFile.read(READ_BLOCK_SIZE)
+		if pending:
+			yield pending, pendingMember, pendingMember
+
+#Returns ({genome version: [rows, offset, bytes]} in the order of the file, [genomes whose rows are not consecutive]).
+#The byte range of a genome with rows in several places covers the first of them only
+def scanFile(path):
+	memberEnds = {}
+	lines = gzipLines(path, memberEnds) if tsv_files.isGzipFile(path) else plainLines(path)
+	genomeToRange = collections.OrderedDict()
+	splitGenomes = []
+	currentGenome, currentRange, extendRange = None, None, False
+	for line, start, endKey in lines:
+		if line.startswith(OUTPUT_HEADER_START) or not line.strip():
+			continue
+		genomeVersion = line.split(b"\t", 1)[0].decode("utf-8")
+		if genomeVersion != currentGenome:
+			currentGenome = genomeVersion
+			currentRange = genomeToRange.get(genomeVersion)
+			extendRange = currentRange is None
+			if extendRange:
+				currentRange = genomeToRange[genomeVersion] = [0, start, endKey]
+			else:
+				splitGenomes.append(genomeVersion)
+		currentRange[0]+=1
+		if extendRange:
+			currentRange[2] = endKey
+	for genomeRange in genomeToRange.values():
+		genomeRange[2] = memberEnds.get(genomeRange[2], genomeRange[2]) - genomeRange[1]
+	return genomeToRange, splitGenomes
+
+#Genomes recorded in a journal of obtain_and_process_tcs.py, in the order they were completed
+def journalGenomes(journalFile):
+	with open(journalFile, "r") as journal:
+		return [line.split("\t", 1)[0] for line in journal if line.endswith("\n") and not line.startswith(JOURNAL_START)]
+
+#Returns ({genome version: entry}, [genomes whose rows are not consecutive in one of the files])
+def buildIndex(hkFile, rrFile, journalFile=None):
+	genomeToEntry = collections.OrderedDict()
+	splitGenomes = []
+	for position, path in enumerate([hkFile, rrFile]):
+		genomeToRange, fileSplitGenomes = scanFile(path)
+		splitGenomes.extend(fileSplitGenomes)
+		for genomeVersion, genomeRange in genomeToRange.items():
+			genomeToEntry.setdefault(genomeVersion, newEntry())[3*position:3*position+3] = genomeRange
+	if journalFile:
+		for genomeVersion in journalGenomes(journalFile):
+			genomeToEntry.setdefault(genomeVersion, newEntry())
+	return genomeToEntry, splitGenomes
+##************************** Scanning block finish ********************##
+##*********************************************************************##
+
+##*********************************************************************##
+##*************************** Index file block ************************##
+def headerLines(indexFile, hkFile, rrFile):
+	indexDir = os.path.dirname(os.path.abspath(indexFile))
+	lines = ["\t".join([FILE_PREFIX, key, os.path.relpath(os.path.abspath(path), indexDir)]) + "\n" for key, path in zip(PROTEIN_KEYS, [hkFile, rrFile])]
+	return lines + ["\t".join(INDEX_HEADER) + "\n"]
+
+def entryLine(genomeVersion, entry):
+	return "\t".join([genomeVersion] + [str(value) for value in entry]) + "\n"
+
+#Written to a temporary file and renamed, so an interrupted run never leaves a truncated index behind
+def writeIndex(indexFile, hkFile, rrFile, genomeToEntry):
+	temporaryFile = indexFile + ".tmp"
+	with open(temporaryFile, "w") as oFile:
+		oFile.writelines(headerLines(indexFile, hkFile, rrFile))
+		for genomeVersion, entry in genomeToEntry.items():
+			oFile.write(entryLine(genomeVersion, entry))
+	os.replace(temporaryFile, indexFile)
+
+#Returns ({"HK": path, "RR": path}, {genome version: entry}); a line cut short by an interrupted run is ignored
+def loadIndex(indexFile):
+	keyToFile = {}
+	genomeToEntry = collections.OrderedDict()
+	indexDir = os.path.dirname(os.path.abspath(indexFile))
+	with open(indexFile, "r") as iFile:
+		for line in iFile:
+			if not line.endswith("\n"):
+				break
+			record = line.rstrip("\n").split("\t")
+			if record[0] == FILE_PREFIX:
+				keyToFile[record[1]] = os.path.normpath(os.path.join(indexDir, record[2]))
+			elif record[0] != INDEX_HEADER[0] and len(record) == len(INDEX_HEADER):
+				genomeToEntry[record[0]] = [int(value) for value in record[1:]]
+	if sorted(keyToFile) != PROTEIN_KEYS:
+		raise ValueError(indexFile + " is not a coverage index of histidine kinase and response regulator files")
+	return keyToFile, genomeToEntry
+
+#Bytes of the files written after the last indexed genome: {"HK": bytes, "RR": bytes}
+def uncoveredBytes(keyToFile, genomeToEntry):
+	keyToBytes = {}
+	for position, key in enumerate(PROTEIN_KEYS):
+		covered = max([entry[3*position+1] + entry[3*position+2] for entry in genomeToEntry.values()] or [0])
+		keyToBytes[key] = max(0, os.path.getsize(keyToFile[key]) - covered) if covered else 0
+	return keyToBytes
+
+#Returns the rows of a genome in the file of the key ("HK" or "RR"), read from the byte range of the index
+def genomeRows(keyToFile, genomeToEntry, genomeVersion, key):
+	position = PROTEIN_KEYS.index(key)
+	rows, offset, length = genomeToEntry[genomeVersion][3*position:3*position+3]
+	if not rows:
+		return []
+	path = keyToFile[key]
+	with open(path, "rb") as iFile:
+		iFile.seek(offset)
+		data = iFile.read(length)
+	if tsv_files.isGzipFile(path):
+		data = gzip.decompress(data)
+	prefix = genomeVersion + "\t"
+	return [line + "\n" for line in data.decode("utf-8").split("\n") if line.startswith(prefix)]
+##************************ Index file block finish ********************##
+##*********************************************************************##
+
+##*********************************************************************##
+##**************************** Sidecar block **************************##
+#Used by obtain_and_process_tcs.py: the index is appended to while the genomes are committed to the output files
+def openSidecar(indexFile, hkFile, rrFile, resume, journalFile=None):
+	if resume:
+		#The rows already written are indexed anew, which also drops the entries of an interrupted genome
+		genomeToEntry, splitGenomes = buildIndex(hkFile, rrFile, journalFile if journalFile and os.path.exists(journalFile) else None)
+		writeIndex(indexFile, hkFile, rrFile, genomeToEntry)
+		return open(indexFile, "a")
+	sidecar = open(indexFile, "w")
+	sidecar.writelines(headerLines(indexFile, hkFile, rrFile))
+	sidecar.flush()
+	return sidecar
+
+def appendEntry(sidecar, genomeVersion, entry):
+	sidecar.write(entryLine(genomeVersion, entry))
+	sidecar.flush()
+##************************* Sidecar block finish **********************##
+##*********************************************************************##
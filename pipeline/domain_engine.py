@@ -0,0 +1,91 @@
+#Batch resolution of domain architectures used by obtain_and_process_tcs.py.
+#The pfam31 hits of many genes are resolved by position in their sorted hit lists: overlaps, holes and the inferred <HisKA> domain
+#are computed without a list.index call per domain, without list.remove and without allocating a dictionary per hole or domain.
+#The rules are the ones of removeOverlapps, processHoles, HisKAprocessing and checkAndAddHolesAndDomains in obtain_and_process_tcs.py,
+#and the result is the same architecture; run obtain_and_process_tcs.py with --verify-domains to compare both on real data.
+
+HIS_KINASE_DIM_DOMAINS = frozenset(["HisKA", "HisKA_2", "HisKA_3", "H-kinase_dim", "His_kinase"])
+HIS_KINASE_CATAL_DOMAINS = frozenset(["HATPase_c", "HATPase_c_2", "HATPase_c_5", "HWE_HK"])
+
+OVERLAP_TOLERANCE = 10
+MIN_DOMAIN_LENGTH = 100
+MIN_LENGTH_FOR_HISKA = 150
+
+def aliFromKey(hit):
+	return hit["ali_from"]
+
+#Takes a list of pfam31 hit lists, one per gene, and returns for every gene its architecture as a list of (name, env_from, env_to),
+#holes included. A gene without hits gets an empty list.
+def resolveDomainsBatch(hitLists):
+	architectures = []
+	for hitList in hitLists:
+		if hitList:
+			#sorted() is stable, as the sort of prepareDomains, so hits starting at the same position keep the server order
+			hits = sorted(hitList, key=aliFromKey)
+			architectures.append(resolveHoles(removeOverlapps(hits)))
+		else:
+			architectures.append([])
+	return architectures
+
+#Returns the hits kept. The hit kept last is always the one compared with the next hit,
+#so a more significant overlapping hit simply takes the last place.
+def removeOverlapps(hits):
+	pfam1 = hits[0]
+	kept = [pfam1]
+	for pfam2 in hits[1:]:
+		if pfam1["ali_to"] - pfam2["ali_from"] > OVERLAP_TOLERANCE:
+			eval1 = pfam1["i_evalue"]
+			eval2 = pfam2["i_evalue"]
+			if eval1 > eval2 or (eval1 == eval2 and (pfam1["ali_to"] - pfam1["ali_from"]) < (pfam2["ali_to"] - pfam2["ali_from"])):
+				pfam1 = pfam2
+				kept[-1] = pfam1
+		else:
+			kept.append(pfam2)
+			pfam1 = pfam2
+	return kept
+
+def resolveHoles(kept):
+	#processHoles keeps the position of the last dimerization and the last catalytic domain, located with list.index,
+	#i.e. at the first hit equal to it; only these two are looked up here
+	lastHisKA = None
+	lastHATPase = None
+	for hit in kept:
+		name = hit["name"]
+		if name in HIS_KINASE_DIM_DOMAINS:
+			lastHisKA = hit
+		elif name in HIS_KINASE_CATAL_DOMAINS:
+			lastHATPase = hit
+
+	architecture = []
+	hatpasePos = kept.index(lastHATPase) if lastHATPase is not None else -1
+	if hatpasePos > 0 and lastHisKA is None:
+		addHolesAndDomains(kept[:hatpasePos], architecture, 1)
+		addHisKA(kept[hatpasePos], kept[hatpasePos-1], architecture)
+		if kept[hatpasePos+1:]:
+			addHolesAndDomains(kept[hatpasePos+1:], architecture, kept[hatpasePos]["env_to"])
+	else:
+		addHolesAndDomains(kept, architecture, 1)
+	return architecture
+
+def addHolesAndDomains(kept, architecture, coord):
+	append = architecture.append
+	previous = kept[0]
+	envFrom = previous["env_from"]
+	if envFrom > MIN_DOMAIN_LENGTH:
+		append(("hole", coord, envFrom-1))
+	previousEnvTo = previous["env_to"]
+	append((previous["name"], envFrom, previousEnvTo))
+	for hit in kept[1:]:
+		envFrom = hit["env_from"]
+		if (envFrom - previousEnvTo) >= MIN_DOMAIN_LENGTH:
+			append(("hole", previousEnvTo+1, envFrom-1))
+		previousEnvTo = hit["env_to"]
+		append((hit["name"], envFrom, previousEnvTo))
+
+def addHisKA(ultimate, penultimate, architecture):
+	HisKAspace = ultimate["env_from"] - penultimate["env_to"]
+	holeEnd = penultimate["env_to"] + (HisKAspace - MIN_LENGTH_FOR_HISKA)
+	if HisKAspace >= (MIN_LENGTH_FOR_HISKA + MIN_DOMAIN_LENGTH):
+		architecture.append(("hole", penultimate["env_to"]+1, holeEnd))
+	architecture.append(("<HisKA>", holeEnd+1, ultimate["env_from"]-1))
+	architecture.append((ultimate["name"], ultimate["env_from"], ultimate["env_to"]))
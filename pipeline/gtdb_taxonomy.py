@@ -0,0 +1,80 @@
+#Index of the GTDB taxonomy (accession -> lineage) used by analyze_tcs_per_taxon.py.
+#The taxonomy is read directly from the GTDB zip archive (a plain or gzip-compressed TSV works too). The index is built once
+#and pickled next to the taxonomy file under a name containing the SHA-256 of that file, so later runs load it instead of
+#parsing the taxonomy, and a new GTDB release gets its own index.
+#Every lineage is stored once and shared by all its genomes, which keeps the index small in memory and on disk.
+import hashlib
+import io
+import os
+import pickle
+import zipfile
+import tsv_files
+
+INDEX_VERSION = 1
+INDEX_FILE_TEMPLATE = "{}.{}.index.pickle"
+HASH_BLOCK_SIZE = 1024*1024
+
+#GTDB accessions carry the source database prefix (RS_GCF_000979555.1, GB_GCA_001315865.1); the genome versions do not
+def genomeVersion(accession):
+	return accession.split("_", 1)[1]
+
+def sourceHash(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as iFile:
+		for block in iter(lambda: iFile.read(HASH_BLOCK_SIZE), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+def indexFile(path, indexDir=None, hashValue=None):
+	hashValue = hashValue or sourceHash(path)
+	indexDir = indexDir or os.path.dirname(os.path.abspath(path))
+	return os.path.join(indexDir, INDEX_FILE_TEMPLATE.format(os.path.basename(path), hashValue[:16]))
+
+#Opens the taxonomy as text: the first .tsv member of a zip archive is streamed without extracting it
+def openTaxonomy(path):
+	if zipfile.is_zipfile(path):
+		archive = zipfile.ZipFile(path)
+		members = [name for name in archive.namelist() if name.endswith(".tsv")] or archive.namelist()
+		return io.TextIOWrapper(archive.open(members[0]), encoding="utf-8")
+	return tsv_files.openTsv(path)
+
+#Returns {genome version: lineage}, the lineage being the full "d__...;p__...;...;s__..." string
+def buildIndex(path):
+	genomeToLineage = {}
+	lineages = {}
+	with openTaxonomy(path) as taxonomy:
+		for line in taxonomy:
+			record = line.rstrip("\n").split("\t")
+			if len(record) < 2:
+				continue
+			lineage = lineages.setdefault(record[1], record[1])
+			genomeToLineage[genomeVersion(record[0])] = lineage
+	return genomeToLineage
+
+#Loads the index of the taxonomy file, building and saving it when it does not exist yet
+def loadIndex(path, indexDir=None):
+	hashValue = sourceHash(path)
+	cacheFile = indexFile(path, indexDir, hashValue)
+	if os.path.exists(cacheFile):
+		try:
+			with open(cacheFile, "rb") as iFile:
+				version, indexHash, genomeToLineage = pickle.load(iFile)
+			if version == INDEX_VERSION and indexHash == hashValue:
+				return genomeToLineage
+		except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+			pass
+	genomeToLineage = buildIndex(path)
+	saveIndex(cacheFile, hashValue, genomeToLineage)
+	return genomeToLineage
+
+def saveIndex(cacheFile, hashValue, genomeToLineage):
+	#Written under a temporary name first, so a concurrent run never reads a partially written index
+	temporaryFile = cacheFile + "." + str(os.getpid())
+	try:
+		with open(temporaryFile, "wb") as oFile:
+			pickle.dump((INDEX_VERSION, hashValue, genomeToLineage), oFile, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(temporaryFile, cacheFile)
+	except OSError:
+		#The index is only an optimization; a read-only taxonomy directory just means it is built on every run
+		if os.path.exists(temporaryFile):
+			os.remove(temporaryFile)
@@ -0,0 +1,170 @@
+#Keep-alive HTTP client for the MiST and MetaMiST APIs used by obtain_and_process_tcs.py.
+#Connections are pooled per host and reused across requests, so a run does not pay a TCP and TLS handshake for every page.
+#Responses are requested gzip-compressed and decompressed while they are read.
+#Non-200 responses are raised as urllib.error.HTTPError, the same way urllib.request.urlopen reports them.
+#The requests in flight and the request rate of every host are controlled by rate_control.py (AIMD concurrency up to
+#HOST_CONNECTIONS, an optional token bucket and a circuit breaker).
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+import rate_control
+
+HOST_CONNECTIONS = 8
+REQUEST_TIMEOUT = 120
+READ_CHUNK_SIZE = 64*1024
+REQUEST_HEADERS = {"Accept": "application/json", "Accept-Encoding": "gzip", "Connection": "keep-alive", "User-Agent": "signal-transduction"}
+
+#{(scheme, host): [idle connection, ...]}
+HOST_TO_IDLE_CONNECTIONS = {}
+#Statuses telling that the server is overloaded or down; they make rate_control.py slow the requests to the host down
+OVERLOAD_STATUSES = frozenset([429, 500, 502, 503, 504])
+POOL_LOCK = threading.Lock()
+#Raised instead of sending a request to a host that is taken as down by its circuit breaker
+HostUnavailableError = rate_control.HostUnavailableError
+STATISTICS = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "bytes_received": 0, "bytes_decoded": 0}
+STATISTICS_LOCK = threading.Lock()
+
+def configure(hostConnections=HOST_CONNECTIONS, requestTimeout=REQUEST_TIMEOUT, maxRate=None, breakerPause=rate_control.BREAKER_PAUSE, maxFailedProbes=None):
+	global HOST_CONNECTIONS, REQUEST_TIMEOUT
+	HOST_CONNECTIONS = hostConnections
+	REQUEST_TIMEOUT = requestTimeout
+	rate_control.configure(hostConnections, maxRate, breakerPause, maxFailedProbes)
+
+#Returns (the decoded body of a 200 response as bytes, the response headers)
+def fetchResponse(url):
+	parsedUrl = urllib.parse.urlsplit(url)
+	hostKey = (parsedUrl.scheme, parsedUrl.netloc)
+	path = parsedUrl.path + ("?" + parsedUrl.query if parsedUrl.query else "")
+	controllerKey = controllerHost(hostKey)
+	rate_control.acquire(controllerKey)
+	outcome = "error"
+	latency = None
+	try:
+		start = time.monotonic()
+		connection, reused = acquireConnection(hostKey)
+		try:
+			response = sendRequest(connection, path)
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+			connection.close()
+			#The server may have closed an idle keep-alive connection; such a request is repeated once on a new connection
+			if not reused:
+				raise
+			start = time.monotonic()
+			connection, reused = acquireConnection(hostKey, False)
+			try:
+				response = sendRequest(connection, path)
+			except Exception:
+				connection.close()
+				raise
+		except Exception:
+			connection.close()
+			raise
+		latency = time.monotonic() - start
+		try:
+			body = readBody(response)
+		except Exception:
+			connection.close()
+			raise
+		if response.will_close:
+			connection.close()
+		else:
+			releaseConnection(hostKey, connection)
+		if response.status in OVERLOAD_STATUSES:
+			outcome = "overload"
+		elif response.status < 400:
+			outcome = "ok"
+	except (OSError, http.client.HTTPException):
+		#Timeouts, refused and dropped connections
+		outcome = "overload"
+		raise
+	finally:
+		rate_control.release(controllerKey, outcome, latency)
+	addStatistic("requests", 1)
+	addStatistic("connections_reused" if reused else "connections_opened", 1)
+	if response.status != 200:
+		raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+	return body, response.headers
+
+def sendRequest(connection, path):
+	connection.request("GET", path, headers=REQUEST_HEADERS)
+	return connection.getresponse()
+
+#Reads the response in chunks, decompressing a gzip-encoded body on the fly.
+#A corrupt gzip body is raised as an HTTPException, so it is retried like a dropped connection
+def readBody(response):
+	decompressor = None
+	if response.getheader("Content-Encoding", "").lower() == "gzip":
+		decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	chunks = []
+	received = 0
+	try:
+		while True:
+			chunk = response.read(READ_CHUNK_SIZE)
+			if not chunk:
+				break
+			received+=len(chunk)
+			chunks.append(decompressor.decompress(chunk) if decompressor else chunk)
+		if decompressor:
+			chunks.append(decompressor.flush())
+	except zlib.error as e:
+		raise http.client.HTTPException("Corrupt gzip response body: " + str(e))
+	body = b"".join(chunks)
+	addStatistic("bytes_received", received)
+	addStatistic("bytes_decoded", len(body))
+	return body
+
+#Every database URL has a host of its own, so the controllers of rate_control.py are kept per host
+def controllerHost(hostKey):
+	return hostKey[0] + "://" + hostKey[1]
+
+#Seconds the circuit breaker of the host of the url keeps the requests paused, 0 when they are not paused
+def pauseRemaining(url):
+	parsedUrl = urllib.parse.urlsplit(url)
+	return rate_control.pauseRemaining(controllerHost((parsedUrl.scheme, parsedUrl.netloc)))
+
+#Returns (connection, True if it is a reused one)
+def acquireConnection(hostKey, reuse=True):
+	with POOL_LOCK:
+		idleConnections = HOST_TO_IDLE_CONNECTIONS.setdefault(hostKey, [])
+		if reuse and idleConnections:
+			return idleConnections.pop(), True
+	scheme, host = hostKey
+	if scheme == "https":
+		return http.client.HTTPSConnection(host, timeout=REQUEST_TIMEOUT), False
+	return http.client.HTTPConnection(host, timeout=REQUEST_TIMEOUT), False
+
+def releaseConnection(hostKey, connection):
+	with POOL_LOCK:
+		HOST_TO_IDLE_CONNECTIONS.setdefault(hostKey, []).append(connection)
+
+def closeConnections():
+	with POOL_LOCK:
+		for idleConnections in HOST_TO_IDLE_CONNECTIONS.values():
+			for connection in idleConnections:
+				connection.close()
+		HOST_TO_IDLE_CONNECTIONS.clear()
+
+def addStatistic(name, value):
+	with STATISTICS_LOCK:
+		STATISTICS[name]+=value
+
+def resetStatistics():
+	with STATISTICS_LOCK:
+		for name in STATISTICS:
+			STATISTICS[name] = 0
+
+def statisticsReport():
+	with STATISTICS_LOCK:
+		statistics = dict(STATISTICS)
+	requests = statistics["requests"]
+	reuseRate = 100.0*statistics["connections_reused"]/requests if requests else 0.0
+	compression = 100.0*statistics["bytes_received"]/statistics["bytes_decoded"] if statistics["bytes_decoded"] else 100.0
+	report = "HTTP requests: {}, connections opened: {}, reused: {} ({:.1f}%), received {} bytes for {} decoded bytes ({:.1f}%)".format(
+		requests, statistics["connections_opened"], statistics["connections_reused"], reuseRate,
+		statistics["bytes_received"], statistics["bytes_decoded"], compression)
+	controllerReport = rate_control.statisticsReport()
+	return report + "\n" + controllerReport if controllerReport else report
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+import sys, getopt
+import json
+import gzip
+import random
+import re
+import threading
+import time
+import urllib.parse
+import http.server
+
+USAGE = "\nThe script serves a local stand-in of the MiST genomes API for measuring obtain_and_process_tcs.py without the MiST server.\n" + \
+	"It answers /v1/genomes/{genome}/stp-matrix and /v1/genomes/{genome}/signal-genes with the pagination of the real API:\n" + \
+	"pages of at most 100 items and an empty page (no components, or an empty list) after the last one.\n" + \
+	"Every genome version is served: its components and genes are synthetic and generated from the version and the seed,\n" + \
+	"so a genome gets the same data in every run. Point obtain_and_process_tcs.py at it with --api-url http://127.0.0.1:PORT/v1/genomes/\n" + \
+	"GET /stats returns the numbers of requests and of injected errors, GET /reset sets them to zero,\n" + \
+	"GET /outage?seconds=N answers every request with 503 for the next N seconds.\n\n" + \
+	"python " + sys.argv[0] + '''
+	-h || --help               - help
+	-p || --port               - port to listen on (default 8765; 0 picks a free port). The port is printed on the first line of the output
+	--components               - range of the number of components per genome (default 1-4)
+	--genes                    - range of the number of histidine kinases and of response regulators per component (default 0-40);
+	                             hybrid ones are added with a tenth of it. 100 genes make one page.
+	--latency                  - seconds every response is delayed by (default 0)
+	--error-rate               - fraction of requests answered with 503 Service Unavailable (default 0)
+	--retry-after              - Retry-After value in seconds sent with the 503 responses (default: none)
+	--capacity                 - requests served at once; a request arriving when this many are in flight is answered
+	                             with 504 Gateway Timeout, as the MiST gateways do under load (default 0: no limit)
+	--distinct-aseqs           - number of distinct protein sequences (Aseqs) per rank the genes are drawn from, so that
+	                             the same sequence occurs in many genomes as in MiST (default 0: every gene has a sequence of its own)
+	--seed                     - seed of the synthetic data and of the errors (default 1)
+'''
+
+#Variables controlled by the script parameters
+PORT = 8765
+COMPONENTS = (1, 4)
+GENES = (0, 40)
+LATENCY = 0.0
+ERROR_RATE = 0.0
+RETRY_AFTER = None
+CAPACITY = 0
+DISTINCT_ASEQS = 0
+SEED = 1
+
+#Variables set within the script
+MAX_PER_PAGE = 100
+DOMAIN_NAMES = ["PAS", "PAS_3", "PAS_4", "GAF", "HAMP", "dCache_1", "Cache_3", "MCPsignal", "GGDEF", "Trans_reg_C", "HTH_8", "CheW"]
+RANK_TO_CORE_DOMAINS = {"hk": ["HisKA", "HATPase_c"], "hhk": ["HisKA", "HATPase_c", "Response_reg"], "rr": ["Response_reg"], "hrr": ["Response_reg", "HisKA"]}
+GENOME_PATH = re.compile(r"^/v1/genomes/([^/]+)/(stp-matrix|signal-genes)$")
+#{genome version: (components, {component id: [gene, ...]})}
+GENOME_TO_DATA = {}
+GENOME_LOCK = threading.Lock()
+STATISTICS = {"requests": 0, "errors": 0, "overloaded": 0, "outage": 0}
+STATISTICS_LOCK = threading.Lock()
+IN_FLIGHT = 0
+OUTAGE_UNTIL = 0.0
+ERROR_RANDOM = random.Random(SEED)
+
+def initialize(argv):
+	global PORT, COMPONENTS, GENES, LATENCY, ERROR_RATE, RETRY_AFTER, CAPACITY, DISTINCT_ASEQS, SEED, ERROR_RANDOM
+	try:
+		opts, args = getopt.getopt(argv[1:],"hp:",["help", "port=", "components=", "genes=", "latency=", "error-rate=", "retry-after=", "capacity=", "distinct-aseqs=", "seed="])
+	except getopt.GetoptError as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				print(USAGE)
+				sys.exit()
+			elif opt in ("-p", "--port"):
+				PORT = int(arg)
+			elif opt == "--components":
+				COMPONENTS = parseRange(arg)
+			elif opt == "--genes":
+				GENES = parseRange(arg)
+			elif opt == "--latency":
+				LATENCY = float(arg)
+			elif opt == "--error-rate":
+				ERROR_RATE = float(arg)
+				if not 0 <= ERROR_RATE < 1:
+					raise ValueError("--error-rate should be at least 0 and below 1")
+			elif opt == "--retry-after":
+				RETRY_AFTER = str(int(arg))
+			elif opt == "--capacity":
+				CAPACITY = int(arg)
+			elif opt == "--distinct-aseqs":
+				DISTINCT_ASEQS = int(arg)
+			elif opt == "--seed":
+				SEED = int(arg)
+		ERROR_RANDOM = random.Random(SEED)
+	except Exception as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+
+#"1-4" -> (1, 4), "3" -> (3, 3)
+def parseRange(value):
+	bounds = [int(bound) for bound in str(value).split("-")]
+	if len(bounds) == 1:
+		bounds = bounds * 2
+	if len(bounds) != 2 or bounds[0] < 0 or bounds[0] > bounds[1]:
+		raise ValueError("A range should look like 1-4: " + str(value))
+	return tuple(bounds)
+
+##*********************************************************************##
+##************************* Synthetic data block **********************##
+def genomeData(genomeVersion):
+	with GENOME_LOCK:
+		if genomeVersion not in GENOME_TO_DATA:
+			GENOME_TO_DATA[genomeVersion] = synthesizeGenome(genomeVersion)
+		return GENOME_TO_DATA[genomeVersion]
+
+#The components as the stp-matrix lists them and the two-component genes of every component
+def synthesizeGenome(genomeVersion):
+	generator = random.Random(str(SEED) + ":" + genomeVersion)
+	genomeNumber = generator.randint(1, 10**6)
+	components = []
+	componentToGenes = {}
+	for componentNumber in range(generator.randint(*COMPONENTS)):
+		componentId = genomeNumber*100 + componentNumber
+		rankToCount = {}
+		for rank in ("hk", "rr"):
+			rankToCount[rank] = generator.randint(*GENES)
+		for rank in ("hhk", "hrr"):
+			rankToCount[rank] = generator.randint(GENES[0]//10, GENES[1]//10)
+		genes = []
+		for rank in ("hk", "hhk", "rr", "hrr"):
+			for geneNumber in range(rankToCount[rank]):
+				genes.append(synthesizeGene(generator, genomeVersion, componentId, rank, len(genes)))
+		#Genes are listed in their order on the component, i.e. the ranks are mixed
+		generator.shuffle(genes)
+		componentToGenes[componentId] = genes
+		tcpCounts = {rank: count for rank, count in rankToCount.items() if count}
+		components.append({"id": componentId, "counts": {"tcp": tcpCounts} if tcpCounts else {}})
+	return components, componentToGenes
+
+def synthesizeGene(generator, genomeVersion, componentId, rank, geneNumber):
+	locus = "{}-{}_{}".format(genomeVersion, componentId, geneNumber)
+	if DISTINCT_ASEQS:
+		#The sequence is one of the pool of the rank, generated from its number alone
+		aseqNumber = generator.randrange(DISTINCT_ASEQS)
+		aseqId = "{}_{}".format(rank, aseqNumber)
+		domains, length = synthesizeAseq(random.Random("{}:aseq:{}".format(SEED, aseqId)), rank)
+	else:
+		aseqId = locus
+		domains, length = synthesizeAseq(generator, rank)
+	return {"id": componentId*10000 + geneNumber, "component_id": componentId, "ranks": ["tcp", rank],
+		"Gene": {"version": "SYN_" + locus + ".1", "stable_id": locus, "length": length, "aseq_id": aseqId, "Aseq": {"pfam31": domains}}}
+
+#Returns (pfam31 hits, gene length)
+def synthesizeAseq(generator, rank):
+	domainNames = [generator.choice(DOMAIN_NAMES) for sensor in range(generator.randint(0, 4))] + RANK_TO_CORE_DOMAINS[rank]
+	domains = []
+	position = generator.randint(1, 150)
+	for name in domainNames:
+		length = generator.randint(40, 160)
+		domains.append({"name": name, "ali_from": position, "ali_to": position+length, "env_from": max(1, position-3), "env_to": position+length+3,
+			"i_evalue": generator.choice([1e-30, 1e-12, 1e-6, 1e-3])})
+		#Domains overlap now and then, and leave holes now and then
+		position+= length + generator.randint(-20, 180)
+	generator.shuffle(domains)
+	return domains, position + generator.randint(0, 200)
+##*********************** Synthetic data block finish *****************##
+##*********************************************************************##
+
+def addStatistic(name):
+	with STATISTICS_LOCK:
+		STATISTICS[name]+=1
+
+def injectError():
+	with STATISTICS_LOCK:
+		return ERROR_RANDOM.random() < ERROR_RATE
+
+#Returns False when CAPACITY requests are in flight already
+def enterRequest():
+	global IN_FLIGHT
+	with STATISTICS_LOCK:
+		if CAPACITY and IN_FLIGHT >= CAPACITY:
+			return False
+		IN_FLIGHT+=1
+		return True
+
+def leaveRequest():
+	global IN_FLIGHT
+	with STATISTICS_LOCK:
+		IN_FLIGHT-=1
+
+class MistStubHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	#Headers and body are written separately; without TCP_NODELAY the body would wait for the delayed acknowledgement of the client
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		global OUTAGE_UNTIL
+		parsedUrl = urllib.parse.urlsplit(self.path)
+		if parsedUrl.path == "/outage":
+			try:
+				seconds = float(urllib.parse.parse_qs(parsedUrl.query).get("seconds", ["0"])[0])
+			except ValueError:
+				self.sendJson(400, {"name": "BadRequestError"})
+				return
+			with STATISTICS_LOCK:
+				OUTAGE_UNTIL = time.time() + seconds
+			self.sendJson(200, {"seconds": seconds})
+			return
+		if parsedUrl.path in ("/stats", "/reset"):
+			with STATISTICS_LOCK:
+				if parsedUrl.path == "/reset":
+					for name in STATISTICS:
+						STATISTICS[name] = 0
+				statistics = dict(STATISTICS)
+			self.sendJson(200, statistics)
+			return
+		addStatistic("requests")
+		if time.time() < OUTAGE_UNTIL:
+			addStatistic("outage")
+			self.sendJson(503, {"name": "ServiceUnavailableError"})
+			return
+		if not enterRequest():
+			addStatistic("overloaded")
+			self.sendJson(504, {"name": "GatewayTimeoutError"})
+			return
+		try:
+			self.serveGenomes(parsedUrl)
+		finally:
+			leaveRequest()
+
+	def serveGenomes(self, parsedUrl):
+		if LATENCY:
+			time.sleep(LATENCY)
+		if ERROR_RATE and injectError():
+			addStatistic("errors")
+			headers = {"Retry-After": RETRY_AFTER} if RETRY_AFTER is not None else {}
+			self.sendJson(503, {"name": "ServiceUnavailableError"}, headers)
+			return
+		match = GENOME_PATH.match(parsedUrl.path)
+		if not match:
+			self.sendJson(404, {"name": "NotFoundError"})
+			return
+		query = urllib.parse.parse_qs(parsedUrl.query, keep_blank_values=True)
+		try:
+			page = int(query.get("page", ["1"])[0])
+			perPage = min(int(query.get("per_page", ["30"])[0]), MAX_PER_PAGE)
+		except ValueError:
+			self.sendJson(400, {"name": "BadRequestError"})
+			return
+		components, componentToGenes = genomeData(match.group(1))
+		if match.group(2) == "stp-matrix":
+			pageComponents = components[(page-1)*perPage:page*perPage]
+			self.sendJson(200, {"counts": {"tcp": {}} if pageComponents else {}, "components": pageComponents})
+			return
+		try:
+			componentId = int(query["where.component_id"][0])
+		except (KeyError, ValueError):
+			self.sendJson(400, {"name": "BadRequestError"})
+			return
+		ranks = query.get("where.ranks", [""])[0].split(",")
+		genes = [gene for gene in componentToGenes.get(componentId, []) if all(rank in gene["ranks"] for rank in ranks if rank)]
+		#The total is reported only when asked for with the count parameter, as by the MiST API
+		headers = {"X-Total-Count": str(len(genes))} if "count" in query else {}
+		self.sendJson(200, genes[(page-1)*perPage:page*perPage], headers)
+
+	def sendJson(self, status, body, headers={}):
+		data = json.dumps(body, separators=(",", ":")).encode("utf-8")
+		compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+		if compressed:
+			data = gzip.compress(data, compresslevel=1)
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		if compressed:
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(data)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+def main(argv):
+	initialize(argv)
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", PORT), MistStubHandler)
+	server.daemon_threads = True
+	print(server.server_address[1], flush=True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+if __name__ == "__main__":
+	main(sys.argv)
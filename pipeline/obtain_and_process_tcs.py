@@ -1,40 +1,166 @@
 #!/usr/bin/python3
 import sys, getopt
 import urllib.request, urllib.parse, urllib.error
+import http.client
+import email.utils
+import random
 import json
 import collections
 import os.path
 import time
+import hashlib
+import inspect
 import logging
+import concurrent.futures
+import multiprocessing
+import response_cache
+import mist_client
+import tsv_files
+import domain_engine
+import run_metrics
+import architecture_cache
+import gtdb_taxonomy
+import coverage_index
 
 OUT_FILE_HEADERS = ["Genome_id", "NCBI_id", "MiST_id", "protein_length", "domain_architecture", "sensors_or_regulators", "domain_counts", "domain_combinations", "\n"]
 
 USAGE = "\n\nThe script queries MiST db via it's API for histidine kinases and response regulators in genomes. \n" + \
 	"It outputs complete domain information and other data in tabulated format for both histidine kinases and response regualtors separately. \n" + \
 	"Output fields: " + ", ".join(OUT_FILE_HEADERS).rstrip(", \n") + " \n" + \
-	"python 	" + sys.argv[0] + '''
+	"Fetching and domain processing can also be run as separate stages: 'fetch' saves the raw signal genes of every genome to a store\n" + \
+	"and 'process' builds the output files from the store on several cores without network access.\n" + \
+	"python 	" + sys.argv[0] + " [fetch|process]" + '''
 	-h || --help               - help
-	-i || --ifile              - input file
+	-i || --ifile              - input file (fetch)
+	-r || --raw-store          - store of the raw signal-gene JSON, one line per genome (gzip-compressed, one member per genome, with the .gz suffix).
+	                             fetch: the fetched genomes are appended to it; process: the genomes are read from it.
+	--fetch-only               - fetch: only fill the raw store (requires -r); the first and second output files are not written
 	-f || --ffile              - first output file
 	-s || --sfile              - second output file
+	                             Output files with the .gz suffix are written gzip-compressed, one gzip member per genome.
 	-d || --database           - specify database: mist or mist-mags
+	--api-url                  - genomes API URL to use for the database instead of its MiST server, e.g. http://127.0.0.1:8765/v1/genomes/ of mist_stub.py
 	-c || --continue           - start a new analysis or continue with allready existing provided files.
 	                             Users are simply expected to specify -c (--continue) without provinding arguments.
 	                             Default is without this paraeter specified, i.e. start a new analysis.
+	                             Not needed when the journal of a previous run exists: such a run is resumed automatically.
+	-j || --journal            - journal of the completed genomes (default: first output file + ".journal").
+	                             Rows of a genome are appended to the output files together and the genome is then recorded in the journal.
+	                             A restarted run skips the genomes in the journal and drops rows of a genome that was interrupted halfway.
+	--restart                  - ignore an existing journal and start a new analysis
+	--taxon                    - only the genomes of these GTDB taxa: comma-separated taxa with their rank prefix, e.g. p__Pseudomonadota,f__Vibrionaceae
+	                             (can be repeated). Genomes are selected by their GTDB lineage before any request; genomes missing from the taxonomy are skipped
+	--exclude-taxon            - skip the genomes of these GTDB taxa, given as for --taxon (can be repeated)
+	--taxonomy                 - GTDB taxonomy file of --taxon and --exclude-taxon (default: the file in input/gtdb_taxonomy of this repository)
+	--coverage-index           - write the per-genome index of tcs_coverage.py to this file while the genomes are written: the rows of every genome
+	                             in the first and second output files and their byte ranges. A resumed run indexes the rows written before anew
+	--skip-existing            - skip the genomes already written to this output file by another run (can be repeated): the genomes of its journal
+	                             when it has one, otherwise the genomes of its first column
+	-w || --workers            - number of genomes fetched concurrently (default 1, i.e. one genome at a time).
+	                             process: number of processes preparing the domains.
+	                             Rows are still written grouped per genome and in the order of the input file (or the raw store).
+	--host-connections         - maximum number of simultaneous requests sent to one MiST host, which is also the number of
+	                             keep-alive connections kept open to it (default 8). Below it the number of requests in flight adapts:
+	                             it grows while the latency stays healthy and is halved on 5xx, 429 responses and timeouts
+	--max-rate                 - maximum number of requests per second sent to one MiST host (default: no limit)
+	--breaker-pause            - seconds every worker pauses when a host answers 5 overloaded responses in a row (default 30).
+	                             A single probe request is sent after the pause; the pause doubles while the probes fail (up to 10 minutes).
+	                             Attempts failing while the host is paused do not count against --retries, but the probes do: after --retries
+	                             failed probes in a row the host is taken as down and the run stops (a new run resumes from the journal).
+	--cache-dir                - directory of the persistent response cache. Responses are served from the cache when present
+	                             and every fetched response is saved to it.
+	--cache-max-age            - drop cached responses older than this number of days (default: no limit)
+	--cache-max-size           - keep the cache below this size in megabytes, evicting the least recently used responses (default: no limit)
+	--per-page                 - items requested per page (default and maximum 100, the maximum of the MiST API)
+	--retries                  - number of attempts per request before the genome is deferred (default 10)
+	--backoff-base             - delay in seconds before the first retry; it doubles with every next attempt (default 2)
+	--backoff-max              - upper limit of the delay between attempts in seconds (default 120).
+	                             A random jitter is applied to every delay.
+	--retry-after-max          - upper limit in seconds of the wait asked for by a Retry-After header of the server (default 3600).
+	                             The server's Retry-After is waited in full up to this limit, even when it is longer than --backoff-max.
+	--retry-rounds             - genomes that failed are queued and fetched again at the end of the run this many times (default 2).
+	                             Genomes failing in the last round are saved to timeout_genomes.txt and are not written to the output files.
+	--metrics                  - append per-genome metrics to this file as JSON lines: wall time, fetch, network and domain processing times,
+	                             pages (and pages served from the cache), decoded bytes and retries
+	--prometheus-file          - write the run totals (genomes, pages, bytes, retries, network and processing time, ETA) to this file
+	                             in the Prometheus text format, e.g. into the directory of the node exporter textfile collector
+	--architecture-cache       - file of the memoized domain architectures: loaded when it exists and saved at the end of the run,
+	                             so the next run (e.g. process over a raw store) reuses the architectures resolved by this one
+	--architecture-cache-size  - number of architectures memoized per Aseq id and per hit signature (default 500000; 0 turns the memoization off)
+	--verify-domains           - resolve domain architectures with both the batch engine and the per-gene functions
+	                             and report genes where they differ (slower; for checking the engine on real data)
+	--offline                  - serve every request from the cache only (requires --cache-dir); the run stops at the first missing response
 '''
 
 #Variables controlled by the script parameters
+COMMAND = "fetch"
 INPUT_FILE = None
+RAW_STORE = None
+FETCH_ONLY = False
 OUTPUT_FILE1 = "output_HK.tsv"
 OUTPUT_FILE2 = "output_RR.tsv"
 CONTINUE = False
+JOURNAL_FILE = None
+RESTART = False
+WORKERS = 1
+HOST_CONNECTIONS = 8
+MAX_RATE = None
+BREAKER_PAUSE = 30.0
+CACHE_DIR = None
+CACHE_MAX_AGE = None
+CACHE_MAX_SIZE = None
+OFFLINE = False
+RETRIES = 10
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+RETRY_AFTER_MAX = 3600.0
+RETRY_ROUNDS = 2
+VERIFY_DOMAINS = False
+API_URL = None
+METRICS_FILE = None
+PROMETHEUS_FILE = None
+PER_PAGE = 100
+ARCHITECTURE_CACHE_FILE = None
+ARCHITECTURE_CACHE_SIZE = 500000
+INCLUDE_TAXA = set()
+EXCLUDE_TAXA = set()
+TAXONOMY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "input", "gtdb_taxonomy", "ar53_bac120_taxonmy_r214.tsv.zip")
+SKIP_EXISTING_FILES = []
+COVERAGE_INDEX_FILE = None
 
 #Variables set within the script
+#Fingerprint of the code the memoized architectures come from, saved with the architecture cache
+ARCHITECTURE_FINGERPRINT = None
 PROTEIN_TYPES = ["sensKinase", "respReg"]
 PROTEIN_TYPE_TO_OUTFILE = {PROTEIN_TYPES[0]: OUTPUT_FILE1, PROTEIN_TYPES[1]: OUTPUT_FILE2}
-GENOME_VERSIONS = None
+#Genome versions recorded in the journal by previous runs
+COMPLETED_GENOMES = set()
+JOURNAL_START = "#start"
+#Genome versions found in the --skip-existing files, and {genome version: GTDB lineage} when taxa are selected
+EXISTING_GENOMES = set()
+GENOME_TO_LINEAGE = None
+TAXON_RANK_PREFIXES = ("d__", "p__", "c__", "o__", "f__", "g__", "s__")
+#Genes compared and genes that differed when VERIFY_DOMAINS is set
+DOMAIN_VERIFICATION = {"genes": 0, "mismatches": 0}
+#Files appended per genome: the first and second output files and/or the raw store, in the order of the sizes recorded in the journal.
+#They and the journal stay open for the whole run and are flushed at genome boundaries
+SINK_FILES = []
+SINK_HANDLES = []
+JOURNAL_HANDLE = None
+COVERAGE_HANDLE = None
+RAW_RECORD_PREFIX = '{"genome":'
+#Streaming mode of tcs_pipeline.py: a function called with (genomeVersion, proteinTypeToRows) of every committed genome.
+#The first and second output files are then written only when given, and no journal is kept, as the streamed statistics are not resumable
+ROWS_CONSUMER = None
+OUTPUT_BUFFER_SIZE = 1024*1024
 TIMEOUT_FILE = "timeout_genomes.txt"
 DATABASE = "mist"
+#Executors for the per-component requests and for the pages after the first one of the genomes being fetched;
+#created in processDomains() when WORKERS > 1. They are separate, as a component task waits for its page tasks
+COMPONENT_EXECUTOR = None
+PAGE_EXECUTOR = None
+#Client errors that are worth retrying; any other 4xx response fails the genome at once
+RETRYABLE_CLIENT_ERRORS = [408, 429]
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(filename=sys.argv[0].replace(".py", "") + "_log.txt", level=logging.INFO)
 
@@ -42,20 +168,40 @@ GENOMES_URL = "https://mib-jouline-db.asc.ohio-state.edu/v1/genomes/"
 METAGENOMES_URL = "https://metagenomes.asc.ohio-state.edu/v1/genomes/"
 DATABASE_TO_URL = {"mist": GENOMES_URL, "mist-mags": METAGENOMES_URL}
 
-STP_MATRIX = "/stp-matrix?page=%PAGE%&per_page=100"
-SIGNAL_GENES_HK = "/signal-genes?where.component_id=%COMPONENT_ID%&where.ranks=tcp,hk&count&page=%PAGE%&per_page=100&fields.Gene.Aseq=pfam31"
-SIGNAL_GENES_HHK = "/signal-genes?where.component_id=%COMPONENT_ID%&where.ranks=tcp,hhk&count&page=%PAGE%&per_page=100&fields.Gene.Aseq=pfam31"
-SIGNAL_GENES_RR = "/signal-genes?where.component_id=%COMPONENT_ID%&where.ranks=tcp,rr&count&page=%PAGE%&per_page=100&fields.Gene.Aseq=pfam31"
-SIGNAL_GENES_HRR = "/signal-genes?where.component_id=%COMPONENT_ID%&where.ranks=tcp,hrr&count&page=%PAGE%&per_page=100&fields.Gene.Aseq=pfam31"
+STP_MATRIX = "/stp-matrix?page=%PAGE%&per_page=%PER_PAGE%"
+#All two-component system genes of a component are requested at once and sorted by their rank on the client.
+#With the count parameter the server reports the number of genes in the X-Total-Count header
+SIGNAL_GENES_TCP = "/signal-genes?where.component_id=%COMPONENT_ID%&where.ranks=tcp&count&page=%PAGE%&per_page=%PER_PAGE%&fields.Gene.Aseq=pfam31"
+MAX_PER_PAGE = 100
+TOTAL_COUNT_HEADER = "X-Total-Count"
+#The total count of a cached page is cached under the url with this suffix, which never occurs in a requested url
+TOTAL_COUNT_CACHE_SUFFIX = "#" + TOTAL_COUNT_HEADER
+#The order of the ranks is the order in which the genes are written to the output files
+SIGNAL_RANKS = ["hk", "hhk", "rr", "hrr"]
+RANK_TO_PROTEIN_TYPE = {"hk": PROTEIN_TYPES[0], "hhk": PROTEIN_TYPES[0], "rr": PROTEIN_TYPES[1], "hrr": PROTEIN_TYPES[1]}
 
 HIS_KINASE_DIM_DOMAINS = ["HisKA", "HisKA_2", "HisKA_3", "H-kinase_dim", "His_kinase"]
 HIS_KINASE_CATAL_DOMAINS = ["HATPase_c", "HATPase_c_2", "HATPase_c_5", "HWE_HK"]
 RESPONSE_REG_DOMAINS = ["Response_reg", "FleQ"]
+#Domains that are not reported among the sensor or regulator domains
+CORE_TCS_DOMAINS = frozenset(HIS_KINASE_DIM_DOMAINS + HIS_KINASE_CATAL_DOMAINS + RESPONSE_REG_DOMAINS)
 
 def initialize(argv):
-	global INPUT_FILE, OUTPUT_FILE1, OUTPUT_FILE2, GENOME_VERSIONS, PROTEIN_TYPE_TO_OUTFILE, DATABASE, CONTINUE
+	global INPUT_FILE, OUTPUT_FILE1, OUTPUT_FILE2, PROTEIN_TYPE_TO_OUTFILE, DATABASE, CONTINUE, WORKERS, HOST_CONNECTIONS, MAX_RATE, BREAKER_PAUSE
+	global CACHE_DIR, CACHE_MAX_AGE, CACHE_MAX_SIZE, OFFLINE, JOURNAL_FILE, RESTART, RETRIES, BACKOFF_BASE, BACKOFF_MAX, RETRY_AFTER_MAX, RETRY_ROUNDS, VERIFY_DOMAINS
+	global COMMAND, RAW_STORE, FETCH_ONLY, SINK_FILES, API_URL, METRICS_FILE, PROMETHEUS_FILE, PER_PAGE
+	global ARCHITECTURE_CACHE_FILE, ARCHITECTURE_CACHE_SIZE, ARCHITECTURE_FINGERPRINT, INCLUDE_TAXA, EXCLUDE_TAXA, TAXONOMY_FILE, SKIP_EXISTING_FILES, COVERAGE_INDEX_FILE
+	arguments = argv[1:]
+	if ROWS_CONSUMER is not None:
+		OUTPUT_FILE1 = OUTPUT_FILE2 = None
+	if arguments and arguments[0] in ("fetch", "process"):
+		COMMAND = arguments[0]
+		arguments = arguments[1:]
 	try:
-		opts, args = getopt.getopt(argv[1:],"hi:f:s:d:c",["help", "ifile=", "ffile=", "sfile=", "database=", "continue"])
+		opts, args = getopt.getopt(arguments,"hi:r:f:s:d:cj:w:",["help", "ifile=", "raw-store=", "fetch-only", "ffile=", "sfile=", "database=", "continue", "journal=", "restart",
+			"workers=", "host-connections=", "max-rate=", "breaker-pause=", "cache-dir=", "cache-max-age=", "cache-max-size=", "offline", "retries=", "backoff-base=", "backoff-max=", "retry-after-max=", "retry-rounds=",
+			"verify-domains", "api-url=", "metrics=", "prometheus-file=", "per-page=", "architecture-cache=", "architecture-cache-size=",
+			"taxon=", "exclude-taxon=", "taxonomy=", "skip-existing=", "coverage-index="])
 		if len(opts) == 0:
 			raise getopt.GetoptError("Options are required\n")
 	except getopt.GetoptError as e:
@@ -68,6 +214,36 @@ def initialize(argv):
 				sys.exit()
 			elif opt in ("-i", "--ifile"):
 				INPUT_FILE = str(arg).strip()
+			elif opt in ("-r", "--raw-store"):
+				RAW_STORE = str(arg).strip()
+			elif opt == "--fetch-only":
+				FETCH_ONLY = True
+			elif opt == "--per-page":
+				PER_PAGE = int(arg)
+				if not 1 <= PER_PAGE <= MAX_PER_PAGE:
+					raise ValueError("--per-page should be between 1 and " + str(MAX_PER_PAGE))
+			elif opt == "--architecture-cache":
+				ARCHITECTURE_CACHE_FILE = str(arg).strip()
+			elif opt == "--architecture-cache-size":
+				ARCHITECTURE_CACHE_SIZE = int(arg)
+				if ARCHITECTURE_CACHE_SIZE < 0:
+					raise ValueError("Architecture cache size should not be negative")
+			elif opt == "--taxon":
+				INCLUDE_TAXA.update(parseTaxa(arg))
+			elif opt == "--exclude-taxon":
+				EXCLUDE_TAXA.update(parseTaxa(arg))
+			elif opt == "--taxonomy":
+				TAXONOMY_FILE = str(arg).strip()
+			elif opt == "--skip-existing":
+				SKIP_EXISTING_FILES.append(str(arg).strip())
+			elif opt == "--coverage-index":
+				COVERAGE_INDEX_FILE = str(arg).strip()
+			elif opt == "--metrics":
+				METRICS_FILE = str(arg).strip()
+			elif opt == "--prometheus-file":
+				PROMETHEUS_FILE = str(arg).strip()
+			elif opt == "--api-url":
+				API_URL = str(arg).strip().rstrip("/") + "/"
 			elif opt in ("-f", "--ffile"):
 				OUTPUT_FILE1 = str(arg).strip()
 			elif opt in ("-s", "--sfile"):
@@ -79,63 +255,342 @@ def initialize(argv):
 					sys.exit(2)
 			elif opt in ("-c", "--continue"):
 				CONTINUE = True
+			elif opt in ("-j", "--journal"):
+				JOURNAL_FILE = str(arg).strip()
+			elif opt == "--restart":
+				RESTART = True
+			elif opt in ("-w", "--workers"):
+				WORKERS = int(arg)
+				if WORKERS < 1:
+					raise ValueError("Number of workers should be a positive integer")
+			elif opt == "--host-connections":
+				HOST_CONNECTIONS = int(arg)
+				if HOST_CONNECTIONS < 1:
+					raise ValueError("Number of host connections should be a positive integer")
+			elif opt == "--max-rate":
+				MAX_RATE = float(arg)
+				if MAX_RATE <= 0:
+					raise ValueError("Maximum request rate should be positive")
+			elif opt == "--breaker-pause":
+				BREAKER_PAUSE = float(arg)
+				if BREAKER_PAUSE < 0:
+					raise ValueError("Breaker pause should not be negative")
+			elif opt == "--cache-dir":
+				CACHE_DIR = str(arg).strip()
+			elif opt == "--cache-max-age":
+				CACHE_MAX_AGE = float(arg)*24*3600
+			elif opt == "--cache-max-size":
+				CACHE_MAX_SIZE = int(float(arg)*1024*1024)
+			elif opt == "--offline":
+				OFFLINE = True
+			elif opt == "--retries":
+				RETRIES = int(arg)
+				if RETRIES < 1:
+					raise ValueError("Number of retries should be a positive integer")
+			elif opt == "--backoff-base":
+				BACKOFF_BASE = float(arg)
+			elif opt == "--backoff-max":
+				BACKOFF_MAX = float(arg)
+			elif opt == "--retry-after-max":
+				RETRY_AFTER_MAX = float(arg)
+				if RETRY_AFTER_MAX < 0:
+					raise ValueError("--retry-after-max should not be negative")
+			elif opt == "--retry-rounds":
+				RETRY_ROUNDS = int(arg)
+			elif opt == "--verify-domains":
+				VERIFY_DOMAINS = True
+		if OFFLINE and not CACHE_DIR:
+			raise ValueError("--offline requires --cache-dir")
+		if ARCHITECTURE_CACHE_FILE and not ARCHITECTURE_CACHE_SIZE:
+			raise ValueError("--architecture-cache requires a positive --architecture-cache-size")
+		if API_URL:
+			DATABASE_TO_URL[DATABASE] = API_URL
+		if FETCH_ONLY and not RAW_STORE:
+			raise ValueError("--fetch-only requires -r (--raw-store)")
+		if COMMAND == "process" and not RAW_STORE:
+			raise ValueError("process requires -r (--raw-store)")
+		if COMMAND == "fetch" and not INPUT_FILE:
+			raise ValueError("fetch requires -i (--ifile)")
+		if COVERAGE_INDEX_FILE and (FETCH_ONLY or not (OUTPUT_FILE1 and OUTPUT_FILE2)):
+			raise ValueError("--coverage-index requires the first and second output files")
+		if INCLUDE_TAXA or EXCLUDE_TAXA:
+			loadTaxonomy()
+		for existingFile in SKIP_EXISTING_FILES:
+			EXISTING_GENOMES.update(readExistingGenomes(existingFile))
 	except Exception as e:
 		print("===========ERROR==========\n " + str(e) + USAGE)
 		sys.exit(2)
+	mist_client.configure(HOST_CONNECTIONS, maxRate=MAX_RATE, breakerPause=BREAKER_PAUSE, maxFailedProbes=RETRIES)
+	if CACHE_DIR:
+		response_cache.openCache(CACHE_DIR, CACHE_MAX_AGE, CACHE_MAX_SIZE)
+	#Worker processes of the process command hand the architectures they resolve over to be saved
+	architecture_cache.configure(ARCHITECTURE_CACHE_SIZE, bool(ARCHITECTURE_CACHE_FILE) and COMMAND == "process" and WORKERS > 1)
+	if ARCHITECTURE_CACHE_FILE:
+		ARCHITECTURE_FINGERPRINT = architectureFingerprint()
+		if architecture_cache.loadCache(ARCHITECTURE_CACHE_FILE, ARCHITECTURE_FINGERPRINT):
+			LOGGER.info("Architecture cache loaded from %s", ARCHITECTURE_CACHE_FILE)
+		elif os.path.exists(ARCHITECTURE_CACHE_FILE):
+			print("Architecture cache " + ARCHITECTURE_CACHE_FILE + " was saved by other domain processing code or can not be read; it is built anew")
+			LOGGER.info("Architecture cache %s is discarded", ARCHITECTURE_CACHE_FILE)
 	#Initialize the dictionary with the provided files
 	PROTEIN_TYPE_TO_OUTFILE = {PROTEIN_TYPES[0]: OUTPUT_FILE1, PROTEIN_TYPES[1]: OUTPUT_FILE2}
-	if not CONTINUE:
-		#Create ouput files and write headers:
-		for oFile in PROTEIN_TYPE_TO_OUTFILE.values():
-			with open(oFile, "w") as outFile:
-				outFile.write("\t".join(OUT_FILE_HEADERS))
+	SINK_FILES = [] if FETCH_ONLY else [oFile for oFile in (OUTPUT_FILE1, OUTPUT_FILE2) if oFile]
+	if COMMAND == "fetch" and RAW_STORE:
+		SINK_FILES.append(RAW_STORE)
+	if ROWS_CONSUMER is not None:
+		JOURNAL_FILE = None
+	elif JOURNAL_FILE is None:
+		JOURNAL_FILE = SINK_FILES[0] + ".journal"
+	if JOURNAL_FILE and os.path.exists(JOURNAL_FILE) and not RESTART:
+		resumeFromJournal()
+	else:
+		if not CONTINUE:
+			#Create ouput files and write headers:
+			for oFile in SINK_FILES:
+				with open(oFile, "wb") as outFile:
+					if oFile in PROTEIN_TYPE_TO_OUTFILE.values():
+						outFile.write(tsv_files.encodeForOutput(oFile, "\t".join(OUT_FILE_HEADERS)))
+		if JOURNAL_FILE:
+			with open(JOURNAL_FILE, "w") as journal:
+				journal.write("\t".join([JOURNAL_START] + outputFileSizes()) + "\n")
+
+##*********************************************************************##
+##*********************** Genome selection block **********************##
+def parseTaxa(arg):
+	taxa = [taxon.strip() for taxon in str(arg).split(",") if taxon.strip()]
+	for taxon in taxa:
+		if not taxon.startswith(TAXON_RANK_PREFIXES):
+			raise ValueError("GTDB taxa are given with their rank prefix (" + ", ".join(TAXON_RANK_PREFIXES) + "): " + taxon)
+	return taxa
+
+def lineageTaxa(lineage):
+	return set(taxon.strip() for taxon in lineage.split(";"))
+
+#The taxa are checked against the taxonomy, so a misspelled taxon stops the run instead of selecting no genomes
+def loadTaxonomy():
+	global GENOME_TO_LINEAGE
+	GENOME_TO_LINEAGE = gtdb_taxonomy.loadIndex(TAXONOMY_FILE)
+	knownTaxa = set()
+	for lineage in set(GENOME_TO_LINEAGE.values()):
+		knownTaxa.update(lineageTaxa(lineage))
+	unknownTaxa = (INCLUDE_TAXA | EXCLUDE_TAXA) - knownTaxa
+	if unknownTaxa:
+		raise ValueError("Taxa not found in the GTDB taxonomy " + TAXONOMY_FILE + ": " + ", ".join(sorted(unknownTaxa)))
+
+#The genomes recorded in the journal of the file, or else the first column of its rows
+def readExistingGenomes(outputFile):
+	existingGenomes = set()
+	journalFile = outputFile + ".journal"
+	if os.path.exists(journalFile):
+		with open(journalFile, "r") as journal:
+			for line in journal:
+				record = line.split("\t")
+				if line.endswith("\n") and record[0] != JOURNAL_START:
+					existingGenomes.add(record[0])
+		return existingGenomes
+	with tsv_files.openTsv(outputFile) as iFile:
+		for line in iFile:
+			genomeVersion = line.split("\t", 1)[0]
+			if genomeVersion != OUT_FILE_HEADERS[0]:
+				existingGenomes.add(genomeVersion)
+	return existingGenomes
+
+def inSelectedTaxa(genomeVersion):
+	if GENOME_TO_LINEAGE is None:
+		return True
+	lineage = GENOME_TO_LINEAGE.get(genomeVersion)
+	if lineage is None:
+		return not INCLUDE_TAXA
+	taxa = lineageTaxa(lineage)
+	if INCLUDE_TAXA and not taxa & INCLUDE_TAXA:
+		return False
+	return not taxa & EXCLUDE_TAXA
+
+#Returns why a genome is not fetched (or processed), None for a genome to fetch
+def genomeSkipReason(genomeVersion):
+	if genomeVersion in COMPLETED_GENOMES:
+		return "completed"
+	if genomeVersion in EXISTING_GENOMES:
+		return "existing"
+	if not inSelectedTaxa(genomeVersion):
+		return "taxon"
+	return None
+##******************** Genome selection block finish ******************##
+##*********************************************************************##
+
+##*********************************************************************##
+##**************************** Journal block **************************##
+#Every journal line is a genome version followed by the sizes of SINK_FILES right after its rows were appended.
+#The first line records the sizes at the start of the analysis.
+def outputFileSizes():
+	return [str(os.path.getsize(oFile)) for oFile in SINK_FILES]
+
+def resumeFromJournal():
+	global COMPLETED_GENOMES
+	with open(JOURNAL_FILE, "rb") as journal:
+		journalContent = journal.read()
+	#A line cut short by a crash is dropped, so that the next record starts on a new line
+	completeLength = journalContent.rfind(b"\n") + 1
+	if completeLength < len(journalContent):
+		os.truncate(JOURNAL_FILE, completeLength)
+	lastSizes = None
+	for line in journalContent[:completeLength].decode("utf-8").splitlines():
+		record = line.split("\t")
+		if record[0] != JOURNAL_START:
+			COMPLETED_GENOMES.add(record[0])
+		lastSizes = [int(size) for size in record[1:]]
+	if lastSizes is None:
+		print("===========ERROR==========\n Journal " + JOURNAL_FILE + " is empty. Use --restart to start a new analysis.")
+		sys.exit(2)
+	if len(lastSizes) != len(SINK_FILES):
+		print("===========ERROR==========\n Journal " + JOURNAL_FILE + " was written for " + str(len(lastSizes)) + " output files, this run writes " + str(len(SINK_FILES)) + \
+			". Use the options of the interrupted run or --restart to start a new analysis.")
+		sys.exit(2)
+	#Rows written after the last completed genome belong to an interrupted genome and are removed
+	for outFile, size in zip(SINK_FILES, lastSizes):
+		if not os.path.exists(outFile) or os.path.getsize(outFile) < size:
+			print("===========ERROR==========\n " + outFile + " is shorter than recorded in the journal " + JOURNAL_FILE + ". Use --restart to start a new analysis.")
+			sys.exit(2)
+		if os.path.getsize(outFile) > size:
+			LOGGER.info("Removing rows of an interrupted genome from %s", outFile)
+			os.truncate(outFile, size)
+	print("Resuming from the journal " + JOURNAL_FILE + ": " + str(len(COMPLETED_GENOMES)) + " genomes are already completed.")
+
+def openOutputFiles():
+	global JOURNAL_HANDLE, COVERAGE_HANDLE
+	for oFile in SINK_FILES:
+		SINK_HANDLES.append(open(oFile, "ab", buffering=OUTPUT_BUFFER_SIZE))
+	if JOURNAL_FILE:
+		JOURNAL_HANDLE = open(JOURNAL_FILE, "a")
+	if COVERAGE_INDEX_FILE:
+		COVERAGE_HANDLE = coverage_index.openSidecar(COVERAGE_INDEX_FILE, OUTPUT_FILE1, OUTPUT_FILE2, bool(COMPLETED_GENOMES) or CONTINUE, JOURNAL_FILE)
+
+def closeOutputFiles():
+	global JOURNAL_HANDLE, COVERAGE_HANDLE
+	for outputFile in SINK_HANDLES:
+		outputFile.close()
+	del SINK_HANDLES[:]
+	if JOURNAL_HANDLE:
+		JOURNAL_HANDLE.close()
+		JOURNAL_HANDLE = None
+	if COVERAGE_HANDLE:
+		COVERAGE_HANDLE.close()
+		COVERAGE_HANDLE = None
+
+#Appends all the rows of a genome to the output files (and its raw record to the raw store) and then records the genome in the journal.
+#The files are flushed here only, so a genome costs one write per file instead of one open and write per protein.
+def commitGenome(genomeVersion, proteinTypeToRows, rawRecord=None):
+	coverageEntry = coverage_index.newEntry() if COVERAGE_HANDLE else None
+	for oFile, outputFile in zip(SINK_FILES, SINK_HANDLES):
+		if oFile == RAW_STORE and COMMAND == "fetch":
+			rows = None
+			text = rawRecord
+		else:
+			rows = proteinTypeToRows[PROTEIN_TYPES[0] if oFile == OUTPUT_FILE1 else PROTEIN_TYPES[1]]
+			text = "".join(rows)
+		data = tsv_files.encodeForOutput(oFile, text) if text else b""
+		if coverageEntry is not None and rows is not None:
+			#The rows count, the offset and the size of the genome in the first or second output file
+			position = 0 if oFile == OUTPUT_FILE1 else 3
+			coverageEntry[position:position+3] = [len(rows), outputFile.tell() if data else 0, len(data)]
+		if data:
+			outputFile.write(data)
+			outputFile.flush()
+			os.fsync(outputFile.fileno())
+	if ROWS_CONSUMER is not None and proteinTypeToRows is not None:
+		ROWS_CONSUMER(genomeVersion, proteinTypeToRows)
+	if JOURNAL_HANDLE:
+		JOURNAL_HANDLE.write("\t".join([genomeVersion] + outputFileSizes()) + "\n")
+		JOURNAL_HANDLE.flush()
+		os.fsync(JOURNAL_HANDLE.fileno())
+	if COVERAGE_HANDLE:
+		coverage_index.appendEntry(COVERAGE_HANDLE, genomeVersion, coverageEntry)
+##************************** Journal block finish *********************##
+##*********************************************************************##
 
 #The function first retreives stp-matrix and after analyzing the matrix it retrives signal genes for those components that have target signaling systems
 #This is done, because it is much faster this way
-def retrieveSignalGenesFromMist(genomeVersion, additionaFieldsTemplate):
-	sensorRegulatorType = "hk"
-	if additionaFieldsTemplate == SIGNAL_GENES_HK:
-		sensorRegulatorType = "hk"
-	elif additionaFieldsTemplate == SIGNAL_GENES_HHK:
-		sensorRegulatorType = "hhk"
-	elif additionaFieldsTemplate == SIGNAL_GENES_RR:
-		sensorRegulatorType = "rr"
-	elif additionaFieldsTemplate == SIGNAL_GENES_HRR:
-		sensorRegulatorType = "hrr"
+#The matrix is fetched once per genome and every component with any of SIGNAL_RANKS is queried once for all of its two-component genes.
+#Returns {"hk": [gene, ...], "hhk": [...], "rr": [...], "hrr": [...]}, every list in the matrix order of the components,
+#i.e. the same genes in the same order as one query per rank would return.
+def retrieveSignalGenesFromMist(genomeVersion):
 	genomeURL = DATABASE_TO_URL[DATABASE] + genomeVersion
 
 	#Get stp-matrix and look at the numnber of components and save those components that have two-component systems.
 	#They will be saved in componentsWithTcp list.
 	componentsWithTcp = list() #componentsWithTcp will be populated
-	getSignalGenes(genomeURL + STP_MATRIX, componentsWithTcp, genomeVersion, sensorRegulatorType, False, False)
+	getSignalGenes(genomeURL + STP_MATRIX, componentsWithTcp, genomeVersion, SIGNAL_RANKS, False, False)
 
 	#Retrieve signal genes in those genomic components (chromosomes, scaffolds, or contigs depending on the assembly level) that have two-component systems
-	signalGeneList = list()
-	for component in componentsWithTcp:
-		getSignalGenes(genomeURL, signalGeneList, genomeVersion, False, additionaFieldsTemplate, component)
+	#Components are queried concurrently when several workers are used. Every component gets its own list
+	#and the lists are joined in the matrix order, so the order of the genes does not depend on the timing.
+	def componentSignalGenes(component):
+		componentSignalGeneList = list()
+		getSignalGenes(genomeURL, componentSignalGeneList, genomeVersion, False, SIGNAL_GENES_TCP, component)
+		return componentSignalGeneList
+	if COMPONENT_EXECUTOR and len(componentsWithTcp) > 1:
+		componentSignalGeneLists = COMPONENT_EXECUTOR.map(componentSignalGenes, componentsWithTcp)
+	else:
+		componentSignalGeneLists = map(componentSignalGenes, componentsWithTcp)
+	rankToSignalGenes = {rank: list() for rank in SIGNAL_RANKS}
+	for componentSignalGeneList in componentSignalGeneLists:
+		for gene in componentSignalGeneList:
+			rank = signalGeneRank(gene)
+			if rank:
+				rankToSignalGenes[rank].append(gene)
+
+	return rankToSignalGenes
 
-	return signalGeneList			
+#A signal gene has ranks like ["tcp", "hk"]; genes of the other two-component ranks are not reported
+def signalGeneRank(gene):
+	for rank in gene.get("ranks", []):
+		if rank in RANK_TO_PROTEIN_TYPE:
+			return rank
+	return None
 
+#The first page is requested alone. When it reports the total number of items, the number of pages is known
+#and the other pages are requested at once; otherwise the pages are requested one after another up to the first empty one.
 def getSignalGenes(url, elementList, genomeVersion, tcpMatrix, additionaFieldsTemplate=False, component=False):
-	noDataAnymore = False
-	#This range is enough as 100 requests for 100 items per page is 10000 items. The numer of components per genome (or histidine kinase|respose regulators)
-	#is an order of magnitde less than this.
-	#'break' statement will stop sending requests when no data could be retrieved anymore
-	for num in range(1, 101):
+	def pageUrl(num):
 		if additionaFieldsTemplate:
 			additionaFields = additionaFieldsTemplate.replace("%COMPONENT_ID%", str(component["id"])).replace("%PAGE%", str(num))
-			constructedUrl = url + additionaFields
+			return (url + additionaFields).replace("%PER_PAGE%", str(PER_PAGE))
+		return url.replace("%PAGE%", str(num)).replace("%PER_PAGE%", str(PER_PAGE))
+	def pageElements(num):
+		pageElementList = list()
+		signalGenesRetriever(pageUrl(num), pageElementList, genomeVersion, tcpMatrix, False)
+		return pageElementList
+
+	noDataAnymore, totalCount = signalGenesRetriever(pageUrl(1), elementList, genomeVersion, tcpMatrix, False)
+	if noDataAnymore:
+		return
+	if totalCount is not None:
+		pageCount = -(-totalCount // PER_PAGE)
+		if PAGE_EXECUTOR and pageCount > 2:
+			pageElementLists = PAGE_EXECUTOR.map(pageElements, range(2, pageCount+1))
 		else:
-			constructedUrl = url.replace("%PAGE%", str(num))
-		noDataAnymore = signalGenesRetriever(constructedUrl, elementList, genomeVersion, tcpMatrix, noDataAnymore)
-		if noDataAnymore:
-			break
+			pageElementLists = map(pageElements, range(2, pageCount+1))
+		#Pages are joined in their order, whatever order they arrive in
+		for pageElementList in pageElementLists:
+			elementList.extend(pageElementList)
+		return
+	num = 2
+	while not noDataAnymore:
+		noDataAnymore, totalCount = signalGenesRetriever(pageUrl(num), elementList, genomeVersion, tcpMatrix, noDataAnymore)
+		num+=1
+
+#Raised when a page could not be retrieved; the genome is then deferred to the end of the run and none of its rows are written
+class GenomeFetchError(Exception):
+	pass
 
+#Returns (noDataAnymore, the total number of items reported by the server or None)
 def signalGenesRetriever(url, elementList, genomeVersion, tcpMatrix, noDataAnymore):
-	for iteration in range (1, 11):
+	totalCount = None
+	iteration = 0
+	while iteration < RETRIES:
+		iteration+=1
 		try:
-			result = urllib.request.urlopen(url)
-			resultAsJson = json.loads(result.read().decode("utf-8"))
+			resultAsJson, totalCount = fetchJson(url, genomeVersion)
 			#In case of tcpMatrix: No data anymore from this page on
 			if tcpMatrix and "components" in resultAsJson and not resultAsJson["components"]:
 				noDataAnymore = True
@@ -145,51 +600,323 @@ def signalGenesRetriever(url, elementList, genomeVersion, tcpMatrix, noDataAnymo
 			elif not resultAsJson:
 				noDataAnymore = True
 				break
-			#404 NotFoundError
+			#404 NotFoundError: there is no data to page through
 			if "name" in resultAsJson:
+				noDataAnymore = True
 				break
-		except (urllib.error.HTTPError, urllib.error.URLError) as error:
-			if iteration == 10:
-				with open (TIMEOUT_FILE, "a") as timeoutFile:
-					LOGGER.info("Ten attempts to retrieve data were unsuccessful. Save the genome caused the problem to %s file", TIMEOUT_FILE)
-					timeoutFile.write(genomeVersion + "\n")
-			#sleep 5 seconds if gateway timeout happened
-			LOGGER.error("Timeout error: %s", error)
-			LOGGER.info("Attempt " + str(iteration) + ". Sleep for 5 seconds...")
-			time.sleep(5)
+		except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as error:
+			LOGGER.error("Request error: %s (%s)", error, url)
+			run_metrics.addRetry(genomeVersion)
+			if isinstance(error, urllib.error.HTTPError) and 400 <= error.code < 500 and error.code not in RETRYABLE_CLIENT_ERRORS:
+				raise GenomeFetchError("Request failed with status " + str(error.code) + ": " + url)
+			#While the host is paused by the circuit breaker of mist_client, the request waits for the end of the pause
+			#and the failed attempt is not counted, so an outage does not defer every genome being fetched.
+			#A host that stays down is bounded by the breaker: after RETRIES failed probes mist_client raises HostUnavailableError
+			if mist_client.pauseRemaining(url) > 0:
+				iteration-=1
+				continue
+			if iteration == RETRIES:
+				raise GenomeFetchError(str(RETRIES) + " attempts to retrieve data were unsuccessful: " + url)
+			delay = backoffDelay(iteration, error)
+			LOGGER.info("Attempt " + str(iteration) + ". Sleep for %.1f seconds...", delay)
+			time.sleep(delay)
 			LOGGER.info("Continue.")
 			continue
 			
 		if tcpMatrix:
 			if "tcp" in resultAsJson["counts"]:
 				for component in resultAsJson["components"]:
-					if "tcp" in component["counts"] and tcpMatrix in component["counts"]["tcp"]:
+					if "tcp" in component["counts"] and any(rank in component["counts"]["tcp"] for rank in tcpMatrix):
 						elementList.append(component)
 		else:
 			elementList.extend(resultAsJson)
 		break
-	return noDataAnymore
+	return noDataAnymore, totalCount
 
-def processDomains():
-	genomeNumber = 1
+#Exponential backoff with full jitter; a Retry-After header of the server is used instead when it asks for a longer pause.
+#The server's pause is limited by RETRY_AFTER_MAX only, not by BACKOFF_MAX, so the client never retries before the server allows it
+def backoffDelay(iteration, error):
+	delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**(iteration-1)))
+	retryAfter = retryAfterSeconds(error)
+	if retryAfter is not None:
+		delay = max(delay, min(retryAfter, RETRY_AFTER_MAX))
+	return delay
+
+def retryAfterSeconds(error):
+	if not isinstance(error, urllib.error.HTTPError) or not error.headers:
+		return None
+	retryAfter = error.headers.get("Retry-After")
+	if not retryAfter:
+		return None
+	try:
+		return max(0.0, float(retryAfter))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+#Returns the decoded JSON of the url and the total number of items reported by the server (or None),
+#from the response cache when it is open and has the url
+def fetchJson(url, genomeVersion):
+	body = None
+	totalCount = None
+	if response_cache.isOpen():
+		body = response_cache.cacheGet(url)
+		cachedCount = response_cache.cacheGet(url + TOTAL_COUNT_CACHE_SUFFIX) if body is not None else None
+		totalCount = int(cachedCount) if cachedCount is not None else None
+	cached = body is not None
+	if body is None:
+		if OFFLINE:
+			raise response_cache.CacheMissError("Response is not in the cache: " + url)
+		#The client limits the requests in flight per host to HOST_CONNECTIONS, whatever the number of workers is
+		start = time.time()
+		try:
+			body, headers = mist_client.fetchResponse(url)
+		finally:
+			run_metrics.addNetworkTime(genomeVersion, time.time() - start)
+		totalCount = headerTotalCount(headers)
+		if response_cache.isOpen():
+			response_cache.cachePut(url, body)
+			if totalCount is not None:
+				response_cache.cachePut(url + TOTAL_COUNT_CACHE_SUFFIX, str(totalCount).encode("utf-8"))
+	run_metrics.addPage(genomeVersion, len(body), cached)
+	resultAsJson = json.loads(body.decode("utf-8"))
+	#A total reported in the body instead of the header
+	if totalCount is None and isinstance(resultAsJson, dict) and isinstance(resultAsJson.get("count"), int):
+		totalCount = resultAsJson["count"]
+	return resultAsJson, totalCount
+
+def headerTotalCount(headers):
+	try:
+		return max(0, int(headers.get(TOTAL_COUNT_HEADER)))
+	except (TypeError, ValueError):
+		return None
+
+def readGenomeVersions():
 	with open(INPUT_FILE, "r") as inputFile:
 		for genomeVersion in inputFile:
 			genomeVersion = genomeVersion.split("\t")[1]
 			if genomeVersion:
-				print(" ".join(["Genome Number:", str(genomeNumber), "   Genome ID:", genomeVersion]))
-				genomeNumber+=1
-				listOfSignalGeneLists = []
-				listOfSignalGeneLists.append((retrieveSignalGenesFromMist(genomeVersion, SIGNAL_GENES_HK), PROTEIN_TYPES[0]))
-				listOfSignalGeneLists.append((retrieveSignalGenesFromMist(genomeVersion, SIGNAL_GENES_HHK), PROTEIN_TYPES[0]))
-				listOfSignalGeneLists.append((retrieveSignalGenesFromMist(genomeVersion, SIGNAL_GENES_RR), PROTEIN_TYPES[1]))
-				listOfSignalGeneLists.append((retrieveSignalGenesFromMist(genomeVersion, SIGNAL_GENES_HRR), PROTEIN_TYPES[1]))
-				for signalGeneList in listOfSignalGeneLists:
-					for gene in signalGeneList[0]:
-						prepareDomains(gene, genomeVersion, signalGeneList[1])
+				yield genomeVersion
+
+#Returns None instead of a partially fetched genome
+def fetchGenomeOrNone(genomeVersion):
+	run_metrics.startGenome(genomeVersion)
+	try:
+		return retrieveSignalGenesFromMist(genomeVersion)
+	except GenomeFetchError as e:
+		LOGGER.error("Genome %s is deferred: %s", genomeVersion, e)
+		return None
+	finally:
+		run_metrics.fetchDone(genomeVersion)
+
+#Yields (genomeVersion, rankToSignalGenes) in the order of the input file.
+#With several workers the genomes are fetched in a thread pool; at most 2*WORKERS genomes are held ahead of the one being written,
+#so a slow genome delays the output but does not let fetched data accumulate without bound.
+def fetchGenomesInOrder(genomeVersions):
+	if WORKERS == 1:
+		for genomeVersion in genomeVersions:
+			yield genomeVersion, fetchGenomeOrNone(genomeVersion)
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+		pending = collections.deque()
+		for genomeVersion in genomeVersions:
+			pending.append((genomeVersion, executor.submit(fetchGenomeOrNone, genomeVersion)))
+			if len(pending) >= 2*WORKERS:
+				genomeVersion, future = pending.popleft()
+				yield genomeVersion, future.result()
+		while pending:
+			genomeVersion, future = pending.popleft()
+			yield genomeVersion, future.result()
+
+def processDomains():
+	global COMPONENT_EXECUTOR, PAGE_EXECUTOR
+	if WORKERS > 1:
+		COMPONENT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS)
+		PAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS)
+	openOutputFiles()
+	#The input file is read once ahead to know the number of genomes for the ETA
+	skipReasons = collections.Counter(genomeSkipReason(genomeVersion) for genomeVersion in readGenomeVersions())
+	if EXISTING_GENOMES or GENOME_TO_LINEAGE is not None:
+		print("Genomes to fetch: {}; skipped: {} already in the --skip-existing files, {} outside the selected taxa".format(
+			skipReasons[None], skipReasons["existing"], skipReasons["taxon"]))
+	run_metrics.configure(METRICS_FILE, PROMETHEUS_FILE, skipReasons[None])
+	try:
+		genomeVersions = (genomeVersion for genomeVersion in readGenomeVersions() if genomeSkipReason(genomeVersion) is None)
+		retryQueue = processGenomes(genomeVersions)
+		#Failed genomes are fetched again once everything else is done, which gives the server time to recover
+		for retryRound in range(1, RETRY_ROUNDS+1):
+			if not retryQueue:
+				break
+			print("Retry round " + str(retryRound) + ": " + str(len(retryQueue)) + " genomes")
+			retryQueue = processGenomes(retryQueue)
+		if retryQueue:
+			with open(TIMEOUT_FILE, "a") as timeoutFile:
+				LOGGER.info("%d genomes could not be retrieved. Save them to %s file", len(retryQueue), TIMEOUT_FILE)
+				for genomeVersion in retryQueue:
+					timeoutFile.write(genomeVersion + "\n")
+	finally:
+		closeOutputFiles()
+		run_metrics.close()
+		if COMPONENT_EXECUTOR:
+			COMPONENT_EXECUTOR.shutdown()
+			COMPONENT_EXECUTOR = None
+		if PAGE_EXECUTOR:
+			PAGE_EXECUTOR.shutdown()
+			PAGE_EXECUTOR = None
+
+#Fetches, processes and writes the genomes; returns the genomes that could not be fetched
+def processGenomes(genomeVersions):
+	failedGenomes = []
+	genomeNumber = 1
+	#Genomes are written one after another from this thread only, so rows of a genome stay consecutive in the output files
+	for genomeVersion, rankToSignalGenes in fetchGenomesInOrder(genomeVersions):
+		if rankToSignalGenes is None:
+			print(" ".join(["Genome ID:", genomeVersion, "failed and is deferred"]))
+			run_metrics.finishGenome(genomeVersion, "deferred")
+			failedGenomes.append(genomeVersion)
+			continue
+		#Rows are staged and written only when the whole genome is processed
+		start = time.time()
+		proteinTypeToRows = None if FETCH_ONLY else genomeOutputRows(genomeVersion, rankToSignalGenes, DOMAIN_VERIFICATION)
+		run_metrics.addProcessing(genomeVersion, time.time() - start)
+		rawRecord = rawStoreRecord(genomeVersion, rankToSignalGenes) if RAW_STORE else None
+		commitGenome(genomeVersion, proteinTypeToRows, rawRecord)
+		run_metrics.finishGenome(genomeVersion, "written")
+		print(" ".join(["Genome Number:", str(genomeNumber), "   Genome ID:", genomeVersion, "  ", run_metrics.etaReport()]))
+		genomeNumber+=1
+	return failedGenomes
+
+#Returns {proteinType: [output row, ...]} of a genome; genes are taken rank by rank in the SIGNAL_RANKS order
+def genomeOutputRows(genomeVersion, rankToSignalGenes, verification):
+	proteinTypeToRows = {proteinType: [] for proteinType in PROTEIN_TYPES}
+	for rank in SIGNAL_RANKS:
+		genes = rankToSignalGenes[rank]
+		outputRecords = prepareDomainsBatch(genes, genomeVersion)
+		if VERIFY_DOMAINS:
+			verifyDomains(genes, genomeVersion, outputRecords, verification)
+		for outputRecord in outputRecords:
+			if outputRecord:
+				proteinTypeToRows[RANK_TO_PROTEIN_TYPE[rank]].append(outputRecord + "\n")
+	return proteinTypeToRows
+
+def verifyDomains(genes, genomeVersion, outputRecords, verification):
+	for gene, outputRecord in zip(genes, outputRecords):
+		verification["genes"]+=1
+		if prepareDomains(gene, genomeVersion) != outputRecord:
+			verification["mismatches"]+=1
+			LOGGER.error("Domain engine differs from the per-gene processing for gene %s of genome %s", gene.get("Gene", {}).get("stable_id"), genomeVersion)
+
+##*********************************************************************##
+##*************************** Raw store block *************************##
+#A raw store line: {"genome":"GCF_000006745.1","signalGenes":{"hk":[...],"hhk":[...],"rr":[...],"hrr":[...]}}
+def rawStoreRecord(genomeVersion, rankToSignalGenes):
+	return json.dumps({"genome": genomeVersion, "signalGenes": rankToSignalGenes}, separators=(",", ":")) + "\n"
+
+#The genome version is decoded from the beginning of the line, without parsing the whole record
+def rawRecordGenome(line):
+	return json.JSONDecoder().raw_decode(line, len(RAW_RECORD_PREFIX))[0]
+
+def readRawRecords():
+	with tsv_files.openTsv(RAW_STORE) as store:
+		for line in store:
+			if line.startswith(RAW_RECORD_PREFIX) and genomeSkipReason(rawRecordGenome(line)) is None:
+				yield line
+
+#Runs in the worker processes; returns (genomeVersion, proteinTypeToRows, verification, architecture cache statistics, new architectures)
+def processRawRecord(line):
+	record = json.loads(line)
+	verification = {"genes": 0, "mismatches": 0}
+	proteinTypeToRows = genomeOutputRows(record["genome"], record["signalGenes"], verification)
+	return record["genome"], proteinTypeToRows, verification, architecture_cache.takeStatistics(), architecture_cache.takeNewEntries()
+
+#Runs in every worker process of the process command. The settings of initialize() and the loaded architecture cache reach
+#the workers by themselves only when they are forked, so they are passed on for the forkserver and spawn start methods
+def initializeWorker(verifyDomains, cacheSize, collectNewEntries, cacheEntries):
+	global VERIFY_DOMAINS, ARCHITECTURE_CACHE_SIZE
+	VERIFY_DOMAINS = verifyDomains
+	ARCHITECTURE_CACHE_SIZE = cacheSize
+	architecture_cache.configure(cacheSize, collectNewEntries)
+	architecture_cache.setEntries(*cacheEntries)
+
+#Builds the output files from the raw store. The records are processed in a process pool and written in the order of the store
+def processRawStore():
+	openOutputFiles()
+	pool = None
+	if WORKERS > 1:
+		pool = multiprocessing.Pool(WORKERS, initializer=initializeWorker, initargs=(VERIFY_DOMAINS, ARCHITECTURE_CACHE_SIZE,
+			architecture_cache.COLLECT_NEW_ENTRIES, architecture_cache.cacheEntries()))
+	try:
+		results = pool.imap(processRawRecord, readRawRecords(), chunksize=4) if pool else map(processRawRecord, readRawRecords())
+		genomeNumber = 1
+		for genomeVersion, proteinTypeToRows, verification, cacheStatistics, newArchitectures in results:
+			print(" ".join(["Genome Number:", str(genomeNumber), "   Genome ID:", genomeVersion]))
+			genomeNumber+=1
+			for key in verification:
+				DOMAIN_VERIFICATION[key]+=verification[key]
+			architecture_cache.addStatistics(cacheStatistics)
+			architecture_cache.addEntries(newArchitectures)
+			commitGenome(genomeVersion, proteinTypeToRows)
+	finally:
+		if pool:
+			pool.terminate()
+		closeOutputFiles()
+##************************* Raw store block finish ********************##
+##*********************************************************************##
 
 ##*********************************************************************##
 ##********************** Domains processing block**********************##
-def prepareDomains(gene, genomeVersion, proteinType):
+#Returns the output records of the genes (without the line end), None for genes without domain information.
+#Architectures of an Aseq or a hit layout seen before come from architecture_cache; the others are resolved together by domain_engine.
+def prepareDomainsBatch(genes, genomeVersion):
+	hitLists = [domainHits(gene) for gene in genes]
+	architectureStrings = [None] * len(genes)
+	#[(gene position, Aseq id, hit signature), ...] of the genes to resolve
+	misses = []
+	for position, (gene, hitList) in enumerate(zip(genes, hitLists)):
+		if not hitList:
+			continue
+		if not ARCHITECTURE_CACHE_SIZE:
+			misses.append((position, None, None))
+			continue
+		aseqId = gene["Gene"].get("aseq_id")
+		strings, signature = architecture_cache.lookup(aseqId, hitList)
+		if strings is None:
+			misses.append((position, aseqId, signature))
+		else:
+			architectureStrings[position] = strings
+	architectures = domain_engine.resolveDomainsBatch([hitLists[position] for position, aseqId, signature in misses])
+	for (position, aseqId, signature), architecture in zip(misses, architectures):
+		architectureStrings[position] = formatArchitecture(architecture)
+		if ARCHITECTURE_CACHE_SIZE:
+			architecture_cache.store(aseqId, signature, architectureStrings[position])
+	outputRecords = []
+	for gene, strings in zip(genes, architectureStrings):
+		outputRecords.append(formatOutputRecord(gene, genomeVersion, strings) if strings is not None else None)
+	return outputRecords
+
+#The memoized architectures depend on domain_engine.py (its rules and constants), the domain lists and the functions turning hits
+#into the architecture strings, and on the per-gene functions they are verified against; a change to any of them changes the fingerprint
+def architectureFingerprint():
+	digest = hashlib.sha256()
+	with open(domain_engine.__file__, "rb") as engineFile:
+		digest.update(engineFile.read())
+	constants = (sorted(HIS_KINASE_DIM_DOMAINS), sorted(HIS_KINASE_CATAL_DOMAINS), sorted(CORE_TCS_DOMAINS), architecture_cache.HIT_FIELDS)
+	digest.update(repr(constants).encode("utf-8"))
+	for function in (domainHits, formatArchitecture, removeOverlapps, compareEvalues, processHoles, HisKAprocessing, checkAndAddHolesAndDomains, addHoleAndDomain):
+		digest.update(inspect.getsource(function).encode("utf-8"))
+	return digest.hexdigest()
+
+def domainHits(gene):
+	if "Gene" in gene and "Aseq" in gene["Gene"] and "pfam31" in gene["Gene"]["Aseq"]:
+		return gene["Gene"]["Aseq"]["pfam31"]
+	return None
+
+#Per-gene processing with removeOverlapps and processHoles. Returns the output record of the gene (without the line end)
+#or None if the gene has no domain information
+def prepareDomains(gene, genomeVersion):
 	if "Gene" in gene and "Aseq" in gene["Gene"] and "pfam31" in gene["Gene"]["Aseq"]:
 		#Ordering domains according to how they are encoded in the gene
 		domainsSorted = sorted(gene["Gene"]["Aseq"]["pfam31"], key=lambda x: x["ali_from"], reverse=False)
@@ -197,33 +924,36 @@ def prepareDomains(gene, genomeVersion, proteinType):
 		#if domainsSorted:
 		if len (domainsSorted) > 0:
 			domainsFiltered = removeOverlapps(domainsSorted)
-			
-			refseqVersion = gene["Gene"]["version"]
-			geneStableId = gene["Gene"]["stable_id"]
-			proteinLength = str(int(gene["Gene"]["length"]/3) - 1)
 			domainsOutput = processHoles(domainsFiltered)
+			architecture = [(domain["name"], domain["env_from"], domain["env_to"]) for domain in domainsOutput]
+			return formatOutputRecord(gene, genomeVersion, formatArchitecture(architecture))
+	return None
+
+#architectureStrings: the gene-independent columns returned by formatArchitecture()
+def formatOutputRecord(gene, genomeVersion, architectureStrings):
+	refseqVersion = gene["Gene"]["version"]
+	geneStableId = gene["Gene"]["stable_id"]
+	proteinLength = str(int(gene["Gene"]["length"]/3) - 1)
+	return "\t".join((genomeVersion, refseqVersion, geneStableId, proteinLength) + architectureStrings)
 
-			domainArchitecture = ""
-			domainArchitectureSensOrRegDomsOnly = []
-			for domain in domainsOutput:
-				domainArchitecture = domainArchitecture + "{}:{}-{},".format(domain["name"], domain["env_from"], domain["env_to"])
-				domainName = domain["name"].lstrip("<").rstrip(">")
-				if domain["name"] != "hole" and domainName not in HIS_KINASE_CATAL_DOMAINS and domainName not in HIS_KINASE_DIM_DOMAINS and domainName not in RESPONSE_REG_DOMAINS:
-					domainArchitectureSensOrRegDomsOnly.append(domain["name"])
-
-			#Generate a set of unique domain names and domain to count uniformly sorted
-			#{'domain1': 1, 'domain2': 2}
-			domainToCount = collections.defaultdict(int)
-			for domain in domainsOutput:
-				domainToCount[domain["name"]]+=1
-			sortedDomainNames = sorted(domainToCount.keys())
-			domainsFilteredNamesUniqueStr = ",".join(sortedDomainNames)
-			domainsFilteredNamesUniqueCountsStr = ",".join(["{}:{}".format(domain, domainToCount[domain]) for domain in sortedDomainNames])
-
-			#Save everything to a file:
-			with open(PROTEIN_TYPE_TO_OUTFILE[proteinType], "a") as outputFile:
-				outputRecord = "\t".join([genomeVersion, refseqVersion, geneStableId, proteinLength, domainArchitecture.rstrip(","), ",".join(domainArchitectureSensOrRegDomsOnly), domainsFilteredNamesUniqueCountsStr, domainsFilteredNamesUniqueStr])
-				outputFile.write(outputRecord + "\n")
+#architecture: [(name, env_from, env_to), ...] including holes. Returns the strings of the architecture, of the sensor or
+#regulatory domains, of the domain counts and of the unique domain names
+def formatArchitecture(architecture):
+	domainArchitecture = []
+	domainArchitectureSensOrRegDomsOnly = []
+	#Generate a set of unique domain names and domain to count uniformly sorted
+	#{'domain1': 1, 'domain2': 2}
+	domainToCount = collections.defaultdict(int)
+	for name, envFrom, envTo in architecture:
+		domainArchitecture.append("{}:{}-{}".format(name, envFrom, envTo))
+		domainToCount[name]+=1
+		if name != "hole" and name.lstrip("<").rstrip(">") not in CORE_TCS_DOMAINS:
+			domainArchitectureSensOrRegDomsOnly.append(name)
+	sortedDomainNames = sorted(domainToCount.keys())
+	domainsFilteredNamesUniqueStr = ",".join(sortedDomainNames)
+	domainsFilteredNamesUniqueCountsStr = ",".join(["{}:{}".format(domain, domainToCount[domain]) for domain in sortedDomainNames])
+
+	return (",".join(domainArchitecture), ",".join(domainArchitectureSensOrRegDomsOnly), domainsFilteredNamesUniqueCountsStr, domainsFilteredNamesUniqueStr)
 
 #### Process holes and domains BEGIN ####
 def processHoles(domains):
@@ -345,6 +1075,34 @@ def compareEvalues(pfam1, pfam2):
 		
 def main(argv):
 	initialize(argv)
-	processDomains()
+	run()
+
+def run():
+	try:
+		if COMMAND == "process":
+			processRawStore()
+		else:
+			processDomains()
+	except response_cache.CacheMissError as e:
+		print("===========ERROR==========\n " + str(e) + "\nThe run was started with --offline and stops at the first missing response.")
+		sys.exit(1)
+	except mist_client.HostUnavailableError as e:
+		print("===========ERROR==========\n " + str(e) + "\nThe host is taken as down and the run stops; check --api-url and the network." +
+			("\nThe genomes written so far are kept in the journal " + JOURNAL_FILE + " and a new run resumes from them." if JOURNAL_FILE else ""))
+		LOGGER.error("Host unavailable: %s", e)
+		sys.exit(1)
+	finally:
+		response_cache.closeCache()
+		mist_client.closeConnections()
+		print(mist_client.statisticsReport())
+		LOGGER.info(mist_client.statisticsReport())
+		if ARCHITECTURE_CACHE_SIZE and not FETCH_ONLY:
+			print(architecture_cache.statisticsReport())
+			LOGGER.info(architecture_cache.statisticsReport())
+		if ARCHITECTURE_CACHE_FILE:
+			architecture_cache.saveCache(ARCHITECTURE_CACHE_FILE, ARCHITECTURE_FINGERPRINT)
+		if VERIFY_DOMAINS:
+			print("Domain engine verification: {} genes compared, {} differ".format(DOMAIN_VERIFICATION["genes"], DOMAIN_VERIFICATION["mismatches"]))
 
-main(sys.argv)
+if __name__ == "__main__":
+	main(sys.argv)
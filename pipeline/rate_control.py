@@ -0,0 +1,151 @@
+#Client-side rate and concurrency control of the requests mist_client.py sends to a host.
+#Every database of obtain_and_process_tcs.py (DATABASE_TO_URL) is a host of its own, so each gets its own controller:
+#- a token bucket limits the request rate (when a maximum rate is set);
+#- the number of requests in flight follows AIMD: it grows by one per window of healthy responses while the latency stays
+#  close to the best one seen, and is cut by DECREASE_FACTOR when the server answers 5xx/429 or the request times out;
+#- a circuit breaker opens after BREAKER_FAILURES overloaded responses in a row and pauses every worker for the breaker pause,
+#  then lets a single probe request through. The pause doubles with every failed probe, up to BREAKER_MAX_PAUSE.
+#  After MAX_FAILED_PROBES failed probes in a row the host is taken as down and every request to it raises HostUnavailableError.
+import threading
+import time
+
+MAX_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+#None: no limit of the request rate
+MAX_RATE = None
+DECREASE_FACTOR = 0.5
+#A response is healthy while its latency is below the best latency seen times this factor (plus LATENCY_SLACK seconds)
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.05
+#The best latency seen creeps up by this factor per response, so a slower server is not held to an old record forever
+BASELINE_DRIFT = 1.01
+BREAKER_FAILURES = 5
+BREAKER_PAUSE = 30.0
+BREAKER_MAX_PAUSE = 600.0
+#None: the probes go on for as long as the host is down
+MAX_FAILED_PROBES = None
+#Waiting requests check for a free slot at least this often
+WAIT_INTERVAL = 0.5
+
+#{host: state of the controller of the host}
+HOST_TO_STATE = {}
+HOSTS_LOCK = threading.Lock()
+
+#Raised by acquire() when the host failed MAX_FAILED_PROBES probes in a row
+class HostUnavailableError(Exception):
+	pass
+
+def configure(maxConcurrency=MAX_CONCURRENCY, maxRate=MAX_RATE, breakerPause=BREAKER_PAUSE, maxFailedProbes=MAX_FAILED_PROBES):
+	global MAX_CONCURRENCY, MAX_RATE, BREAKER_PAUSE, MAX_FAILED_PROBES
+	MAX_CONCURRENCY = maxConcurrency
+	MAX_RATE = maxRate
+	BREAKER_PAUSE = breakerPause
+	MAX_FAILED_PROBES = maxFailedProbes
+	with HOSTS_LOCK:
+		HOST_TO_STATE.clear()
+
+def newState():
+	return {"condition": threading.Condition(), "limit": float(max(MIN_CONCURRENCY, MAX_CONCURRENCY // 2)), "in_flight": 0,
+		"tokens": float(max(1.0, MAX_RATE or 1.0)), "refilled": time.monotonic(), "baseline_latency": None, "last_decrease": 0.0,
+		"failures": 0, "open_until": 0.0, "pause": BREAKER_PAUSE, "probing": False, "failed_probes": 0,
+		"requests": 0, "overloads": 0, "decreases": 0, "breaker_opens": 0, "paused_seconds": 0.0}
+
+def hostState(host):
+	with HOSTS_LOCK:
+		if host not in HOST_TO_STATE:
+			HOST_TO_STATE[host] = newState()
+		return HOST_TO_STATE[host]
+
+#Called with the condition of the state held
+def refillTokens(state, now):
+	if MAX_RATE:
+		state["tokens"] = min(max(1.0, MAX_RATE), state["tokens"] + (now - state["refilled"]) * MAX_RATE)
+	state["refilled"] = now
+
+#Blocks until a request may be sent to the host
+def acquire(host):
+	state = hostState(host)
+	with state["condition"]:
+		while True:
+			if MAX_FAILED_PROBES and state["failed_probes"] >= MAX_FAILED_PROBES:
+				raise HostUnavailableError("{} failed {} probe requests in a row after the circuit breaker pauses ({:.1f} s paused)".format(
+					host, state["failed_probes"], state["paused_seconds"]))
+			now = time.monotonic()
+			if state["open_until"] > now:
+				#The breaker is open: every worker waits for the end of the pause
+				state["condition"].wait(state["open_until"] - now)
+				continue
+			#After a pause the breaker is half open: a single probe request goes through until it succeeds
+			halfOpen = state["failures"] >= BREAKER_FAILURES
+			if halfOpen and state["probing"]:
+				state["condition"].wait(WAIT_INTERVAL)
+				continue
+			refillTokens(state, now)
+			if state["in_flight"] < int(state["limit"]) and (not MAX_RATE or state["tokens"] >= 1.0):
+				if MAX_RATE:
+					state["tokens"]-= 1.0
+				state["in_flight"]+= 1
+				state["requests"]+= 1
+				if halfOpen:
+					state["probing"] = True
+				return
+			waitTime = WAIT_INTERVAL
+			if MAX_RATE and state["tokens"] < 1.0:
+				waitTime = min(waitTime, (1.0 - state["tokens"]) / MAX_RATE)
+			state["condition"].wait(waitTime)
+
+#Ends a request acquired for the host. outcome is "ok" (with the latency of the response headers in seconds),
+#"overload" (5xx, 429 or a timeout or connection failure) or "error" (any other failure, which says nothing about the load)
+def release(host, outcome, latency=None):
+	state = hostState(host)
+	with state["condition"]:
+		state["in_flight"]-= 1
+		state["probing"] = False
+		now = time.monotonic()
+		if outcome == "ok":
+			if state["failures"] >= BREAKER_FAILURES:
+				state["pause"] = BREAKER_PAUSE
+			state["failures"] = 0
+			state["failed_probes"] = 0
+			baseline = state["baseline_latency"]
+			if latency is not None:
+				baseline = latency if baseline is None else min(latency, baseline * BASELINE_DRIFT)
+				state["baseline_latency"] = baseline
+			if latency is None or latency <= baseline * LATENCY_TOLERANCE + LATENCY_SLACK:
+				state["limit"] = min(float(MAX_CONCURRENCY), state["limit"] + 1.0 / state["limit"])
+		elif outcome == "overload":
+			state["overloads"]+= 1
+			state["failures"]+= 1
+			#The requests in flight when the server got overloaded fail together; the limit is cut once for them
+			if now - state["last_decrease"] >= (state["baseline_latency"] or 0.0) + LATENCY_SLACK:
+				state["limit"] = max(float(MIN_CONCURRENCY), state["limit"] * DECREASE_FACTOR)
+				state["last_decrease"] = now
+				state["decreases"]+= 1
+			#Requests that were in flight when the breaker opened do not extend the pause
+			if state["failures"] >= BREAKER_FAILURES and state["open_until"] <= now:
+				state["limit"] = float(MIN_CONCURRENCY)
+				state["open_until"] = now + state["pause"]
+				state["breaker_opens"]+= 1
+				state["paused_seconds"]+= state["pause"]
+				#The breaker opens again (rather than for the first time) when the probe after a pause fails
+				if state["failures"] > BREAKER_FAILURES:
+					state["failed_probes"]+= 1
+				#A failed probe doubles the next pause
+				state["pause"] = min(BREAKER_MAX_PAUSE, state["pause"] * 2)
+		state["condition"].notify_all()
+
+#Seconds the breaker of the host stays open, 0 when it is closed
+def pauseRemaining(host):
+	state = hostState(host)
+	with state["condition"]:
+		return max(0.0, state["open_until"] - time.monotonic())
+
+def statisticsReport():
+	with HOSTS_LOCK:
+		hostToState = dict(HOST_TO_STATE)
+	reports = []
+	for host, state in sorted(hostToState.items()):
+		with state["condition"]:
+			reports.append("{}: concurrency limit {:.1f}, overloaded responses {} of {} requests, limit cuts {}, breaker opened {} times ({:.1f} s paused)".format(
+				host, state["limit"], state["overloads"], state["requests"], state["decreases"], state["breaker_opens"], state["paused_seconds"]))
+	return "\n".join(reports)
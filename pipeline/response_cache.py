@@ -0,0 +1,86 @@
+#Persistent cache of MiST/MetaMiST API responses used by obtain_and_process_tcs.py.
+#Responses are stored zlib-compressed in a SQLite database keyed by the requested URL. Entries older than the
+#maximum age are dropped, and when the cache grows above the maximum size the least recently used entries are removed.
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_FILE_NAME = "mist_responses.sqlite"
+#Eviction is checked on opening, on closing and after this many stored responses
+EVICTION_INTERVAL = 1000
+
+CACHE_CONNECTION = None
+CACHE_LOCK = threading.Lock()
+MAX_AGE = None
+MAX_SIZE = None
+PUTS_SINCE_EVICTION = 0
+
+class CacheMissError(Exception):
+	pass
+
+#maxAge in seconds, maxSize in bytes of compressed responses; None means no limit
+def openCache(cacheDir, maxAge=None, maxSize=None):
+	global CACHE_CONNECTION, MAX_AGE, MAX_SIZE
+	if not os.path.isdir(cacheDir):
+		os.makedirs(cacheDir)
+	MAX_AGE = maxAge
+	MAX_SIZE = maxSize
+	CACHE_CONNECTION = sqlite3.connect(os.path.join(cacheDir, CACHE_FILE_NAME), check_same_thread=False, isolation_level=None)
+	CACHE_CONNECTION.execute("PRAGMA journal_mode=WAL")
+	CACHE_CONNECTION.execute("PRAGMA synchronous=NORMAL")
+	CACHE_CONNECTION.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body BLOB, size INTEGER, stored REAL, accessed REAL)")
+	CACHE_CONNECTION.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+	evict()
+
+def closeCache():
+	global CACHE_CONNECTION
+	if CACHE_CONNECTION:
+		evict()
+		CACHE_CONNECTION.close()
+		CACHE_CONNECTION = None
+
+def isOpen():
+	return CACHE_CONNECTION is not None
+
+#Returns the response body as bytes, or None if the URL is not cached or the entry has expired
+def cacheGet(url):
+	with CACHE_LOCK:
+		row = CACHE_CONNECTION.execute("SELECT body, stored FROM responses WHERE url = ?", (url,)).fetchone()
+		if row is None:
+			return None
+		now = time.time()
+		if MAX_AGE is not None and now - row[1] > MAX_AGE:
+			return None
+		CACHE_CONNECTION.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, url))
+	return zlib.decompress(row[0])
+
+def cachePut(url, body):
+	global PUTS_SINCE_EVICTION
+	compressedBody = zlib.compress(body)
+	now = time.time()
+	with CACHE_LOCK:
+		CACHE_CONNECTION.execute("INSERT OR REPLACE INTO responses (url, body, size, stored, accessed) VALUES (?, ?, ?, ?, ?)",
+			(url, compressedBody, len(compressedBody), now, now))
+		PUTS_SINCE_EVICTION+=1
+	if PUTS_SINCE_EVICTION >= EVICTION_INTERVAL:
+		evict()
+
+def evict():
+	global PUTS_SINCE_EVICTION
+	with CACHE_LOCK:
+		PUTS_SINCE_EVICTION = 0
+		if MAX_AGE is not None:
+			CACHE_CONNECTION.execute("DELETE FROM responses WHERE stored < ?", (time.time() - MAX_AGE,))
+		if MAX_SIZE is not None:
+			totalSize = CACHE_CONNECTION.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+			if totalSize > MAX_SIZE:
+				#Walk the entries from the least recently used one and remove them until the cache fits
+				toRemove = []
+				for url, size in CACHE_CONNECTION.execute("SELECT url, size FROM responses ORDER BY accessed"):
+					if totalSize <= MAX_SIZE:
+						break
+					toRemove.append((url,))
+					totalSize-=size
+				CACHE_CONNECTION.executemany("DELETE FROM responses WHERE url = ?", toRemove)
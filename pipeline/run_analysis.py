@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+import sys, getopt
+import os
+import json
+import time
+import hashlib
+import shlex
+import subprocess
+import concurrent.futures
+
+USAGE = "\nThe script runs the whole analysis of the repository (analyze.sh runs it with the options given to it):\n" + \
+	"preparing the genome lists, obtain_and_process_tcs.py per kingdom and database, analyze_tcs_per_genome.py per protein type and kingdom\n" + \
+	"and analyze_tcs_per_taxon.py per per-genome file. The steps are tasks of a graph linked by their files, and a task runs only when\n" + \
+	"its outputs are stale: missing, built by another command, or older than a changed input (the scripts and the modules they import included).\n" + \
+	"A stale obtain task resumes from its journal when only its genome list changed, and starts anew (--restart) otherwise.\n" + \
+	"Obtained files without a record or a journal (left by an earlier analyze.sh) are taken as built; --force obtains them again.\n" + \
+	"Inputs are compared by size and modification time first and by their SHA-256 when these differ, so a touched file is not rebuilt.\n" + \
+	"Independent tasks run in parallel; obtain tasks of the same database never run at the same time.\n\n" + \
+	"python " + sys.argv[0] + '''
+	-h || --help               - help
+	-j || --jobs               - number of tasks run at once (default: number of CPUs)
+	-n || --dry-run            - print the tasks that would run and why, without running them
+	--force                    - run every task, stale or not
+	--no-obtain                - never run obtain_and_process_tcs.py; the existing results of it are analyzed
+	--obtain-options           - options added to every obtain_and_process_tcs.py run, quoted (e.g. "-w 8 --cache-dir ./cache").
+	                             They do not make the obtained files stale; add --force to obtain them again with other options
+'''
+# Variables controlled by the script parameters
+JOBS = os.cpu_count() or 1
+DRY_RUN = False
+FORCE = False
+NO_OBTAIN = False
+OBTAIN_OPTIONS = []
+
+# Variables set within the script
+REPOSITORY_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+DB = {"MiST": "mist", "MetaMiST": "mist-mags"}
+KINGDOMS = {"archaea": "d__Archaea", "bacteria": "d__Bacteria"}
+REPRESENTATIVE_SET = "./input/repr_set_v214_Oct2024_MiST_MetaMiST.tsv"
+DOMAINS_FILE = "./input/MiST_domains_18.tsv"
+TAXONOMY_FILE = "./input/gtdb_taxonomy/ar53_bac120_taxonmy_r214.tsv.zip"
+OBTAIN = "./pipeline/obtain_and_process_tcs.py"
+ANALYZEG = "./pipeline/analyze_tcs_per_genome.py"
+ANALYZET = "./pipeline/analyze_tcs_per_taxon.py"
+OFOLDER = "./results/obtain_and_process_tcs"
+AGFOLDER = "./results/analyze_tcs_per_genome"
+ATFOLDER = "./results/analyze_tcs_per_taxon"
+LOG_FOLDER = "./results/logs"
+# {task name: {"command": command key, "inputs": {path: [size, mtime_ns, sha256]}}} of the tasks built successfully
+STATE_FILE = "./results/.run_analysis_state.json"
+PROTEIN_PREFIXES = ["his_kinases", "resp_regulators"]
+GENOME_STATISTICS = [("-f", "domains"), ("-g", "domain_comb"), ("-k", "superfamily"), ("-l", "superfamily_comb")]
+TAXONOMY_LEVELS = ["species", "genus", "family", "order", "class", "phylum", "kingdom"]
+HASH_BLOCK_SIZE = 1024*1024
+#Local modules imported by the scripts that shape their results; they are inputs of the tasks, as the scripts are.
+#The transport modules of obtain_and_process_tcs.py (mist_client, response_cache, rate_control) do not change its rows, and an edit
+#of them must not restart every obtain task
+OBTAIN_MODULES = ["domain_engine.py", "architecture_cache.py", "tsv_files.py", "gtdb_taxonomy.py"]
+ANALYZEG_MODULES = ["tsv_files.py"]
+ANALYZET_MODULES = ["tsv_files.py", "gtdb_taxonomy.py"]
+
+def initialize(argv):
+	global JOBS, DRY_RUN, FORCE, NO_OBTAIN, OBTAIN_OPTIONS
+	try:
+		opts, args = getopt.getopt(argv[1:],"hj:n",["help", "jobs=", "dry-run", "force", "no-obtain", "obtain-options="])
+	except getopt.GetoptError as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				print(USAGE)
+				sys.exit()
+			elif opt in ("-j", "--jobs"):
+				JOBS = int(arg)
+				if JOBS < 1:
+					raise ValueError("-j (--jobs) must be at least 1")
+			elif opt in ("-n", "--dry-run"):
+				DRY_RUN = True
+			elif opt == "--force":
+				FORCE = True
+			elif opt == "--no-obtain":
+				NO_OBTAIN = True
+			elif opt == "--obtain-options":
+				OBTAIN_OPTIONS = shlex.split(arg)
+	except Exception as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+
+##*********************************************************************##
+##**************************** Task graph block ***********************##
+#A task: {"name", "inputs": [paths], "outputs": [paths], "command": argv of a script or ["filter"|"concat", ...] run by runBuiltin,
+#"exclusive": tasks with the same value never run at the same time (or None)}. Tasks are listed so that producers come before consumers.
+def newTask(name, inputs, outputs, command, exclusive=None):
+	return {"name": name, "inputs": inputs, "outputs": outputs, "command": command, "exclusive": exclusive}
+
+def genomeList(kingdom, db=None):
+	name = "./input/repr_set_v214_Oct2024_MiST_MetaMiST_" + kingdom[:4]
+	return name + ("_" + DB[db] if db else "") + ".tsv"
+
+#The script and its modules; listed before the other inputs, so that staleReason() reports a changed script first
+def scriptFiles(script, modules):
+	return [script] + [os.path.join(os.path.dirname(script), module) for module in modules]
+
+def buildTasks():
+	tasks = []
+	#prepare_files of analyze.sh: the representative set split per kingdom and then per database (lines containing the name, as grep does)
+	for kingdom, domainName in KINGDOMS.items():
+		tasks.append(newTask("prepare " + kingdom, [REPRESENTATIVE_SET], [genomeList(kingdom)], ["filter", REPRESENTATIVE_SET, genomeList(kingdom), domainName]))
+		for db in DB:
+			tasks.append(newTask("prepare " + kingdom + " " + DB[db], [genomeList(kingdom)], [genomeList(kingdom, db)],
+				["filter", genomeList(kingdom), genomeList(kingdom, db), db]))
+	#obtain of analyze.sh; the results of the databases are concatenated into the *_all.tsv files (written anew, not appended to)
+	for kingdom in KINGDOMS:
+		for db in DB:
+			outputs = [os.path.join(OFOLDER, prefix + "_" + kingdom + "_" + DB[db] + ".tsv") for prefix in PROTEIN_PREFIXES]
+			command = [sys.executable, OBTAIN, "-i", genomeList(kingdom, db), "-f", outputs[0], "-s", outputs[1], "-d", DB[db]] + OBTAIN_OPTIONS
+			tasks.append(newTask("obtain " + kingdom + " " + DB[db], scriptFiles(OBTAIN, OBTAIN_MODULES) + [genomeList(kingdom, db)], outputs, command, exclusive=DB[db]))
+		for prefix in PROTEIN_PREFIXES:
+			parts = [os.path.join(OFOLDER, prefix + "_" + kingdom + "_" + DB[db] + ".tsv") for db in DB]
+			allFile = os.path.join(OFOLDER, prefix + "_" + kingdom + "_all.tsv")
+			tasks.append(newTask("concat " + prefix + " " + kingdom, parts, [allFile], ["concat", allFile] + parts))
+	#analyze of analyze.sh: per-genome statistics of every *_all.tsv file, then per-taxon statistics of every level for each of them
+	genomeJobs = str(max(1, JOBS // (len(PROTEIN_PREFIXES)*len(KINGDOMS))))
+	for kingdom in KINGDOMS:
+		for prefix in PROTEIN_PREFIXES:
+			edfile = prefix + "_" + kingdom + "_all"
+			allFile = os.path.join(OFOLDER, edfile + ".tsv")
+			statisticsFiles = [os.path.join(AGFOLDER, edfile + "_" + statistics + ".tsv") for option, statistics in GENOME_STATISTICS]
+			command = [sys.executable, ANALYZEG, "-i", allFile, "-s", DOMAINS_FILE]
+			for (option, statistics), statisticsFile in zip(GENOME_STATISTICS, statisticsFiles):
+				command+= [option, statisticsFile]
+			tasks.append(newTask("per-genome " + edfile, scriptFiles(ANALYZEG, ANALYZEG_MODULES) + [allFile, DOMAINS_FILE], statisticsFiles, command + ["-j", genomeJobs]))
+			#one run per file reads it once and writes every level
+			for statisticsFile in statisticsFiles:
+				root = os.path.join(ATFOLDER, os.path.splitext(os.path.basename(statisticsFile))[0])
+				outputs = [root + "_" + level + ".tsv" for level in TAXONOMY_LEVELS]
+				command = [sys.executable, ANALYZET, "-i", statisticsFile, "-s", TAXONOMY_FILE, "-f", root + ".tsv", "-t", "all"]
+				tasks.append(newTask("per-taxon " + os.path.basename(root), scriptFiles(ANALYZET, ANALYZET_MODULES) + [statisticsFile, TAXONOMY_FILE], outputs, command))
+	return tasks
+
+#Left out of the command a task is fingerprinted by: the -j option of per-genome runs, which depends on -j of this script,
+#and --obtain-options, which mostly tune the requests; use --force to obtain again after changing options that change the results
+def commandKey(task):
+	command = list(task["command"])
+	if command[1:2] == [ANALYZEG] and "-j" in command:
+		del command[command.index("-j"):command.index("-j")+2]
+	if command[1:2] == [OBTAIN] and OBTAIN_OPTIONS:
+		del command[-len(OBTAIN_OPTIONS):]
+	return " ".join(command)
+
+#An obtain run resumes from the journal of its outputs and skips the genomes in it; it has to start anew (--restart) unless
+#the outputs exist and only the genome list changed (or a task before it, preparing the list, runs). Outputs without a journal
+#(adopted from analyze.sh, see adoptable()) are continued (-c) with the genomes already in them skipped, never written anew
+def obtainCommand(task, reason):
+	command = list(task["command"])
+	position = len(command) - len(OBTAIN_OPTIONS)
+	if reason == "no record of a previous build" or reason.startswith("after ") or reason == "changed " + genomeListOf(task):
+		if os.path.exists(journalOf(task)) or not all(os.path.exists(output) for output in task["outputs"]):
+			return command
+		return command[:position] + ["-c", "--skip-existing", task["outputs"][0]] + command[position:]
+	return command[:position] + ["--restart"] + command[position:]
+
+def genomeListOf(task):
+	return task["command"][task["command"].index("-i") + 1]
+
+def journalOf(task):
+	return task["outputs"][0] + ".journal"
+
+#Outputs of obtain_and_process_tcs.py left by analyze.sh before this script have no record and no journal; they are taken
+#as built (their inputs recorded) rather than obtained again
+def adoptable(task, state):
+	if FORCE or task["command"][1:2] != [OBTAIN] or task["name"] in state or os.path.exists(journalOf(task)):
+		return False
+	return all(os.path.exists(output) for output in task["outputs"])
+##************************* Task graph block finish *******************##
+##*********************************************************************##
+
+##*********************************************************************##
+##************************** Fingerprint block ************************##
+def fileHash(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as iFile:
+		for block in iter(lambda: iFile.read(HASH_BLOCK_SIZE), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+#[size, mtime_ns, sha256]; the hash of a file is computed only when its size or modification time differ from previous
+def fingerprint(path, previous=None):
+	stat = os.stat(path)
+	if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+		return previous
+	return [stat.st_size, stat.st_mtime_ns, fileHash(path)]
+
+def loadState():
+	if not os.path.exists(STATE_FILE):
+		return {}
+	with open(STATE_FILE) as iFile:
+		return json.load(iFile)
+
+def saveState(state):
+	os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+	temporaryFile = STATE_FILE + ".tmp"
+	with open(temporaryFile, "w") as oFile:
+		json.dump(state, oFile, indent=1, sort_keys=True)
+	os.replace(temporaryFile, STATE_FILE)
+
+#Returns why the task has to run, or None when its outputs are up to date. A touched but unchanged input gets its new time recorded.
+def staleReason(task, state):
+	if FORCE:
+		return "forced"
+	for output in task["outputs"]:
+		if not os.path.exists(output):
+			return "missing " + output
+	record = state.get(task["name"])
+	if record is None:
+		return "no record of a previous build"
+	if record["command"] != commandKey(task):
+		return "command changed"
+	for path in task["inputs"]:
+		if not os.path.exists(path):
+			return "missing input " + path
+		previous = record["inputs"].get(path)
+		current = fingerprint(path, previous)
+		if previous is None or current[2] != previous[2]:
+			return "changed " + path
+		record["inputs"][path] = current
+	return None
+##*********************** Fingerprint block finish ********************##
+##*********************************************************************##
+
+##*********************************************************************##
+##***************************** Running block *************************##
+#Runs in the pool processes; returns (task name, exit code, seconds)
+def executeTask(task):
+	start = time.time()
+	os.makedirs(LOG_FOLDER, exist_ok=True)
+	for output in task["outputs"]:
+		os.makedirs(os.path.dirname(output), exist_ok=True)
+	logFile = os.path.join(LOG_FOLDER, task["name"].replace(" ", "_") + ".log")
+	with open(logFile, "w") as log:
+		if task["command"][0] in ("filter", "concat"):
+			try:
+				runBuiltin(task["command"])
+				returnCode = 0
+			except OSError as e:
+				log.write(str(e) + "\n")
+				returnCode = 1
+		else:
+			returnCode = subprocess.call(task["command"], stdout=log, stderr=subprocess.STDOUT)
+	return task["name"], returnCode, time.time() - start
+
+#Outputs are written under a temporary name and renamed, so a failed task never leaves an output that looks complete
+def runBuiltin(command):
+	if command[0] == "filter":
+		source, output, pattern = command[1], command[2], command[3].encode("utf-8")
+	else:
+		output, parts = command[1], command[2:]
+	temporaryFile = output + ".tmp"
+	with open(temporaryFile, "wb") as oFile:
+		if command[0] == "filter":
+			with open(source, "rb") as iFile:
+				oFile.writelines(line for line in iFile if pattern in line)
+		else:
+			for part in parts:
+				with open(part, "rb") as iFile:
+					for block in iter(lambda: iFile.read(HASH_BLOCK_SIZE), b""):
+						oFile.write(block)
+	os.replace(temporaryFile, output)
+
+#Returns {task name: reason} of the tasks to run: the stale tasks and every task using an output of a task to run
+def plan(tasks, state):
+	producer = {output: task["name"] for task in tasks for output in task["outputs"]}
+	toRun = {}
+	for task in tasks:
+		if NO_OBTAIN and task["name"].startswith("obtain "):
+			continue
+		if adoptable(task, state):
+			print("Existing outputs of " + task["name"] + " are taken as built (no record of a previous build and no journal); use --force to obtain them again")
+			recordTask(task, state)
+			continue
+		#The own reason of a task comes first: it decides whether an obtain task restarts
+		upstream = [producer[path] for path in task["inputs"] if producer.get(path) in toRun]
+		reason = staleReason(task, state) or ("after " + upstream[0] if upstream else None)
+		if reason:
+			toRun[task["name"]] = reason
+	return toRun
+
+def recordTask(task, state):
+	previous = state.get(task["name"], {}).get("inputs", {})
+	state[task["name"]] = {"command": commandKey(task), "inputs": {path: fingerprint(path, previous.get(path)) for path in task["inputs"] if os.path.exists(path)}}
+
+def runTasks(tasks, toRun, state):
+	nameToTask = {task["name"]: task for task in tasks}
+	producer = {output: task["name"] for task in tasks for output in task["outputs"]}
+	waiting = [task["name"] for task in tasks if task["name"] in toRun]
+	failed = set()
+	running = {}
+	with concurrent.futures.ProcessPoolExecutor(max_workers=JOBS) as executor:
+		while waiting or running:
+			busy = set(nameToTask[name]["exclusive"] for name in running.values()) - set([None])
+			for name in list(waiting):
+				task = nameToTask[name]
+				upstream = set(producer[path] for path in task["inputs"] if path in producer)
+				if upstream & failed:
+					print("Skipped (an input failed):", name)
+					failed.add(name)
+					waiting.remove(name)
+				elif not upstream & (set(waiting) | set(running.values())) and task["exclusive"] not in busy:
+					print("Started:", name, "(" + toRun[name] + ")", flush=True)
+					if task["command"][1:2] == [OBTAIN]:
+						task = dict(task, command=obtainCommand(task, toRun[name]))
+					running[executor.submit(executeTask, task)] = name
+					waiting.remove(name)
+					if task["exclusive"] is not None:
+						busy.add(task["exclusive"])
+			if not running:
+				break
+			done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				name, returnCode, seconds = future.result()
+				del running[future]
+				if returnCode == 0:
+					print("Finished: {} ({:.1f} s)".format(name, seconds), flush=True)
+					recordTask(nameToTask[name], state)
+					saveState(state)
+				else:
+					print("Failed: {} (exit code {}, see {})".format(name, returnCode, os.path.join(LOG_FOLDER, name.replace(" ", "_") + ".log")), flush=True)
+					failed.add(name)
+	return failed
+##************************** Running block finish *********************##
+##*********************************************************************##
+
+def main(argv):
+	initialize(argv)
+	os.chdir(REPOSITORY_DIR)
+	tasks = buildTasks()
+	state = loadState()
+	toRun = plan(tasks, state)
+	if DRY_RUN:
+		for task in tasks:
+			if task["name"] in toRun:
+				restart = task["command"][1:2] == [OBTAIN] and "--restart" in obtainCommand(task, toRun[task["name"]])
+				print(task["name"] + ": " + toRun[task["name"]] + (" (starts anew)" if restart else ""))
+		print("{} of {} tasks would run".format(len(toRun), len(tasks)))
+		return
+	#Unchanged inputs with a new modification time were recorded by the planning
+	saveState(state)
+	if not toRun:
+		print("Everything is up to date")
+		return
+	failed = runTasks(tasks, toRun, state)
+	if failed:
+		print("{} tasks failed or were skipped".format(len(failed)))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,160 @@
+#Per-genome metrics of the fetch pipeline of obtain_and_process_tcs.py.
+#For every genome the wall time, the fetching and domain processing times, the pages and bytes fetched and the retries are recorded.
+#Finished genomes are written as JSON lines, run totals are exported as a Prometheus textfile (for the node exporter textfile collector)
+#and the rate of the run gives the estimated time to completion.
+import json
+import os
+import threading
+import time
+
+#The Prometheus textfile is rewritten at most this often, and once more when the run ends
+PROMETHEUS_INTERVAL = 10.0
+METRIC_PREFIX = "tcs_fetch_"
+
+METRICS_LOCK = threading.Lock()
+#{genome version: metrics of the genome being fetched or processed}
+GENOME_TO_METRICS = {}
+TOTALS = {"genomes_written": 0, "genomes_deferred": 0, "pages": 0, "cached_pages": 0, "response_bytes": 0, "retries": 0,
+	"network_seconds": 0.0, "processing_seconds": 0.0}
+#(name, type, help) of the exported totals
+TOTAL_METRICS = [
+	("genomes_written", "counter", "Genomes fetched, processed and written"),
+	("genomes_deferred", "counter", "Genome fetches that failed and were deferred"),
+	("pages", "counter", "Pages received, from the API or from the response cache"),
+	("cached_pages", "counter", "Pages served from the response cache"),
+	("response_bytes", "counter", "Decoded bytes of the fetched pages"),
+	("retries", "counter", "Requests repeated after an error"),
+	("network_seconds", "counter", "Seconds spent waiting for the API, failed requests included, summed over the concurrent requests"),
+	("processing_seconds", "counter", "Seconds spent resolving domain architectures"),
+]
+JSONL_HANDLE = None
+PROMETHEUS_FILE = None
+LAST_PROMETHEUS_WRITE = 0.0
+START_TIME = None
+TOTAL_GENOMES = None
+
+def configure(jsonlFile=None, prometheusFile=None, totalGenomes=None):
+	global JSONL_HANDLE, PROMETHEUS_FILE, START_TIME, TOTAL_GENOMES
+	if jsonlFile:
+		JSONL_HANDLE = open(jsonlFile, "a", buffering=1)
+	PROMETHEUS_FILE = prometheusFile
+	TOTAL_GENOMES = totalGenomes
+	START_TIME = time.time()
+
+#Clears the totals and the genomes in progress, so a next run in the same process (tcs_pipeline.py) starts from zero
+def reset():
+	global LAST_PROMETHEUS_WRITE, START_TIME, TOTAL_GENOMES
+	with METRICS_LOCK:
+		GENOME_TO_METRICS.clear()
+		for name in TOTALS:
+			TOTALS[name] = 0.0 if isinstance(TOTALS[name], float) else 0
+	LAST_PROMETHEUS_WRITE = 0.0
+	START_TIME = None
+	TOTAL_GENOMES = None
+
+def close():
+	global JSONL_HANDLE
+	if PROMETHEUS_FILE:
+		writePrometheusFile()
+	if JSONL_HANDLE:
+		JSONL_HANDLE.close()
+		JSONL_HANDLE = None
+
+def newGenomeMetrics(genomeVersion):
+	return {"genome": genomeVersion, "started": time.time(), "pages": 0, "cached_pages": 0, "bytes": 0, "retries": 0,
+		"fetch_seconds": 0.0, "network_seconds": 0.0, "processing_seconds": 0.0}
+
+#A genome fetched again in a retry round starts anew
+def startGenome(genomeVersion):
+	with METRICS_LOCK:
+		GENOME_TO_METRICS[genomeVersion] = newGenomeMetrics(genomeVersion)
+
+#Called with METRICS_LOCK held
+def genomeMetrics(genomeVersion):
+	metrics = GENOME_TO_METRICS.get(genomeVersion)
+	if metrics is None:
+		metrics = GENOME_TO_METRICS[genomeVersion] = newGenomeMetrics(genomeVersion)
+	return metrics
+
+#A page received, from the API or from the response cache
+def addPage(genomeVersion, size, cached):
+	with METRICS_LOCK:
+		metrics = genomeMetrics(genomeVersion)
+		metrics["pages"]+=1
+		metrics["bytes"]+=size
+		TOTALS["pages"]+=1
+		TOTALS["response_bytes"]+=size
+		if cached:
+			metrics["cached_pages"]+=1
+			TOTALS["cached_pages"]+=1
+
+#Time of a request sent to the API, whether it succeeded or not
+def addNetworkTime(genomeVersion, seconds):
+	with METRICS_LOCK:
+		genomeMetrics(genomeVersion)["network_seconds"]+=seconds
+		TOTALS["network_seconds"]+=seconds
+
+def addRetry(genomeVersion):
+	with METRICS_LOCK:
+		genomeMetrics(genomeVersion)["retries"]+=1
+		TOTALS["retries"]+=1
+
+def fetchDone(genomeVersion):
+	with METRICS_LOCK:
+		metrics = genomeMetrics(genomeVersion)
+		metrics["fetch_seconds"] = time.time() - metrics["started"]
+
+def addProcessing(genomeVersion, seconds):
+	with METRICS_LOCK:
+		genomeMetrics(genomeVersion)["processing_seconds"]+=seconds
+		TOTALS["processing_seconds"]+=seconds
+
+#status is "written" or "deferred"; the genome metrics are written as a JSON line
+def finishGenome(genomeVersion, status):
+	with METRICS_LOCK:
+		metrics = GENOME_TO_METRICS.pop(genomeVersion, None) or newGenomeMetrics(genomeVersion)
+		metrics["status"] = status
+		metrics["wall_seconds"] = time.time() - metrics["started"]
+		TOTALS["genomes_written" if status == "written" else "genomes_deferred"]+=1
+		if JSONL_HANDLE:
+			JSONL_HANDLE.write(json.dumps(metrics, sort_keys=True) + "\n")
+	if PROMETHEUS_FILE and time.time() - LAST_PROMETHEUS_WRITE >= PROMETHEUS_INTERVAL:
+		writePrometheusFile()
+
+#Estimated seconds to completion from the rate of the genomes written so far, or None when it cannot be estimated yet
+def etaSeconds():
+	with METRICS_LOCK:
+		written = TOTALS["genomes_written"]
+	if not TOTAL_GENOMES or not written or START_TIME is None:
+		return None
+	return max(0, TOTAL_GENOMES - written) * (time.time() - START_TIME) / written
+
+def etaReport():
+	eta = etaSeconds()
+	if eta is None:
+		return "ETA: unknown"
+	hours, rest = divmod(int(eta), 3600)
+	return "ETA: {:d}:{:02d}:{:02d}".format(hours, rest // 60, rest % 60)
+
+#The file is written under a temporary name and renamed, so the collector never reads a partial file
+def writePrometheusFile():
+	global LAST_PROMETHEUS_WRITE
+	LAST_PROMETHEUS_WRITE = time.time()
+	with METRICS_LOCK:
+		totals = dict(TOTALS)
+	lines = []
+	for name, metricType, description in TOTAL_METRICS:
+		lines.append("# HELP {}{}_total {}".format(METRIC_PREFIX, name, description))
+		lines.append("# TYPE {}{}_total {}".format(METRIC_PREFIX, name, metricType))
+		lines.append("{}{}_total {}".format(METRIC_PREFIX, name, totals[name]))
+	gauges = [("genomes_planned", "Genomes to fetch in this run", TOTAL_GENOMES), ("eta_seconds", "Estimated seconds to the end of the run", etaSeconds()),
+		("last_update_timestamp_seconds", "Time of this update", LAST_PROMETHEUS_WRITE)]
+	for name, description, value in gauges:
+		if value is not None:
+			lines.append("# HELP {}{} {}".format(METRIC_PREFIX, name, description))
+			lines.append("# TYPE {}{} gauge".format(METRIC_PREFIX, name))
+			lines.append("{}{} {}".format(METRIC_PREFIX, name, value))
+	temporaryFile = PROMETHEUS_FILE + ".tmp"
+	with open(temporaryFile, "w") as oFile:
+		oFile.write("\n".join(lines) + "\n")
+	os.replace(temporaryFile, PROMETHEUS_FILE)
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+import sys, getopt
+import os
+import coverage_index
+
+USAGE = "\nThe script checks the coverage of the histidine kinase (HK) and response regulator (RR) files of obtain_and_process_tcs.py\n" + \
+	"through a per-genome index: the rows of every genome in each file and the byte range holding them.\n" + \
+	"index  - builds the index in one pass over the two files (and the journal of the run, which adds the genomes without rows).\n" + \
+	"         obtain_and_process_tcs.py writes the same index during the fetch with --coverage-index.\n" + \
+	"report - reports the genomes with HK rows only, with RR rows only and without rows, and compared with the input file of the fetch\n" + \
+	"         and its timeout_genomes.txt, the genomes missing from the outputs and the timed-out genomes that are still missing.\n" + \
+	"rows   - prints the rows of the given genomes, read from their byte ranges.\n\n" + \
+	"python " + sys.argv[0] + " index|report|rows" + '''
+	-h || --help               - help
+	-f || --ffile              - histidine kinases file (first output file of obtain_and_process_tcs.py)
+	-s || --sfile              - response regulators file (second output file of obtain_and_process_tcs.py)
+	-x || --index              - index file (default: the histidine kinases file + ".coverage.tsv"). report builds it first when it does not exist
+	-j || --journal            - index: journal of the run (default: the histidine kinases file + ".journal" when it exists)
+	-i || --ifile              - report: input file of obtain_and_process_tcs.py; its genomes missing from the outputs are reported
+	-t || --timeout-file       - report: timeout_genomes.txt of obtain_and_process_tcs.py
+	-o || --output-prefix      - report: also write the genome lists to PREFIX_hk_only.txt, PREFIX_rr_only.txt, PREFIX_missing.txt and PREFIX_timed_out.txt
+	-p || --protein            - rows: HK, RR or both (default both)
+Genomes to print with rows follow the options, e.g. python ''' + sys.argv[0] + ''' rows -x his_kinases.tsv.coverage.tsv GCF_000006745.1
+'''
+# Variables controlled by the script parameters
+COMMAND = None
+HK_FILE = None
+RR_FILE = None
+INDEX_FILE = None
+JOURNAL_FILE = None
+INPUT_FILE = None
+TIMEOUT_FILE = None
+OUTPUT_PREFIX = None
+PROTEIN_KEYS = coverage_index.PROTEIN_KEYS
+GENOMES = []
+
+def initialize(argv):
+	global COMMAND, HK_FILE, RR_FILE, INDEX_FILE, JOURNAL_FILE, INPUT_FILE, TIMEOUT_FILE, OUTPUT_PREFIX, PROTEIN_KEYS, GENOMES
+	arguments = argv[1:]
+	if arguments and arguments[0] in ("index", "report", "rows"):
+		COMMAND = arguments[0]
+		arguments = arguments[1:]
+	try:
+		opts, GENOMES = getopt.getopt(arguments,"hf:s:x:j:i:t:o:p:",["help", "ffile=", "sfile=", "index=", "journal=", "ifile=", "timeout-file=", "output-prefix=", "protein="])
+	except getopt.GetoptError as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				print(USAGE)
+				sys.exit()
+			elif opt in ("-f", "--ffile"):
+				HK_FILE = str(arg).strip()
+			elif opt in ("-s", "--sfile"):
+				RR_FILE = str(arg).strip()
+			elif opt in ("-x", "--index"):
+				INDEX_FILE = str(arg).strip()
+			elif opt in ("-j", "--journal"):
+				JOURNAL_FILE = str(arg).strip()
+			elif opt in ("-i", "--ifile"):
+				INPUT_FILE = str(arg).strip()
+			elif opt in ("-t", "--timeout-file"):
+				TIMEOUT_FILE = str(arg).strip()
+			elif opt in ("-o", "--output-prefix"):
+				OUTPUT_PREFIX = str(arg).strip()
+			elif opt in ("-p", "--protein"):
+				arg = str(arg).strip().upper()
+				if arg not in coverage_index.PROTEIN_KEYS + ["BOTH"]:
+					raise ValueError("-p (--protein) should be HK, RR or both")
+				PROTEIN_KEYS = coverage_index.PROTEIN_KEYS if arg == "BOTH" else [arg]
+		if COMMAND is None:
+			raise ValueError("One of the commands index, report or rows is required")
+		if INDEX_FILE is None and HK_FILE:
+			INDEX_FILE = coverage_index.indexFileFor(HK_FILE)
+		if not INDEX_FILE:
+			raise ValueError("-x (--index) or -f (--ffile) is required")
+		if COMMAND == "index" and not (HK_FILE and RR_FILE):
+			raise ValueError("index requires -f (--ffile) and -s (--sfile)")
+		if COMMAND == "report" and not os.path.exists(INDEX_FILE) and not (HK_FILE and RR_FILE):
+			raise ValueError(INDEX_FILE + " does not exist; -f (--ffile) and -s (--sfile) are required to build it")
+		if COMMAND == "rows" and not GENOMES:
+			raise ValueError("rows requires genome versions after the options")
+	except Exception as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	if JOURNAL_FILE is None and HK_FILE and os.path.exists(HK_FILE + ".journal"):
+		JOURNAL_FILE = HK_FILE + ".journal"
+
+def buildIndex():
+	genomeToEntry, splitGenomes = coverage_index.buildIndex(HK_FILE, RR_FILE, JOURNAL_FILE)
+	coverage_index.writeIndex(INDEX_FILE, HK_FILE, RR_FILE, genomeToEntry)
+	print("Indexed genomes: {} ({}) in {}".format(len(genomeToEntry), "with the journal " + JOURNAL_FILE if JOURNAL_FILE else "without a journal: genomes without rows are not known", INDEX_FILE))
+	if splitGenomes:
+		print("Genomes whose rows are not consecutive (the index points at their first rows only): " + ", ".join(sorted(set(splitGenomes))))
+
+#Genome versions of an input file of obtain_and_process_tcs.py (the second column), in the order of the file
+def readInputGenomes(inputFile):
+	genomeVersions = []
+	with open(inputFile, "r") as iFile:
+		for line in iFile:
+			record = line.rstrip("\n").split("\t")
+			if len(record) > 1 and record[1]:
+				genomeVersions.append(record[1])
+	return genomeVersions
+
+def readTimeoutGenomes(timeoutFile):
+	with open(timeoutFile, "r") as iFile:
+		return [line.strip() for line in iFile if line.strip()]
+
+def writeGenomeList(suffix, genomes):
+	with open(OUTPUT_PREFIX + "_" + suffix + ".txt", "w") as oFile:
+		for genomeVersion in genomes:
+			oFile.write(genomeVersion + "\n")
+
+def report():
+	if not os.path.exists(INDEX_FILE):
+		buildIndex()
+	keyToFile, genomeToEntry = coverage_index.loadIndex(INDEX_FILE)
+	hkOnly = [genome for genome, entry in genomeToEntry.items() if entry[0] and not entry[3]]
+	rrOnly = [genome for genome, entry in genomeToEntry.items() if entry[3] and not entry[0]]
+	withoutRows = [genome for genome, entry in genomeToEntry.items() if not entry[0] and not entry[3]]
+	print("Genomes in the index:", len(genomeToEntry))
+	print("  with HK and RR rows:", len(genomeToEntry) - len(hkOnly) - len(rrOnly) - len(withoutRows))
+	print("  with HK rows only:", len(hkOnly))
+	print("  with RR rows only:", len(rrOnly))
+	print("  without rows (fetched, no two-component system genes):", len(withoutRows))
+	print("HK rows: {}, RR rows: {}".format(sum(entry[0] for entry in genomeToEntry.values()), sum(entry[3] for entry in genomeToEntry.values())))
+	for key, uncovered in coverage_index.uncoveredBytes(keyToFile, genomeToEntry).items():
+		if uncovered:
+			print("WARNING: {} bytes of {} follow the last indexed genome; index the file again".format(uncovered, keyToFile[key]))
+	missing = []
+	if INPUT_FILE:
+		inputGenomes = readInputGenomes(INPUT_FILE)
+		missing = [genome for genome in inputGenomes if genome not in genomeToEntry]
+		print("Genomes of the input file:", len(inputGenomes))
+		print("  missing from the outputs:", len(missing))
+	timedOut = []
+	if TIMEOUT_FILE:
+		timeoutGenomes = list(dict.fromkeys(readTimeoutGenomes(TIMEOUT_FILE)))
+		timedOut = [genome for genome in timeoutGenomes if genome not in genomeToEntry]
+		print("Timed-out genomes:", len(timeoutGenomes))
+		print("  still missing from the outputs:", len(timedOut))
+		print("  fetched by a later run:", len(timeoutGenomes) - len(timedOut))
+	if OUTPUT_PREFIX:
+		writeGenomeList("hk_only", hkOnly)
+		writeGenomeList("rr_only", rrOnly)
+		if INPUT_FILE:
+			writeGenomeList("missing", missing)
+		if TIMEOUT_FILE:
+			writeGenomeList("timed_out", timedOut)
+
+def printRows():
+	keyToFile, genomeToEntry = coverage_index.loadIndex(INDEX_FILE)
+	for genomeVersion in GENOMES:
+		if genomeVersion not in genomeToEntry:
+			print("Genome " + genomeVersion + " is not in the index", file=sys.stderr)
+			continue
+		for key in PROTEIN_KEYS:
+			sys.stdout.write("".join(coverage_index.genomeRows(keyToFile, genomeToEntry, genomeVersion, key)))
+
+def main(argv):
+	initialize(argv)
+	if COMMAND == "index":
+		buildIndex()
+	elif COMMAND == "report":
+		report()
+	else:
+		printRows()
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+import sys, getopt
+import os
+import shlex
+import importlib
+import obtain_and_process_tcs
+import run_metrics
+import mist_client
+import architecture_cache
+import analyze_tcs_per_genome
+import analyze_tcs_per_taxon
+
+USAGE = "\nThe script runs obtain_and_process_tcs.py, analyze_tcs_per_genome.py and analyze_tcs_per_taxon.py as one streaming pipeline in one process.\n" + \
+	"The records of every genome are counted per genome as soon as they are made and the counts are added to per-taxon statistics in memory,\n" + \
+	"so no intermediate file is written or parsed again. The output files of the first two scripts can still be written as side outputs.\n" + \
+	"Written per-taxon statistics (the files of analyze.sh, with X the name given with -n and LEVEL the taxonomy level):\n" + \
+	"his_kinases_X_{domains,domain_comb,superfamily,superfamily_comb}_LEVEL.tsv and the same for resp_regulators_X.\n\n" + \
+	"python " + sys.argv[0] + '''
+	-h || --help               - help
+	-o || --obtain             - options of one obtain_and_process_tcs.py run, quoted (e.g. "-i archaea_mist.tsv -d mist -w 8", or "process -r raw.ndjson.gz").
+	                             Repeat it to stream several runs (e.g. MiST and MetaMiST) into the same statistics, as the *_all.tsv files of analyze.sh.
+	                             Its -f and -s output files are written as side outputs when given. A streaming run always starts anew (no journal)
+	-s || --sfile              - file with MiST domain information (the -s file of analyze_tcs_per_genome.py)
+	-x || --taxonomy           - GTDB taxonomy metadata file (the -s file of analyze_tcs_per_taxon.py; default: the file of this repository)
+	--index-dir                - directory for the taxonomy index instead of the directory of the taxonomy file
+	-t || --taxlevel           - taxonomy levels: one of "species", "genus", "family", "order", "class", "phylum", "kingdom", a comma-separated list of them
+	                             or "all" (default all)
+	-n || --name               - name of the analyzed set in the output file names (default all)
+	-f || --output-dir         - directory of the per-taxon statistics (default: current directory)
+	-g || --genome-dir         - also write the per-genome statistics of analyze_tcs_per_genome.py to this directory (side output)
+'''
+# Variables controlled by the script parameters
+OBTAIN_RUNS = []
+DOMAINS_FILE = None
+TAXONOMY_FILE = analyze_tcs_per_taxon.INPUT_FILE2
+INDEX_DIR = None
+TAXONOMY_LEVELS = analyze_tcs_per_taxon.ALL_TAXONOMY_LEVELS
+NAME = "all"
+OUTPUT_DIR = "."
+GENOME_DIR = None
+
+# Variables set within the script
+PROTEIN_TYPE_TO_PREFIX = {obtain_and_process_tcs.PROTEIN_TYPES[0]: "his_kinases", obtain_and_process_tcs.PROTEIN_TYPES[1]: "resp_regulators"}
+# the four statistics of analyze_tcs_per_genome.py, in the order countPerGenome() returns them
+STATISTICS = ["domains", "domain_comb", "superfamily", "superfamily_comb"]
+# {(protein type, statistics): per-taxon accumulator of analyze_tcs_per_taxon.py}
+STREAM_TO_ACCUMULATOR = {}
+# {(protein type, statistics): per-genome side output file}
+STREAM_TO_GENOME_FILE = {}
+GENOME_COUNT = 0
+
+def initialize(argv):
+	global OBTAIN_RUNS, DOMAINS_FILE, TAXONOMY_FILE, INDEX_DIR, TAXONOMY_LEVELS, NAME, OUTPUT_DIR, GENOME_DIR
+	try:
+		opts, args = getopt.getopt(argv[1:],"ho:s:x:t:n:f:g:",["help", "obtain=", "sfile=", "taxonomy=", "index-dir=", "taxlevel=", "name=", "output-dir=", "genome-dir="])
+		if len(opts) == 0:
+			raise getopt.GetoptError("Options are required\n")
+	except getopt.GetoptError as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+	try:
+		for opt, arg in opts:
+			if opt in ("-h", "--help"):
+				print(USAGE)
+				sys.exit()
+			elif opt in ("-o", "--obtain"):
+				OBTAIN_RUNS.append(shlex.split(arg))
+			elif opt in ("-s", "--sfile"):
+				DOMAINS_FILE = str(arg).strip()
+			elif opt in ("-x", "--taxonomy"):
+				TAXONOMY_FILE = str(arg).strip()
+			elif opt == "--index-dir":
+				INDEX_DIR = str(arg).strip()
+			elif opt in ("-t", "--taxlevel"):
+				arg = str(arg).strip()
+				TAXONOMY_LEVELS = analyze_tcs_per_taxon.ALL_TAXONOMY_LEVELS if arg == "all" else [level.strip() for level in arg.split(",")]
+				for level in TAXONOMY_LEVELS:
+					if analyze_tcs_per_taxon.tax_level_selector(level) is None:
+						raise ValueError("Incorrect argument of -t (--taxlevel) option: " + level)
+			elif opt in ("-n", "--name"):
+				NAME = str(arg).strip()
+			elif opt in ("-f", "--output-dir"):
+				OUTPUT_DIR = str(arg).strip()
+			elif opt in ("-g", "--genome-dir"):
+				GENOME_DIR = str(arg).strip()
+		if not OBTAIN_RUNS:
+			raise ValueError("At least one -o (--obtain) run is required")
+		if not DOMAINS_FILE:
+			raise ValueError("-s (--sfile) is required")
+	except Exception as e:
+		print("===========ERROR==========\n " + str(e) + USAGE)
+		sys.exit(2)
+
+# the names analyze.sh gives the files: his_kinases_X_domains.tsv (per genome), his_kinases_X_domains_genus.tsv (per taxon)
+def streamName(proteinType, statistics):
+	return "_".join([PROTEIN_TYPE_TO_PREFIX[proteinType], NAME, statistics])
+
+##*********************************************************************##
+##**************************** Streaming block ************************##
+# called by obtain_and_process_tcs.py with the rows of every genome it commits
+def consumeGenome(genomeVersion, proteinTypeToRows):
+	global GENOME_COUNT
+	GENOME_COUNT+=1
+	for proteinType, rows in proteinTypeToRows.items():
+		# the rows of a protein type are the lines of the output file of obtain_and_process_tcs.py for the genome
+		for genomeId, dataDicts in analyze_tcs_per_genome.countPerGenome(rows):
+			for statistics, dataDict in zip(STATISTICS, dataDicts):
+				stream = (proteinType, statistics)
+				if GENOME_DIR:
+					analyze_tcs_per_genome.writeToFile(dataDict, genomeId, STREAM_TO_GENOME_FILE[stream])
+				analyze_tcs_per_taxon.add_genome(genomeId, dataDict, STREAM_TO_ACCUMULATOR[stream])
+
+def runObtain(arguments, runNumber):
+	# every run starts from the defaults of obtain_and_process_tcs.py, as a run of the script would; the modules it uses
+	# are not reloaded, so their totals are cleared (the memoized architectures are kept for the next run)
+	if runNumber > 0:
+		importlib.reload(obtain_and_process_tcs)
+		run_metrics.reset()
+		mist_client.resetStatistics()
+		architecture_cache.resetStatistics()
+	obtain_and_process_tcs.ROWS_CONSUMER = consumeGenome
+	obtain_and_process_tcs.initialize([obtain_and_process_tcs.__file__] + arguments)
+	if obtain_and_process_tcs.FETCH_ONLY:
+		print("===========ERROR==========\n --fetch-only leaves no records to stream" + USAGE)
+		sys.exit(2)
+	obtain_and_process_tcs.run()
+
+def runPipeline():
+	for proteinType in PROTEIN_TYPE_TO_PREFIX:
+		for statistics in STATISTICS:
+			STREAM_TO_ACCUMULATOR[(proteinType, statistics)] = analyze_tcs_per_taxon.new_accumulator()
+			if GENOME_DIR:
+				STREAM_TO_GENOME_FILE[(proteinType, statistics)] = os.path.join(GENOME_DIR, streamName(proteinType, statistics) + ".tsv")
+	if GENOME_DIR:
+		analyze_tcs_per_genome.openOutputFiles(list(STREAM_TO_GENOME_FILE.values()))
+	try:
+		for runNumber, arguments in enumerate(OBTAIN_RUNS):
+			runObtain(arguments, runNumber)
+	finally:
+		if GENOME_DIR:
+			analyze_tcs_per_genome.closeOutputFiles()
+
+def writeStatistics():
+	for stream, accumulator in STREAM_TO_ACCUMULATOR.items():
+		for level in TAXONOMY_LEVELS:
+			outputFile = os.path.join(OUTPUT_DIR, streamName(*stream) + "_" + level + ".tsv")
+			analyze_tcs_per_taxon.write_to_file(analyze_tcs_per_taxon.roll_up_statistics(level, accumulator), outputFile, accumulator)
+##************************* Streaming block finish ********************##
+##*********************************************************************##
+
+def main(argv):
+	initialize(argv)
+	analyze_tcs_per_genome.readDomainSuperfamilies(DOMAINS_FILE)
+	analyze_tcs_per_taxon.load_taxonomy(TAXONOMY_FILE, INDEX_DIR)
+	for directory in (OUTPUT_DIR, GENOME_DIR):
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+	runPipeline()
+	writeStatistics()
+	print("Genomes streamed:", GENOME_COUNT)
+	if analyze_tcs_per_taxon.GENOMES_WITHOUT_TAXONOMY:
+		print("Genomes missing from the taxonomy file (skipped):", len(analyze_tcs_per_taxon.GENOMES_WITHOUT_TAXONOMY))
+	analyze_tcs_per_taxon.report_memory()
+
+if __name__ == "__main__":
+	main(sys.argv)
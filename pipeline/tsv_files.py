@@ -0,0 +1,27 @@
+#Opening of the tabulated files shared by the pipeline scripts.
+#Inputs compressed with gzip are recognized by their content, so .tsv and .tsv.gz files (or a gzip file without the suffix) are read the same way.
+import gzip
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def isGzipFile(path):
+	with open(path, "rb") as iFile:
+		return iFile.read(2) == GZIP_MAGIC
+
+#Opens a tabulated file for reading as text
+def openTsv(path):
+	if isGzipFile(path):
+		return gzip.open(path, "rt", encoding="utf-8")
+	return open(path, "r")
+
+#Output files are compressed when their name ends with .gz
+def isGzipOutput(path):
+	return path.endswith(".gz")
+
+#Encodes text for appending to the output file: a separate gzip member for a compressed file, which keeps the file readable
+#after any number of appends and lets it be truncated at any member boundary
+def encodeForOutput(path, text):
+	data = text.encode("utf-8")
+	if isGzipOutput(path):
+		return gzip.compress(data, mtime=0)
+	return data
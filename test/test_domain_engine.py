@@ -0,0 +1,93 @@
+#Parity of the batch domain engine with the per-gene functions of obtain_and_process_tcs.py:
+#resolveDomainsBatch() must give the architecture of processHoles(removeOverlapps(sorted hits)) for every hit list.
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline"))
+#obtain_and_process_tcs.py configures a log file named after the running program when it is imported; a handler of the root
+#logger keeps that configuration from applying to the test runner
+logging.getLogger().addHandler(logging.NullHandler())
+import domain_engine
+import obtain_and_process_tcs
+
+NAMES = ["PAS", "GAF", "HisKA", "HisKA_3", "His_kinase", "HATPase_c", "HWE_HK", "Response_reg", "FleQ", "CheY", "Cache_1"]
+EVALUES = [1e-3, 1e-5, 1e-10]
+TOLERANCE = domain_engine.OVERLAP_TOLERANCE
+
+def hit(name, aliFrom, aliTo, evalue=1e-5, envFrom=None, envTo=None):
+	return {"name": name, "ali_from": aliFrom, "ali_to": aliTo, "env_from": aliFrom if envFrom is None else envFrom,
+		"env_to": aliTo if envTo is None else envTo, "i_evalue": evalue}
+
+def legacyArchitecture(hits):
+	if not hits:
+		return []
+	domains = obtain_and_process_tcs.processHoles(obtain_and_process_tcs.removeOverlapps(sorted(hits, key=lambda pfam: pfam["ali_from"])))
+	return [(domain["name"], domain["env_from"], domain["env_to"]) for domain in domains]
+
+def assertParity(hitLists):
+	architectures = domain_engine.resolveDomainsBatch(hitLists)
+	assert len(architectures) == len(hitLists)
+	for hits, architecture in zip(hitLists, architectures):
+		assert [tuple(domain) for domain in architecture] == legacyArchitecture(hits), hits
+
+def randomHits(generator):
+	hits = []
+	position = generator.randint(1, 200)
+	for number in range(generator.randint(0, 8)):
+		length = generator.choice([3, 8, 40, 120, 200])
+		#the next hit starts after the previous one, overlapping it by about the tolerance, or anywhere
+		choice = generator.random()
+		if hits and choice < 0.4:
+			aliFrom = hits[-1]["ali_to"] - TOLERANCE + generator.randint(-1, 1)
+		elif hits and choice < 0.5:
+			aliFrom = hits[-1]["ali_from"]
+		else:
+			aliFrom = position + generator.randint(0, 300)
+		aliFrom = max(1, aliFrom)
+		hits.append(hit(generator.choice(NAMES), aliFrom, aliFrom + length, generator.choice(EVALUES),
+			max(1, aliFrom - generator.randint(0, 5)), aliFrom + length + generator.randint(0, 5)))
+		if generator.random() < 0.1:
+			#a duplicate hit, equal in every field
+			hits.append(dict(hits[-1]))
+		position = aliFrom + length
+	generator.shuffle(hits)
+	return hits
+
+def test_empty_and_single_hit():
+	assertParity([[], [hit("PAS", 5, 60)], [hit("HATPase_c", 400, 520)], [hit("Response_reg", 150, 260)]])
+
+def test_duplicate_and_tied_hits():
+	duplicate = hit("HisKA", 200, 260, 1e-5)
+	assertParity([
+		[duplicate, dict(duplicate), hit("HATPase_c", 300, 420)],
+		[hit("PAS", 10, 110, 1e-5), hit("GAF", 10, 110, 1e-5)],
+		[hit("PAS", 10, 110, 1e-5), hit("GAF", 10, 130, 1e-5), hit("Cache_1", 10, 90, 1e-5)],
+		[hit("PAS", 10, 110, 1e-5), hit("GAF", 50, 150, 1e-5), dict(hit("PAS", 10, 110, 1e-5)), hit("HATPase_c", 300, 420)],
+	])
+
+def test_overlaps_around_the_tolerance():
+	hitLists = []
+	for overlap in (TOLERANCE - 1, TOLERANCE, TOLERANCE + 1):
+		for evalues in ((1e-5, 1e-10), (1e-10, 1e-5), (1e-5, 1e-5)):
+			first = hit("PAS", 10, 110, evalues[0])
+			second = hit("GAF", 110 - overlap, 220, evalues[1])
+			hitLists.append([first, second])
+			hitLists.append([first, second, hit("Cache_1", 220 - overlap, 330, 1e-3)])
+	assertParity(hitLists)
+
+def test_hatpase_without_hiska():
+	hitLists = [[hit("HATPase_c", 50, 170)], [hit("HATPase_c", 600, 720)]]
+	minimum = domain_engine.MIN_LENGTH_FOR_HISKA + domain_engine.MIN_DOMAIN_LENGTH
+	#the space between the penultimate domain and the HATPase domain just below, at and above the length of <HisKA> plus a domain
+	for space in (domain_engine.MIN_LENGTH_FOR_HISKA - 1, minimum - 1, minimum, minimum + 1, minimum + 200):
+		penultimate = hit("PAS", 120, 200)
+		hatpase = hit("HWE_HK", 200 + space, 320 + space)
+		hitLists.append([penultimate, hatpase])
+		hitLists.append([hit("Cache_1", 5, 90), penultimate, hatpase, hit("Response_reg", 340 + space, 450 + space)])
+	assertParity(hitLists)
+
+def test_random_hit_lists():
+	generator = random.Random(8)
+	assertParity([randomHits(generator) for number in range(20000)])